@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+'''
+    watdo.benchmarks
+    ~~~~~~~~~~~~~~~~
+
+    This package contains benchmarks for watdo's hot paths. Run them with::
+
+        python -m benchmarks.run --output report.json
+
+    :copyright: (c) 2014 Markus Unterwaditzer
+    :license: MIT, see LICENSE for more details.
+'''
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+'''
+    watdo.benchmarks.run
+    ~~~~~~~~~~~~~~~~~~~~
+
+    This module times each phase of a watdo run against synthetic vdirs and
+    writes the results as JSON.
+
+    :copyright: (c) 2014 Markus Unterwaditzer
+    :license: MIT, see LICENSE for more details.
+'''
+
+import contextlib
+import io
+import json
+import platform
+import shutil
+import sys
+import tempfile
+import timeit
+
+import click
+
+import watdo
+from watdo import editor, model
+from watdo.cache import TaskIndex
+from watdo.query import Query
+
+from .vdir import generate_vdir
+
+#: ratio of tasks modified in the editor
+MODIFIED_RATIO = 0.01
+#: number of tasks shown with ``--limit``
+LIMIT = 50
+
+
+@contextlib.contextmanager
+def _quiet():
+    '''Swallow the parse errors printed for malformed files.'''
+    stdout = sys.stdout
+    sys.stdout = io.StringIO() if str is not bytes else io.BytesIO()
+    try:
+        yield
+    finally:
+        sys.stdout = stdout
+
+
+class _Timer(object):
+    def __init__(self, size):
+        self.size = size
+        self.results = []
+
+    @contextlib.contextmanager
+    def __call__(self, phase, **counters):
+        start = timeit.default_timer()
+        yield counters
+        self.results.append(dict(counters, tasks=self.size, phase=phase,
+                                 seconds=timeit.default_timer() - start))
+
+
+def _modify(lines):
+    '''Change the summary of some tasks in the tmpfile.'''
+    every = int(1 / MODIFIED_RATIO)
+    rv = []
+    i = 0
+    for line in lines:
+        if line and not line.startswith((b'//', b' ')):
+            i += 1
+            if i % every == 0:
+                line = b'changed ' + line
+        rv.append(line)
+    return rv
+
+
+def run_benchmark(path, size, jobs=1, **vdir_args):
+    '''Generate a vdir with ``size`` tasks inside ``path`` and time every
+    phase. Returns a list of result dicts.'''
+    timer = _Timer(size)
+    generate_vdir(path, tasks=size, **vdir_args)
+
+    with _quiet():
+        index = TaskIndex()
+        with timer('walk_calendars') as counters:
+            counters['jobs'] = jobs
+            tasks = list(model.walk_calendars(path, index=index, jobs=jobs))
+
+        with timer('walk_calendars_indexed'):
+            tasks = list(model.walk_calendars(path, index=index))
+
+        # the query every run without -q uses
+        with timer('walk_calendars_query'):
+            list(model.walk_calendars(path, index=index,
+                                      predicate=Query(u'', pending=True)))
+
+    with timer('generate_tmpfile_limit') as counters:
+        counters['limit'] = LIMIT
+        editor.generate_tmpfile(io.BytesIO(), tasks, limit=LIMIT)
+
+    f = io.BytesIO()
+    with timer('generate_tmpfile'):
+        old_ids = editor.generate_tmpfile(f, tasks)
+    del tasks
+
+    lines = _modify(f.getvalue().splitlines())
+    with timer('parse_tmpfile'):
+        new_ids = editor.parse_tmpfile(lines)
+
+    with timer('diff_calendars') as counters:
+        changes = list(editor.get_changes(old_ids, new_ids))
+        counters['changes'] = len(changes)
+
+    with timer('make_changes') as counters:
+        batch = model.WriteBatch()
+        for description, func in changes:
+            func({'path': path}, batch)
+        counters['errors'] = len(batch.commit())
+
+    return timer.results
+
+
+@click.command()
+@click.option('--sizes', default='1000,10000,100000',
+              help='Comma-separated numbers of tasks.')
+@click.option('--calendars', default=5, help='Number of calendars.')
+@click.option('--seed', default=0, help='Seed for the generated vdirs.')
+@click.option('--malformed', default=0.01,
+              help='Ratio of malformed files.')
+@click.option('--jobs', default=1, help='Processes for reading files.')
+@click.option('--output', '-o', type=click.File('w'), default='-',
+              help='Where to write the JSON report.')
+def main(sizes, calendars, seed, malformed, jobs, output):
+    '''Benchmark watdo against synthetic vdirs.'''
+    results = []
+    for size in [int(x) for x in sizes.split(',')]:
+        path = tempfile.mkdtemp(prefix='watdo-benchmark-')
+        try:
+            results.extend(run_benchmark(path, size, jobs=jobs,
+                                         calendars=calendars, seed=seed,
+                                         malformed_ratio=malformed))
+        finally:
+            shutil.rmtree(path)
+        click.echo(u'Finished {} tasks.'.format(size), err=True)
+
+    json.dump({
+        'watdo': watdo.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results
+    }, output, indent=2, sort_keys=True)
+    output.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+'''
+    watdo.benchmarks.vdir
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    This module generates reproducible synthetic vdirs.
+
+    :copyright: (c) 2014 Markus Unterwaditzer
+    :license: MIT, see LICENSE for more details.
+'''
+
+import datetime
+import os
+import random
+
+WORDS = (u'buy milk call mom write report fix bug review patch invoice '
+         u'meeting dentist taxes garden laundry book flight renew passport '
+         u'clean kitchen update résumé').split()
+
+STATUSES = (u'NEEDS-ACTION', u'IN-PROCESS', u'COMPLETED', u'CANCELLED')
+
+
+def _fold(line):
+    '''Fold a content line to 75 octets (RFC 5545, section 3.1).'''
+    line = line.encode('utf-8')
+    rv = []
+    while len(line) > 75:
+        i = 75
+        # don't split multi-byte characters
+        while line[i:i + 1] and (ord(line[i:i + 1]) & 0xC0) == 0x80:
+            i -= 1
+        rv.append(line[:i])
+        line = b' ' + line[i:]
+    rv.append(line)
+    return b'\r\n'.join(rv) + b'\r\n'
+
+
+def _escape(text):
+    return (text.replace(u'\\', u'\\\\').replace(u';', u'\\;')
+            .replace(u',', u'\\,').replace(u'\n', u'\\n'))
+
+
+def _words(rng, n):
+    return u' '.join(rng.choice(WORDS) for _ in range(n))
+
+
+def generate_task(rng, uid, due_ratio=0.5, statuses=(0.6, 0.1, 0.25, 0.05),
+                  description_lines=(0, 3)):
+    '''Return the raw content of a single task file.'''
+    today = datetime.date(2014, 9, 1)
+    lines = [u'BEGIN:VCALENDAR', u'VERSION:2.0',
+             u'PRODID:-//watdo//benchmarks//EN', u'BEGIN:VTODO',
+             u'UID:{}'.format(uid),
+             u'SUMMARY:{}'.format(_escape(_words(rng, rng.randint(2, 8))))]
+
+    if rng.random() < due_ratio:
+        due = today + datetime.timedelta(days=rng.randint(-30, 365))
+        if rng.random() < 0.5:
+            lines.append(u'DUE;VALUE=DATE:{}'.format(due.strftime('%Y%m%d')))
+        else:
+            lines.append(u'DUE:{}T{:02}0000'.format(due.strftime('%Y%m%d'),
+                                                    rng.randint(0, 23)))
+
+    status = STATUSES[-1]
+    x = rng.random()
+    for candidate, ratio in zip(STATUSES, statuses):
+        if x < ratio:
+            status = candidate
+            break
+        x -= ratio
+    if status != u'NEEDS-ACTION':
+        lines.append(u'STATUS:{}'.format(status))
+    if status == u'COMPLETED':
+        done = today - datetime.timedelta(days=rng.randint(0, 1000))
+        lines.append(u'COMPLETED:{}T120000Z'.format(done.strftime('%Y%m%d')))
+
+    n = rng.randint(*description_lines)
+    if n:
+        description = u'\n'.join(_words(rng, rng.randint(5, 30))
+                                 for _ in range(n))
+        lines.append(u'DESCRIPTION:{}'.format(_escape(description)))
+
+    lines.extend((u'END:VTODO', u'END:VCALENDAR'))
+    return b''.join(_fold(line) for line in lines)
+
+
+def generate_malformed(rng):
+    '''Return the content of a broken task file.'''
+    return rng.choice((
+        b'BEGIN:VCALENDAR\r\nBEGIN:VTODO\r\nSUMMARY:truncated\r\n',
+        b'BEGIN:VCALENDAR\r\nthis is not ical\r\nEND:VCALENDAR\r\n',
+        b'BEGIN:VCALENDAR\r\nBEGIN:VTODO\r\nDUE:yesterday\r\n'
+        b'END:VTODO\r\nEND:VCALENDAR\r\n',
+    ))
+
+
+def generate_vdir(path, tasks=1000, calendars=5, seed=0, due_ratio=0.5,
+                  statuses=(0.6, 0.1, 0.25, 0.05), description_lines=(0, 3),
+                  malformed_ratio=0.0):
+    '''Create ``calendars`` calendars with ``tasks`` tasks in total inside
+    ``path``. The same arguments always produce the same files.
+
+    :param statuses: ratios of NEEDS-ACTION, IN-PROCESS, COMPLETED and
+        CANCELLED tasks.
+    :param description_lines: range of the number of description lines.
+    :param malformed_ratio: ratio of files that can't be parsed.
+    '''
+    rng = random.Random(seed)
+    dirpaths = [os.path.join(path, 'calendar{}'.format(i))
+                for i in range(calendars)]
+    for dirpath in dirpaths:
+        if not os.path.exists(dirpath):
+            os.makedirs(dirpath)
+
+    for i in range(tasks):
+        uid = u'benchmark-{}-{}@watdo'.format(seed, i)
+        if rng.random() < malformed_ratio:
+            data = generate_malformed(rng)
+        else:
+            data = generate_task(rng, uid, due_ratio=due_ratio,
+                                 statuses=statuses,
+                                 description_lines=description_lines)
+        filepath = os.path.join(rng.choice(dirpaths), uid + u'.ics')
+        with open(filepath, 'wb') as f:
+            f.write(data)
+    return dirpaths
@@ -29,10 +29,13 @@ setup(
     description='Task-manager for the command line.',
     license='MIT',
     long_description=open('README.rst').read(),
-    packages=find_packages(exclude=['tests.*', 'tests']),
+    packages=find_packages(exclude=['tests.*', 'tests', 'benchmarks']),
     include_package_data=True,
     entry_points={
         'console_scripts': ['watdo = watdo.cli:main']
     },
-    install_requires=['icalendar', 'click', 'atomicwrites']
+    install_requires=['icalendar', 'click', 'atomicwrites'],
+    extras_require={
+        ':python_version < "3.5"': ['scandir']
+    }
 )
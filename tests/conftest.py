@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+'''
+    watdo.tests.conftest
+    ~~~~~~~~~~~~~~~~~~~~
+
+    :copyright: (c) 2014 Markus Unterwaditzer
+    :license: MIT, see LICENSE for more details.
+'''
+
+import pytest
+
+
+@pytest.fixture
+def tasks_dir(tmpdir):
+    return tmpdir.mkdir('tasks')
+
+
+@pytest.fixture
+def config(tmpdir, tasks_dir):
+    '''A function that writes a config for ``tasks_dir`` and returns the
+    environment to run watdo with. Its keyword arguments are written as
+    further options of the ``[watdo]`` section.'''
+    def write(**options):
+        options.setdefault('path', str(tasks_dir))
+        options.setdefault('tmppath', str(tmpdir.join('tmp').ensure(dir=True)))
+        f = tmpdir.join('config')
+        f.write('[watdo]\n' + ''.join(
+            '{} = {}\n'.format(key, value)
+            for key, value in sorted(options.items())))
+        return {'WATDO_CONFIG': str(f)}
+    return write
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+'''
+    watdo.tests.test_archive
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright: (c) 2014 Markus Unterwaditzer
+    :license: MIT, see LICENSE for more details.
+'''
+
+import base64
+import datetime
+
+import pytest
+
+from watdo.archive import Archive, is_archivable
+from watdo.cache import TaskIndex
+import watdo.model as model
+Task = model.Task
+
+
+@pytest.mark.parametrize('fields,expected', [
+    ({'status': u'NEEDS-ACTION'}, False),
+    ({'status': u'COMPLETED'}, False),
+    ({'status': u'COMPLETED', 'completed': u'garbage'}, False),
+    ({'status': u'cancelled', 'completed': u'20141001T100000Z'}, True),
+    ({'status': u'COMPLETED', 'completed': u'20141020T100000'}, False),
+    ({'status': u'COMPLETED', 'completed': u'20141014'}, True),
+    (None, False),
+])
+def test_is_archivable(fields, expected):
+    assert is_archivable(fields, datetime.datetime(2014, 10, 15)) == expected
+    if fields is not None and fields['status'] != u'NEEDS-ACTION':
+        assert is_archivable(fields)
+
+
+def test_compact(tmpdir):
+    tasks_dir = tmpdir.mkdir('tasks')
+    cal = tasks_dir.mkdir('cal')
+    for summary, status in ((u'pending', u''), (u'done', u'COMPLETED')):
+        Task(summary=summary, status=status, calendar=u'cal',
+             basepath=str(tasks_dir)).write(create=True)
+    done, = [x for x in cal.listdir() if b'COMPLETED' in x.read_binary()]
+    raw = done.read_binary()
+
+    index = TaskIndex()
+    list(model.walk_calendars(str(tasks_dir), index=index))
+    archive = Archive(str(tmpdir.join('archive')), str(tasks_dir))
+    assert archive.compact(index) == (1, [])
+    assert archive.calendars() == [u'cal']
+
+    task, = model.walk_calendars(str(tasks_dir), index=index)
+    assert task.summary == u'pending'
+
+    task, = archive.walk()
+    assert task.summary == u'done'
+    assert task.archived
+    assert task.filepath == str(done)
+    assert base64.b64decode(list(archive._read(u'cal'))[0]['data']) == raw
+
+    record = model.TaskRecord.from_task(task)
+    with pytest.raises(model.ConflictError):
+        record.load()
+
+    # nothing left to archive
+    assert archive.compact(index) == (0, [])
+    assert len(list(archive.walk())) == 1
+    assert not list(archive.walk(predicate=lambda fields: False))
+
+    # a file that reappears is only archived again if it differs
+    for content, archived in ((raw, 1), (raw.replace(b'done', b'redo'), 2)):
+        done.write_binary(content)
+        list(model.walk_calendars(str(tasks_dir), index=index))
+        assert archive.compact(index) == (1, [])
+        assert not done.check()
+        assert len(list(archive.walk())) == archived
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+'''
+    watdo.tests.test_benchmarks
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright: (c) 2014 Markus Unterwaditzer
+    :license: MIT, see LICENSE for more details.
+'''
+
+from benchmarks.run import run_benchmark
+from benchmarks.vdir import generate_vdir
+import watdo.model as model
+
+
+def test_generate_vdir_reproducible(tmpdir):
+    a, b = tmpdir.mkdir('a'), tmpdir.mkdir('b')
+    generate_vdir(str(a), tasks=50, calendars=3, malformed_ratio=0.1)
+    generate_vdir(str(b), tasks=50, calendars=3, malformed_ratio=0.1)
+    files_a = sorted(a.visit('*.ics'))
+    assert len(files_a) == 50
+    assert [f.read_binary() for f in files_a] == \
+        [f.read_binary() for f in sorted(b.visit('*.ics'))]
+
+    tasks = list(model.walk_calendars(str(a)))
+    assert 30 < len(tasks) < 50
+
+
+def test_run_benchmark(tmpdir):
+    results = run_benchmark(str(tmpdir), 200, calendars=2)
+    assert [x['phase'] for x in results] == [
+        'walk_calendars', 'walk_calendars_indexed', 'walk_calendars_query',
+        'generate_tmpfile_limit', 'generate_tmpfile', 'parse_tmpfile',
+        'diff_calendars', 'make_changes'
+    ]
+    assert all(x['tasks'] == 200 for x in results)
+    assert results[-1]['errors'] == 0
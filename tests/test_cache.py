@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+'''
+    watdo.tests.test_cache
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright: (c) 2014 Markus Unterwaditzer
+    :license: MIT, see LICENSE for more details.
+'''
+
+import datetime
+
+from watdo.cache import TaskIndex
+import watdo.model as model
+Task = model.Task
+
+
+def _make_vdir(tmpdir):
+    tasks = [
+        Task(summary='task1', calendar='cal1',
+             due=datetime.date(2014, 9, 9)),
+        Task(summary='task2', calendar='cal1', description='lel'),
+        Task(summary='task3', calendar='cal2', status='COMPLETED')
+    ]
+    tmpdir.mkdir('cal1')
+    tmpdir.mkdir('cal2')
+    for task in tasks:
+        task.basepath = str(tmpdir)
+        task.write(create=True)
+    return tasks
+
+
+def test_index_roundtrip(tmpdir):
+    tasks = _make_vdir(tmpdir.mkdir('tasks'))
+    index_path = str(tmpdir.join('cache', 'index.json'))
+
+    index = TaskIndex.load(index_path)
+    list(model.walk_calendars(str(tmpdir.join('tasks')), index=index))
+    assert index.changed
+    index.save()
+
+    index = TaskIndex.load(index_path)
+    rv = list(model.walk_calendars(str(tmpdir.join('tasks')), index=index))
+    assert sorted(rv, key=lambda x: x.summary) == tasks
+    assert not index.changed
+
+
+def test_index_refresh(tmpdir, monkeypatch):
+    tasks = _make_vdir(tmpdir.mkdir('tasks'))
+    index = TaskIndex()
+    list(model.walk_calendars(str(tmpdir.join('tasks')), index=index))
+
+    scanned = []
+    scan_vtodo = model.scan_vtodo
+
+    def counting_scan_vtodo(raw):
+        rv = scan_vtodo(raw)
+        scanned.append(rv['summary'])
+        return rv
+    monkeypatch.setattr(model, 'scan_vtodo', counting_scan_vtodo)
+
+    changed, removed = tasks[0], tasks[1]
+    changed.summary = 'task1 changed'
+    changed.write()
+    tmpdir.join('tasks', 'cal1', removed.filename).remove()
+
+    rv = {t.summary: t for t in
+          model.walk_calendars(str(tmpdir.join('tasks')), index=index)}
+    assert set(rv) == set(['task1 changed', 'task3'])
+    assert scanned == ['task1 changed']
+    assert rv['task3'].done
+    assert removed.filename not in index.get_calendar(
+        str(tmpdir.join('tasks', 'cal1')))
+
+
+def test_lazy_task_loading(tmpdir):
+    tasks = _make_vdir(tmpdir.mkdir('tasks'))
+    index = TaskIndex()
+    list(model.walk_calendars(str(tmpdir.join('tasks')), index=index))
+    task, = (t for t in model.walk_calendars(str(tmpdir.join('tasks')),
+                                             index=index)
+             if t.summary == 'task1')
+    assert task._vcal is None
+    assert task.due == datetime.date(2014, 9, 9)
+
+    task.summary = 'task1 modified'
+    assert task._fields is None
+    assert task.due == datetime.date(2014, 9, 9)
+    task.write()
+
+    with open(tasks[0].filepath, 'rb') as f:
+        assert b'SUMMARY:task1 modified' in f.read()
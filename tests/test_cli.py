@@ -7,10 +7,30 @@
     :license: MIT, see LICENSE for more details.
 '''
 
+import datetime
+import json
+import subprocess
+import sys
+import timeit
+
 from click.testing import CliRunner
 
 import watdo.cli as cli
 
+#: seconds ``watdo --help`` may take, including interpreter startup
+HELP_TIME_BUDGET = 1.0
+
+_help_script = '''
+import sys
+sys.argv = ['watdo', '--help']
+import watdo.cli
+try:
+    watdo.cli.main()
+except SystemExit:
+    pass
+sys.stderr.write(' '.join(sys.modules))
+'''
+
 
 def test_basic_run(tmpdir):
     tasks_dir = tmpdir.mkdir('tasks')
@@ -46,3 +66,289 @@ def test_basic_run(tmpdir):
             'Please create the directory {} yourself.'
             .format(str(tasks_dir.join('wrongcalendar')))) \
         in result.output.splitlines()
+
+
+def test_profile(tmpdir, tasks_dir, config):
+    default_cal = tasks_dir.mkdir('default')
+    env = config(confirmation=False)
+    profile = tmpdir.join('profile.json')
+
+    runner = CliRunner()
+    for summary in ('task 1', 'task 2'):
+        env['EDITOR'] = 'echo "{} @default" >> '.format(summary)
+        result = runner.invoke(cli.main, ['--profile', str(profile)],
+                               env=env, catch_exceptions=False)
+        assert not result.exception
+
+    assert len(default_cal.listdir()) == 2
+    report = json.loads(profile.read())
+    # the file written by the first run isn't in the index yet
+    assert report['counters'] == {
+        'files_scanned': 1,
+        'cache_hits': 0,
+        'bytes_read': default_cal.listdir()[0].size(),
+        'tasks_emitted': 1,
+        'changes_applied': 1,
+        'files_written': 1
+    }
+    assert set(report['timings']) >= \
+        set(['generate_tmpfile', 'editor', 'parse_tmpfile', 'make_changes'])
+
+
+def test_list(tasks_dir, config):
+    tasks_dir.mkdir('default')
+    tasks_dir.mkdir('work')
+    env = dict(config(), EDITOR='')
+
+    runner = CliRunner()
+    for summary in ('x 2014-09-01 old @default', 'later due:2014-10-02 @work',
+                    'sooner due:2014-10-01 @default'):
+        result = runner.invoke(cli.main, ['new', summary], env=env,
+                               catch_exceptions=False)
+        assert not result.exception
+
+    result = runner.invoke(cli.main, ['list', '--sort'], env=env,
+                           catch_exceptions=False)
+    assert not result.exception
+    assert result.output.splitlines() == [
+        'sooner due:2014-10-01 @default',
+        'later due:2014-10-02 @work'
+    ]
+
+    result = runner.invoke(cli.main, ['--all', '-c', 'default', 'export',
+                                      '--format', 'json'],
+                           env=env, catch_exceptions=False)
+    tasks = sorted((json.loads(line) for line in result.output.splitlines()),
+                   key=lambda x: x['summary'])
+    assert [(x['summary'], x['status'], x['due'], x['done_date'])
+            for x in tasks] == [
+        ('old', 'COMPLETED', None, '2014-09-01'),
+        ('sooner', 'NEEDS-ACTION', '2014-10-01', None)
+    ]
+
+
+def test_search(tmpdir, tasks_dir, config):
+    cal = tasks_dir.mkdir('default')
+    env = dict(config(confirmation=False), EDITOR='')
+
+    runner = CliRunner()
+    for summary in ('Pay invoice due:2014-10-02 @default',
+                    'Invoice the invoice due:2014-10-01 @default',
+                    'Call mom @default'):
+        runner.invoke(cli.main, ['new', summary], env=env,
+                      catch_exceptions=False)
+
+    result = runner.invoke(cli.main, ['search', 'invoice'], env=env,
+                           catch_exceptions=False)
+    assert result.output.splitlines() == [
+        'Invoice the invoice due:2014-10-01 @default',
+        'Pay invoice due:2014-10-02 @default'
+    ]
+    assert tmpdir.join('tmp', 'cache', 'search.json').check()
+
+    result = runner.invoke(cli.main, ['-n', '1', 'search', 'invoice',
+                                      '--sort', 'due'],
+                           env=env, catch_exceptions=False)
+    assert result.output.splitlines() == [
+        'Invoice the invoice due:2014-10-01 @default'
+    ]
+
+    env['EDITOR'] = 'sed -i -e s/@default/@default\\ done/'
+    result = runner.invoke(cli.main, ['search', '--edit', 'pay'], env=env,
+                           catch_exceptions=False)
+    assert not result.exception
+    assert sorted(x.read().split('SUMMARY:')[1].splitlines()[0]
+                  for x in cal.listdir()) == \
+        ['Call mom', 'Invoice the invoice', 'Pay invoice done']
+
+
+def test_import(tmpdir, tasks_dir, config):
+    tasks_dir.mkdir('default')
+    source = tmpdir.join('todo.txt')
+    source.write('Task 1\nTask 2 due:2014-10-01\n')
+    env = config()
+
+    runner = CliRunner()
+    for _ in range(2):
+        result = runner.invoke(cli.main, ['-c', 'default', 'import',
+                                          str(source)],
+                               env=env, catch_exceptions=False)
+        assert not result.exception
+    assert 'Imported 0 tasks, skipped 2.' in result.output
+
+    result = runner.invoke(cli.main, ['list', '--sort'], env=env,
+                           catch_exceptions=False)
+    assert result.output.splitlines() == [
+        'Task 2 due:2014-10-01 @default',
+        'Task 1 @default'
+    ]
+
+
+def test_archive(tmpdir, tasks_dir, config):
+    tasks_dir.mkdir('default')
+    env = config(archivepath=str(tmpdir.join('archive')))
+
+    runner = CliRunner()
+    for summary in ('Pay invoice', 'x 2014-10-01 Old invoice',
+                    'x 2099-01-01 Future invoice'):
+        summary += ' @default'
+        result = runner.invoke(cli.main, ['new', summary], env=env,
+                               catch_exceptions=False)
+        assert not result.exception
+
+    result = runner.invoke(cli.main, ['archive', '--older-than', '30'],
+                           env=env, catch_exceptions=False)
+    assert result.output == 'Archived 1 tasks.\n'
+    assert len(tasks_dir.join('default').listdir()) == 2
+
+    result = runner.invoke(cli.main, ['--all', 'list'], env=env,
+                           catch_exceptions=False)
+    assert sorted(result.output.splitlines()) == [
+        'Pay invoice @default',
+        'x 2014-10-01 Old invoice @default',
+        'x 2099-01-01 Future invoice @default',
+    ]
+    result = runner.invoke(cli.main, ['list'], env=env,
+                           catch_exceptions=False)
+    assert 'Old invoice' not in result.output
+    result = runner.invoke(cli.main, ['--all', 'search', 'invoice'],
+                           env=env, catch_exceptions=False)
+    assert result.output.splitlines()[-1] == \
+        'x 2014-10-01 Old invoice @default'
+    result = runner.invoke(cli.main, ['--all', 'search', '!!!'],
+                           env=env, catch_exceptions=False)
+    assert not result.output
+
+    # archive_after archives done tasks on every run
+    env['WATDO_ARCHIVE_AFTER'] = '0'
+    result = runner.invoke(cli.main, ['list'], env=env,
+                           catch_exceptions=False)
+    assert result.output == 'Pay invoice @default\n'
+    assert len(tasks_dir.join('default').listdir()) == 1
+
+
+def test_doctor(tmpdir, tasks_dir, config):
+    tasks_dir.mkdir('default').join('broken.ics').write('BEGIN:VCALENDAR\n')
+    env = dict(config(), WATDO_CACHEPATH=str(tmpdir.join('cache')))
+
+    runner = CliRunner()
+    result = runner.invoke(cli.main, ['list'], env=env,
+                           catch_exceptions=False)
+    assert 'broken.ics' in result.output
+    result = runner.invoke(cli.main, ['list'], env=env,
+                           catch_exceptions=False)
+    assert not result.output
+
+    moved = tmpdir.join('broken')
+    result = runner.invoke(cli.main, ['doctor', '--move-to', str(moved)],
+                           env=env, catch_exceptions=False)
+    assert not result.exception
+    assert 'default/broken.ics: ' in result.output
+    assert not tasks_dir.join('default').listdir()
+    assert moved.join('default', 'broken.ics').check()
+
+    result = runner.invoke(cli.main, ['doctor'], env=env,
+                           catch_exceptions=False)
+    assert result.output == 'No broken files found.\n'
+
+
+def test_sqlite_storage(tmpdir, tasks_dir, config):
+    env = config(storage='sqlite',
+                 database=str(tmpdir.join('tasks.sqlite3')))
+
+    runner = CliRunner()
+    for summary in ('Task 1 @default', 'x Task 2 @default'):
+        result = runner.invoke(cli.main, ['new', summary], env=env,
+                               catch_exceptions=False)
+        assert not result.exception
+    assert not tasks_dir.listdir()
+
+    result = runner.invoke(cli.main, ['list'], env=env,
+                           catch_exceptions=False)
+    assert result.output == 'Task 1 @default\n'
+
+    result = runner.invoke(cli.main, ['db', 'export-vdir'], env=env,
+                           catch_exceptions=False)
+    assert not result.exception
+    assert len(tasks_dir.join('default').listdir()) == 2
+
+    result = runner.invoke(cli.main, ['search', 'task'], env=env)
+    assert 'only works with tasks stored in the vdir' in result.output
+
+
+def test_set(tasks_dir, config):
+    tasks_dir.mkdir('default')
+    tasks_dir.mkdir('work')
+    env = config()
+
+    runner = CliRunner()
+    for summary in ('Pay invoice due:2014-10-01', 'Write invoice',
+                    'Call mom due:2014-10-01'):
+        result = runner.invoke(cli.main, ['new', summary + ' @default'],
+                               env=env, catch_exceptions=False)
+        assert not result.exception
+
+    # tasks are moved while later calendars are still to be read
+    args = ['-q', 'invoice', 'set', '--due', '2014-11-01', '--move-to',
+            'work', '--batch-size', '1']
+    result = runner.invoke(cli.main, args + ['--dry-run'], env=env,
+                           catch_exceptions=False)
+    assert result.output.splitlines()[-1] == \
+        'Would change 2 tasks, 0 unchanged, 0 conflicts, 0 errors.'
+    assert len(tasks_dir.join('default').listdir()) == 3
+
+    for expected in ('Changed 2 tasks, 0 unchanged',
+                     'Changed 0 tasks, 2 unchanged'):
+        result = runner.invoke(cli.main, args, env=env,
+                               catch_exceptions=False)
+        assert result.output.startswith(expected)
+
+    result = runner.invoke(cli.main, ['-q', 'due<2014-10-02', 'set',
+                                      '--status', 'x'],
+                           env=env, catch_exceptions=False)
+    assert result.output.startswith('Changed 1 tasks')
+
+    result = runner.invoke(cli.main, ['--all', 'list'], env=env,
+                           catch_exceptions=False)
+    lines = sorted(result.output.splitlines())
+    assert lines[:2] == [
+        'Pay invoice due:2014-11-01 @work',
+        'Write invoice due:2014-11-01 @work',
+    ]
+    # tasks that are set to done are marked as done now
+    assert lines[2].startswith(datetime.date.today().strftime('x %Y-%m-%d/'))
+    assert lines[2].endswith(' Call mom due:2014-10-01 @default')
+
+    result = runner.invoke(cli.main, ['set'], env=env)
+    assert 'Nothing to change' in result.output
+    result = runner.invoke(cli.main, ['set', '--status', 'x'], env=env)
+    assert 'No tasks selected' in result.output
+    result = runner.invoke(cli.main, ['--all', 'set', '--select-all',
+                                      '--move-to', 'default'],
+                           env=env, catch_exceptions=False)
+    assert result.output.startswith('Changed 2 tasks, 1 unchanged')
+
+    # pending tasks have no status, so setting it again changes nothing
+    args = ['--all', '-c', 'default', 'set', '--status', 'NEEDS-ACTION']
+    result = runner.invoke(cli.main, args, env=env, catch_exceptions=False)
+    assert result.output.startswith('Changed 1 tasks, 2 unchanged')
+    raw = [x.read_binary() for x in tasks_dir.join('default').listdir()]
+    result = runner.invoke(cli.main, args, env=env, catch_exceptions=False)
+    assert result.output.startswith('Changed 0 tasks, 3 unchanged')
+    assert [x.read_binary() for x in tasks_dir.join('default').listdir()] \
+        == raw
+
+
+def test_help_cold_start():
+    start = timeit.default_timer()
+    proc = subprocess.Popen([sys.executable, '-c', _help_script],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = proc.communicate()
+    duration = timeit.default_timer() - start
+
+    assert proc.returncode == 0
+    assert b'Usage:' in stdout
+    modules = set(stderr.decode('utf-8').split())
+    for heavy in ('icalendar', 'atomicwrites', 'multiprocessing'):
+        assert heavy not in modules
+    assert duration < HELP_TIME_BUDGET
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+'''
+    watdo.tests.test_daemon
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright: (c) 2014 Markus Unterwaditzer
+    :license: MIT, see LICENSE for more details.
+'''
+
+import os
+import socket
+import stat
+import threading
+
+import pytest
+
+from watdo import daemon
+from watdo.cli import read_tasks
+from watdo.exceptions import CliError
+from watdo.query import Query
+import watdo.model as model
+Task = model.Task
+
+
+@pytest.fixture(params=['inotify', 'polling'])
+def server(request, tmpdir, monkeypatch):
+    if request.param == 'polling':
+        monkeypatch.setattr(daemon.Inotify, 'create', lambda: None)
+    tasks_dir = tmpdir.mkdir('tasks')
+    tasks_dir.mkdir('cal1')
+    tasks_dir.mkdir('cal2')
+    d = daemon.Daemon(str(tasks_dir), str(tmpdir.join('daemon.sock')))
+    t = threading.Thread(target=d.serve_forever, kwargs={'timeout': 0.05})
+    t.start()
+
+    def stop():
+        d.stop()
+        t.join()
+    request.addfinalizer(stop)
+
+    client = daemon.Client(d.sockpath)
+    while not client.ping():
+        pass
+    return d
+
+
+def test_list_and_apply(server):
+    client = daemon.Client(server.sockpath)
+    assert client.ping()
+    assert list(client.walk_calendars()) == []
+
+    Task(summary='task 1', calendar='cal1',
+         basepath=server.path).write(create=True)
+    Task(summary='task 2', calendar='cal2', status='COMPLETED',
+         basepath=server.path).write(create=True)
+
+    tasks = list(client.walk_calendars())
+    assert [t.summary for t in tasks] == ['task 1', 'task 2']
+    assert [t.summary for t in client.walk_calendars(pending=True)] == \
+        ['task 1']
+    assert [t.summary for t in client.walk_calendars(calendars=['cal2'])] \
+        == ['task 2']
+    assert [t.summary for t in client.walk_calendars(query=u'status:x')] \
+        == ['task 2']
+    assert [t.summary for t in client.walk_calendars(query=u'task @cal1')] \
+        == ['task 1']
+
+    batch = client.batch()
+    task = Task(filepath=tasks[0].filepath, vcal=open(tasks[0].filepath,
+                                                      'rb').read())
+    task.summary = 'task 1 modified'
+    task.write(batch=batch)
+    batch.remove(tasks[1].filepath)
+    new = Task(summary='task 3', calendar='cal2', basepath=server.path)
+    new.write(create=True, batch=batch)
+    assert batch.commit() == []
+
+    assert [t.summary for t in client.walk_calendars()] == \
+        ['task 1 modified', 'task 3']
+    assert sorted(t.summary for t in model.walk_calendars(server.path)) == \
+        ['task 1 modified', 'task 3']
+
+
+def test_new_calendar(server, tmpdir):
+    client = daemon.Client(server.sockpath)
+    assert list(client.walk_calendars()) == []
+    tmpdir.join('tasks').mkdir('cal3')
+    Task(summary='task', calendar='cal3',
+         basepath=server.path).write(create=True)
+    assert [t.calendar for t in client.walk_calendars()] == ['cal3']
+
+
+def test_apply_outside_vdir(server, tmpdir):
+    client = daemon.Client(server.sockpath)
+    assert stat.S_IMODE(os.stat(server.sockpath).st_mode) == 0o600
+    outside = tmpdir.mkdir('outside')
+    tasks_dir = tmpdir.join('tasks')
+    tasks_dir.join('cal2', 'link').mksymlinkto(outside)
+    for filepath in (outside.join('evil.ics'),
+                     tasks_dir.join('cal1', '..', '..', 'evil.ics'),
+                     tasks_dir.join('cal2', 'link', 'evil.ics'),
+                     tasks_dir.join('cal1', 'evil.txt'),
+                     tasks_dir.join('evil.ics')):
+        with pytest.raises(CliError):
+            client.request(cmd='apply', writes=[{'filepath': str(filepath),
+                                                 'data': u'', 'create': True}])
+        with pytest.raises(CliError):
+            client.request(cmd='apply', removals=[str(filepath)])
+    assert not outside.listdir()
+    assert not tmpdir.join('evil.ics').check()
+    assert not tasks_dir.join('cal1').listdir()
+
+
+def test_unresponsive_daemon(tmpdir, capsys):
+    tasks_dir = tmpdir.mkdir('tasks')
+    tasks_dir.mkdir('cal')
+    Task(summary='task', calendar='cal',
+         basepath=str(tasks_dir)).write(create=True)
+    # a daemon that accepts connections but never answers
+    sockpath = str(tmpdir.join('daemon.sock'))
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(sockpath)
+    sock.listen(1)
+    try:
+        client = daemon.Client(sockpath, timeout=0.1)
+        assert not client.ping()
+        with pytest.raises(daemon.DaemonUnavailable):
+            client.walk_calendars()
+
+        cfg = {'path': str(tasks_dir), 'cachepath': str(tmpdir)}
+        with read_tasks(cfg, Query(), client) as tasks:
+            assert [t.summary for t in tasks] == ['task']
+        assert 'Reading tasks from disk instead' in capsys.readouterr().out
+    finally:
+        sock.close()
+
+
+def test_stalled_client(server, monkeypatch):
+    monkeypatch.setattr(daemon, 'REQUEST_TIMEOUT', 0.1)
+    stalled = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        stalled.connect(server.sockpath)
+        assert daemon.Client(server.sockpath).ping()
+    finally:
+        stalled.close()
+
+
+def test_connect(tmpdir):
+    cfg = {'cachepath': str(tmpdir)}
+    assert daemon.connect(cfg) is None
+    tmpdir.join('daemon.sock').write('')
+    assert daemon.connect(cfg) is None
@@ -8,6 +8,7 @@
 '''
 
 import datetime
+import os
 
 import pytest
 
@@ -18,7 +19,9 @@ except ImportError:
 
 from watdo._compat import to_bytes
 import watdo.editor as editor
-from watdo.model import ParsingError, Task
+import watdo.model as model
+from watdo.model import ParsingError, Task, TaskRecord
+from watdo.storage import VdirStorage
 
 
 def test_basic():
@@ -103,6 +106,30 @@ def test_missing_calendar():
         editor.parse_tmpfile(['ASDASDASDASDAD'])
 
 
+def test_parse_summary_header():
+    task_id, task = editor.parse_summary_header(
+        u'x 2014-09-08 Do due:never this due:2014-09-09 id:3 @cal @other '
+        u'id:4 due:2014-09-10')
+    assert task_id == 3
+    assert task.status == u'COMPLETED'
+    assert task.done_date == datetime.date(2014, 9, 8)
+    assert task.due == datetime.date(2014, 9, 9)
+    assert task.calendar == u'cal'
+    assert task.summary == u'Do due:never this @other id:4 due:2014-09-10'
+
+    task_id, task = editor.parse_summary_header(u'2014-09-08 task @cal')
+    assert task_id == u'2014-09-08 task @cal'
+    assert task.done_date is None
+    assert task.summary == u'2014-09-08 task'
+
+    task_id, task = editor.parse_summary_header(u'buy milk @work id:abc')
+    assert task_id == u'buy milk @work id:abc'
+    assert task.summary == u'buy milk id:abc'
+
+    with pytest.raises(ParsingError):
+        editor.parse_summary_header(u'x')
+
+
 def test_descriptions():
     calendars = [
         Task(
@@ -117,3 +144,180 @@ def test_descriptions():
 
     new_ids = editor.parse_tmpfile(f.getvalue().splitlines())
     assert old_ids == new_ids
+
+
+def test_fingerprints(monkeypatch):
+    f = BytesIO()
+    old_ids = editor.generate_tmpfile(f, [
+        Task(summary=u'Hello World', description=u'a\n\nb\n',
+             calendar='test_cal', due=datetime.date(2014, 9, 9)),
+        Task(summary=u'Done', calendar='test_cal', status=u'COMPLETED',
+             done_date=datetime.date(2014, 9, 8)),
+        Task(summary=u'Other', calendar='test_cal')
+    ])
+    lines = f.getvalue().splitlines()
+    lines[-1] = lines[-1].replace(b'Other', b'Changed')
+    new_ids = editor.parse_tmpfile(lines)
+
+    assert old_ids[1].fingerprint == new_ids[1].fingerprint
+    assert old_ids[2].fingerprint == new_ids[2].fingerprint
+    assert old_ids[3].fingerprint != new_ids[3].fingerprint
+
+    compared = []
+
+    def __eq__(self, other):
+        compared.append(self.summary)
+        return False
+    monkeypatch.setattr(TaskRecord, '__eq__', __eq__)
+    assert list(editor.diff_calendars(old_ids, new_ids)) == [('mod', 3)]
+    assert compared == [u'Other']
+
+
+def test_limit():
+    tasks = [Task(summary=u'task {}'.format(i), calendar='test_cal',
+                  due=datetime.date(2014, 9, 30 - i))
+             for i in range(10)]
+    tasks.append(Task(summary=u'no due date', calendar='test_cal'))
+
+    f = BytesIO()
+    old_ids = editor.generate_tmpfile(f, iter(tasks), limit=3, offset=3)
+    lines = f.getvalue().splitlines()
+    assert [old_ids[i].summary for i in sorted(old_ids)] == \
+        [u'task 6', u'task 5', u'task 4']
+
+    # tasks outside of the window are not deleted
+    del lines[2]
+    new_ids = editor.parse_tmpfile(lines)
+    assert list(editor.diff_calendars(old_ids, new_ids)) == [('del', 2)]
+
+    selected = editor.select_by_deadline(tasks, limit=5, offset=9)
+    assert [t.summary for t in selected] == [u'task 0', u'no due date']
+
+
+def test_changes_on_disk(tmpdir):
+    tmpdir.mkdir('test_cal')
+    for summary in (u'task 1', u'task 2'):
+        Task(summary=summary, calendar=u'test_cal',
+             basepath=str(tmpdir)).write(create=True)
+
+    f = BytesIO()
+    old_ids = editor.generate_tmpfile(f, model.walk_calendars(str(tmpdir)))
+    assert all(isinstance(x, TaskRecord) for x in old_ids.values())
+    assert not hasattr(old_ids[1], '__dict__')
+
+    lines = [line for line in f.getvalue().splitlines()
+             if not line.startswith(b'task 2')]
+    lines = [line.replace(b'task 1', b'task 1 modified') for line in lines]
+    lines.append(b'task 3 @test_cal')
+    new_ids = editor.parse_tmpfile(lines)
+
+    changes = list(editor.get_changes(old_ids, new_ids))
+    assert len(changes) == 3
+    for description, func in changes:
+        func({'path': str(tmpdir)})
+
+    assert sorted(t.summary for t in model.walk_calendars(str(tmpdir))) == \
+        [u'task 1 modified', u'task 3']
+
+
+def test_move_calendar(tmpdir):
+    tmpdir.mkdir('cal1')
+    tmpdir.mkdir('cal2')
+    Task(summary=u'task', calendar=u'cal1',
+         basepath=str(tmpdir)).write(create=True)
+    raw = tmpdir.join('cal1').listdir()[0].read_binary()
+
+    f = BytesIO()
+    old_ids = editor.generate_tmpfile(f, model.walk_calendars(str(tmpdir)))
+    lines = f.getvalue().replace(b'@cal1', b'@cal2').splitlines()
+    changes = list(editor.get_changes(old_ids, editor.parse_tmpfile(lines)))
+    assert len(changes) == 1
+    batch = model.WriteBatch()
+    for description, func in changes:
+        func({'path': str(tmpdir)}, batch)
+    assert batch.commit() == []
+
+    assert not tmpdir.join('cal1').listdir()
+    moved, = tmpdir.join('cal2').listdir()
+    assert moved.read_binary() == raw
+
+
+def test_conflicts(tmpdir):
+    tmpdir.mkdir('cal')
+    for summary in (u'changed', u'removed', u'untouched'):
+        Task(summary=summary, calendar=u'cal',
+             basepath=str(tmpdir)).write(create=True)
+
+    f = BytesIO()
+    old_ids = editor.generate_tmpfile(f, model.walk_calendars(str(tmpdir)))
+    tasks = dict((task.summary, task) for task in old_ids.values())
+
+    # another program modifies and removes tasks while the editor is open
+    other = tasks[u'changed'].load()
+    other.summary = u'changed elsewhere'
+    other.write()
+    os.remove(tasks[u'removed'].filepath)
+
+    lines = [line.replace(b'changed', b'mine').replace(b'removed', b'mine')
+             .replace(b'untouched', b'ok')
+             for line in f.getvalue().splitlines()]
+    changes = list(editor.get_changes(old_ids, editor.parse_tmpfile(lines)))
+    assert len(changes) == 3
+    batch = model.WriteBatch()
+    conflicts = []
+    for description, func in changes:
+        try:
+            func({'path': str(tmpdir)}, batch)
+        except model.ConflictError as e:
+            conflicts.append(str(e))
+    assert batch.commit() == []
+    assert len(conflicts) == 2
+
+    summaries = sorted(t.summary for t in model.walk_calendars(str(tmpdir)))
+    assert summaries == [u'changed elsewhere', u'ok']
+
+    task = tasks[u'removed']
+    with pytest.raises(model.ConflictError):
+        editor._change_delete(task)({'path': str(tmpdir)})
+
+
+def test_locators(tmpdir):
+    tmpdir.mkdir('cal')
+    for summary in (u'keep', u'change', u'delete'):
+        Task(summary=summary, calendar=u'cal',
+             basepath=str(tmpdir)).write(create=True)
+
+    f = BytesIO()
+    old_ids = editor.generate_tmpfile(f, model.walk_calendars(str(tmpdir)),
+                                      locators=True)
+    assert not any(isinstance(x, TaskRecord) for x in old_ids.values())
+
+    lines = [line.replace(b'change', b'changed')
+             for line in f.getvalue().splitlines()
+             if not line.startswith(b'delete')]
+    new_ids = editor.parse_tmpfile(lines)
+    read = VdirStorage(str(tmpdir)).read
+    editor.load_records(old_ids, new_ids, read)
+    records = [x for x in old_ids.values() if isinstance(x, TaskRecord)]
+    assert sorted(x.summary for x in records) == [u'change', u'delete']
+
+    changes = list(editor.get_changes(old_ids, new_ids))
+    assert sorted(description for description, func in changes) == \
+        [u'Delete: delete', u'Modify: change => changed']
+    batch = model.WriteBatch()
+    for description, func in changes:
+        func({'path': str(tmpdir)}, batch)
+    assert batch.commit() == []
+    assert sorted(t.summary for t in model.walk_calendars(str(tmpdir))) == \
+        [u'changed', u'keep']
+
+
+def test_update_record():
+    record = TaskRecord(summary=u'task', status=u'COMPLETED',
+                        done_date=datetime.date(2014, 10, 1), calendar=u'a')
+    assert editor.update_record(record) == record
+    assert editor.update_record(record, calendar=u'b').calendar == u'b'
+
+    updated = editor.update_record(record, status=u'NEEDS-ACTION')
+    assert updated.done_date is None
+    assert record.done_date == datetime.date(2014, 10, 1)
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+'''
+    watdo.tests.test_importer
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright: (c) 2014 Markus Unterwaditzer
+    :license: MIT, see LICENSE for more details.
+'''
+
+import datetime
+
+import pytest
+
+from watdo.exceptions import CliError
+from watdo.importer import Importer
+import watdo.model as model
+
+TODO_TXT = u'''\
+x 2014-09-01 Pay rent @home
+(A) Call mom due:2014-10-01
+Write report +work @work
+    with a description
+Call mom due:2014-10-01
+Call mom due:2014-10-01
+'''.splitlines()
+
+
+def test_import(tmpdir):
+    tmpdir.mkdir('home')
+    tmpdir.mkdir('work')
+    progress = []
+    imp = Importer(str(tmpdir), calendar=u'home', batch_size=2,
+                   progress=lambda x: progress.append(x.imported))
+    imp.feed(TODO_TXT)
+    assert (imp.imported, imp.skipped, imp.errors) == (5, 0, [])
+    assert progress == [2, 4, 5]
+
+    tasks = sorted(model.walk_calendars(str(tmpdir)),
+                   key=lambda x: x.summary)
+    assert [(t.calendar, t.summary, t.status, t.due, t.done_date)
+            for t in tasks] == [
+        (u'home', u'(A) Call mom', u'', datetime.date(2014, 10, 1), None),
+        (u'home', u'Call mom', u'', datetime.date(2014, 10, 1), None),
+        (u'home', u'Call mom', u'', datetime.date(2014, 10, 1), None),
+        (u'home', u'Pay rent', u'COMPLETED', None, datetime.date(2014, 9, 1)),
+        (u'work', u'Write report +work', u'', None, None),
+    ]
+    assert tasks[-1].description == u'with a description'
+    assert all(t.filename == t.uid + u'.ics' for t in tasks)
+
+    # an interrupted import can be started again
+    imp = Importer(str(tmpdir), uids=[t.uid for t in tasks],
+                   calendar=u'home')
+    imp.feed(TODO_TXT + [u'New task'])
+    assert (imp.imported, imp.skipped) == (1, 5)
+    assert len(list(model.walk_calendars(str(tmpdir)))) == 6
+
+    # relative dates don't change the UID
+    for imported in (1, 0):
+        imp = Importer(str(tmpdir), uids=[t.uid for t in
+                                          model.walk_calendars(str(tmpdir))])
+        imp.feed([u'Call dad due:now @home'])
+        assert imp.imported == imported
+
+
+def test_import_errors(tmpdir):
+    tmpdir.mkdir('home')
+    imp = Importer(str(tmpdir))
+    with pytest.raises(model.ParsingError) as excinfo:
+        imp.feed([u'Task @home', u'No calendar', u'Other task @home'])
+    assert 'Line 2' in str(excinfo.value)
+    assert imp.imported == 1
+
+    with pytest.raises(CliError):
+        Importer(str(tmpdir)).feed([u'Task @missing'])
@@ -7,6 +7,14 @@
     :license: MIT, see LICENSE for more details.
 '''
 
+import datetime
+import os
+import sys
+
+import pytest
+
+from watdo.cache import TaskIndex
+from watdo.exceptions import CliError
 import watdo.model as model
 Task = model.Task
 
@@ -51,6 +59,43 @@ class TestTask(object):
         assert a.main['last-modified'].dt > old_date.dt
 
 
+class TestWriteBatch(object):
+    def test_commit(self, tmpdir):
+        tmpdir.mkdir('cal1')
+        tmpdir.mkdir('cal2')
+        existing = Task(summary='existing', calendar='cal1',
+                        basepath=str(tmpdir))
+        existing.write(create=True)
+
+        batch = model.WriteBatch()
+        tasks = [Task(summary='task {}'.format(i),
+                      calendar='cal{}'.format(i % 2 + 1),
+                      basepath=str(tmpdir)) for i in range(10)]
+        for task in tasks:
+            task.write(create=True, batch=batch)
+        duplicate = Task(summary='duplicate', calendar='cal1',
+                         basepath=str(tmpdir), filename=existing.filename)
+        duplicate.write(create=True, batch=batch)
+        batch.remove(existing.filepath)
+        assert len(batch) == 12
+        assert not tmpdir.join('cal2').listdir()
+
+        errors = batch.commit()
+        assert [filepath for filepath, e in errors] == [existing.filepath]
+        assert not len(batch)
+        rv = sorted(model.walk_calendars(str(tmpdir)),
+                    key=lambda x: x.summary)
+        assert rv == sorted(tasks, key=lambda x: x.summary)
+        assert not [f for f in tmpdir.join('cal1').listdir()
+                    if f.basename.startswith('.')]
+
+    def test_missing_calendar(self, tmpdir):
+        batch = model.WriteBatch()
+        with pytest.raises(CliError):
+            Task(summary='task', calendar='cal', basepath=str(tmpdir)) \
+                .write(create=True, batch=batch)
+
+
 class TestFileSystem(object):
     def test_walk_calendar(self, tmpdir):
         tasks = [
@@ -78,3 +123,269 @@ class TestFileSystem(object):
                     key=lambda x: x.summary)
 
         assert tasks == rv
+
+        rv = sorted(model.walk_calendars(str(tmpdir), calendars=['cal3'],
+                                         predicate=model.is_pending),
+                    key=lambda x: x.summary)
+        assert [t.summary for t in rv] == ['task3.1', 'task3.3']
+
+        index = TaskIndex()
+        rv = list(model.walk_calendars(str(tmpdir), index=index,
+                                       calendars=['cal1', 'nonexistent']))
+        assert set(t.calendar for t in rv) == set(['cal1'])
+        assert list(index.calendars) == [str(tmpdir.join('cal1'))]
+
+    def test_walk_skips_hidden_files(self, tmpdir):
+        cal = tmpdir.mkdir('cal')
+        t = Task(summary='task', calendar='cal', basepath=str(tmpdir))
+        t.write(create=True)
+        raw = cal.join(t.filename).read_binary()
+        cal.join('.tmp-sync.ics').write_binary(raw)
+        cal.join(t.filename + '.tmp').write_binary(raw)
+        cal.mkdir('dir.ics')
+        tmpdir.mkdir('.hidden_cal').join('task.ics').write_binary(raw)
+
+        task, = model.walk_calendars(str(tmpdir))
+        assert task.filepath == t.filepath
+        assert task.stat.st_size == len(raw)
+
+    def test_walk_calendars_parallel(self, tmpdir, capsys):
+        for calendar in ('cal1', 'cal2'):
+            tmpdir.mkdir(calendar)
+            for i in range(20):
+                Task(summary='task {} {}'.format(calendar, i),
+                     calendar=calendar,
+                     basepath=str(tmpdir)).write(create=True)
+        tmpdir.join('cal2', 'broken.ics').write('BEGIN:VCALENDAR\n')
+
+        serial = list(model.walk_calendars(str(tmpdir)))
+        assert 'broken.ics' in capsys.readouterr().out
+        parallel = list(model.walk_calendars(str(tmpdir), jobs=2))
+        assert 'broken.ics' in capsys.readouterr().out
+
+        assert len(parallel) == 40
+        assert [t.filepath for t in serial] == [t.filepath for t in parallel]
+        assert serial == parallel
+
+    def test_walk_calendars_parallel_cached(self, tmpdir, monkeypatch):
+        tmpdir.mkdir('cal')
+        Task(summary='task', calendar='cal', basepath=str(tmpdir)) \
+            .write(create=True)
+        index = TaskIndex()
+        assert len(list(model.walk_calendars(str(tmpdir), index=index))) == 1
+
+        # nothing to scan, so no processes are started
+        import multiprocessing
+        monkeypatch.setattr(multiprocessing, 'Pool', None)
+        task, = model.walk_calendars(str(tmpdir), index=index, jobs=2)
+        assert task.summary == 'task'
+
+    def test_quarantine(self, tmpdir, capsys, monkeypatch):
+        cal = tmpdir.mkdir('cal')
+        Task(summary='task', calendar='cal', basepath=str(tmpdir)) \
+            .write(create=True)
+        broken = cal.join('broken.ics')
+        broken.write('BEGIN:VCALENDAR\n')
+
+        index = TaskIndex()
+        assert len(list(model.walk_calendars(str(tmpdir), index=index))) == 1
+        assert 'broken.ics' in capsys.readouterr().out
+        assert [x[0] for x in index.quarantined_files()] == [str(broken)]
+
+        # known-bad files are neither read nor reported again
+        monkeypatch.setattr(model, '_scan_file', None)
+        assert len(list(model.walk_calendars(str(tmpdir), index=index))) == 1
+        assert not capsys.readouterr().out
+        monkeypatch.undo()
+
+        # but they are once they change
+        broken.write('BEGIN:VCALENDAR\nBEGIN:VTODO\nSUMMARY:fixed\n'
+                     'END:VTODO\nEND:VCALENDAR\n')
+        os.utime(str(broken), (0, 0))
+        assert len(list(model.walk_calendars(str(tmpdir), index=index))) == 2
+        assert not list(index.quarantined_files())
+
+
+class TestScanner(object):
+    def test_scan_vtodo(self):
+        raw = (b'BEGIN:VCALENDAR\r\n'
+               b'VERSION:2.0\r\n'
+               b'BEGIN:VTODO\r\n'
+               b'SUMMARY:Buy milk\\, eggs\r\n'
+               b'DESCRIPTION:First line\\nand a very long second line that '
+               b'was\r\n  folded\r\n'
+               b'DUE;TZID="Europe/Vienna":20140909T133700\r\n'
+               b'STATUS:IN-PROCESS\r\n'
+               b'BEGIN:VALARM\r\n'
+               b'DESCRIPTION:Not the task description\r\n'
+               b'END:VALARM\r\n'
+               b'END:VTODO\r\n'
+               b'END:VCALENDAR\r\n')
+        task = Task(_fields=model.scan_vtodo(raw))
+        assert task.summary == u'Buy milk, eggs'
+        assert task.description == (u'First line\nand a very long second '
+                                    u'line that was folded')
+        assert task.due == datetime.datetime(2014, 9, 9, 13, 37)
+        assert task.status == u'IN-PROCESS'
+        assert task.done_date is None
+
+    def test_scan_matches_icalendar(self):
+        t = Task(summary=u'Hello; World', description=u'a\nb\\c',
+                 due=datetime.date(2014, 9, 9), status=u'COMPLETED',
+                 done_date=datetime.datetime(2014, 9, 10, 12, 0))
+        scanned = Task(_fields=model.scan_vtodo(t.vcal.to_ical()))
+        assert scanned == t
+        assert scanned.done_date == t.done_date
+
+    @pytest.mark.parametrize('kwargs', [
+        dict(summary=u'Hello; World, ' * 6, description=u'a\nb\\c',
+             due=datetime.date(2014, 9, 9), status=u'COMPLETED',
+             done_date=datetime.datetime(2014, 9, 10, 12, 0)),
+        dict(summary=u'ü' * 40 + u'a' * 7, due=datetime.time(13, 37)),
+        dict(summary=u'a', due=datetime.datetime(2014, 9, 9, 13, 37)),
+    ])
+    def test_render_vtodo(self, kwargs):
+        t = Task(**kwargs)
+        t.main['uid'] = u'uid@watdo'
+        assert model.render_vtodo(u'uid@watdo', **kwargs) == t.vcal.to_ical()
+
+    def test_no_vtodo(self):
+        assert model.scan_vtodo(b'BEGIN:VCALENDAR\r\n'
+                                b'END:VCALENDAR\r\n') is None
+
+    @pytest.mark.parametrize('raw', [
+        b'BEGIN:VCALENDAR\r\nBEGIN:VTODO\r\nEND:VCALENDAR\r\n',
+        b'BEGIN:VCALENDAR\r\nBEGIN:VTODO\r\nEND:VTODO\r\n',
+        b'BEGIN:VCALENDAR\r\ngarbage\r\nEND:VCALENDAR\r\n',
+        b'BEGIN:VTODO\r\nDUE:tomorrow\r\nEND:VTODO\r\n',
+    ])
+    def test_broken_files(self, raw):
+        with pytest.raises(model.ParsingError):
+            model.scan_vtodo(raw)
+
+
+class TestPatch(object):
+    raw = (b'BEGIN:VCALENDAR\n'
+           b'VERSION:2.0\n'
+           b'PRODID:-//someone else//EN\n'
+           b'BEGIN:VTODO\n'
+           b'UID:patch-test\n'
+           b'X-UNKNOWN;FOO="a:b":keep me\n'
+           b'SUMMARY:A summary that is long enough to have been folded by '
+           b'the\n  other client\n'
+           b'DESCRIPTION:first\n'
+           b'DESCRIPTION:duplicate\n'
+           b'BEGIN:VALARM\n'
+           b'DESCRIPTION:alarm\n'
+           b'END:VALARM\n'
+           b'END:VTODO\n'
+           b'END:VCALENDAR\n')
+
+    def test_patch_vtodo(self):
+        rv = model.patch_vtodo(self.raw, {
+            b'SUMMARY': [b'SUMMARY:new'],
+            b'DESCRIPTION': [],
+            b'STATUS': [b'STATUS:COMPLETED'],
+        })
+        assert rv == (b'BEGIN:VCALENDAR\n'
+                      b'VERSION:2.0\n'
+                      b'PRODID:-//someone else//EN\n'
+                      b'BEGIN:VTODO\n'
+                      b'UID:patch-test\n'
+                      b'X-UNKNOWN;FOO="a:b":keep me\n'
+                      b'SUMMARY:new\n'
+                      b'STATUS:COMPLETED\n'
+                      b'BEGIN:VALARM\n'
+                      b'DESCRIPTION:alarm\n'
+                      b'END:VALARM\n'
+                      b'END:VTODO\n'
+                      b'END:VCALENDAR\n')
+
+        with pytest.raises(model.ParsingError):
+            model.patch_vtodo(b'BEGIN:VCALENDAR\nEND:VCALENDAR\n', {})
+
+    def test_write_changed_properties_only(self, tmpdir):
+        tmpdir.mkdir('cal')
+        filepath = str(tmpdir.join('cal', 'patch-test.ics'))
+        raw = self.raw.replace(b'DESCRIPTION:duplicate\n', b'')
+        with open(filepath, 'wb') as f:
+            f.write(raw)
+
+        task, = model.walk_calendars(str(tmpdir))
+        task.due = datetime.date(2014, 9, 9)
+        task.write()
+        with open(filepath, 'rb') as f:
+            assert f.read() == raw.replace(
+                b'BEGIN:VALARM', b'DUE;VALUE=DATE:20140909\nBEGIN:VALARM', 1)
+
+        task, = model.walk_calendars(str(tmpdir))
+        raw = task.serialize()[0]
+        assert task.serialize() == (raw, True)
+        assert not task.update(Task(summary=task.summary, due=task.due,
+                                    description=task.description + u'\n',
+                                    calendar=u'cal'))
+        assert task.serialize() == (raw, True)
+
+    def test_update_done_date(self, tmpdir, monkeypatch):
+        # pytz isn't a dependency
+        monkeypatch.setitem(sys.modules, 'pytz', None)
+        tmpdir.mkdir('cal')
+        filepath = str(tmpdir.join('cal', 'patch-test.ics'))
+        raw = self.raw.replace(b'DESCRIPTION:duplicate\n',
+                               b'STATUS:COMPLETED\n'
+                               b'COMPLETED:20141001T103045Z\n')
+        with open(filepath, 'wb') as f:
+            f.write(raw)
+
+        task, = model.walk_calendars(str(tmpdir))
+        done_date = task.done_date
+        assert done_date == model._to_local(
+            datetime.datetime(2014, 10, 1, 10, 30, 45))
+
+        # the editor shows the done date without seconds
+        edited = model.TaskRecord.from_task(task)
+        edited.summary = u'new'
+        edited.done_date = done_date.replace(second=0)
+        assert task.update(edited)
+        task.write()
+        with open(filepath, 'rb') as f:
+            assert b'COMPLETED:20141001T103045Z\n' in f.read()
+
+        task, = model.walk_calendars(str(tmpdir))
+        edited.done_date = datetime.datetime(2014, 10, 2, 12, 0)
+        assert task.update(edited)
+        task.write()
+        task, = model.walk_calendars(str(tmpdir))
+        assert task.done_date == edited.done_date
+        assert task._fields['completed'].endswith(u'Z')
+
+    def test_skip_and_rename(self, tmpdir):
+        tmpdir.mkdir('cal1')
+        tmpdir.mkdir('cal2')
+        Task(summary=u'task', calendar=u'cal1',
+             basepath=str(tmpdir)).write(create=True)
+        task, = model.walk_calendars(str(tmpdir))
+        raw = tmpdir.join('cal1', task.filename).read_binary()
+        st = task.stat
+
+        model.stats.enable()
+        try:
+            task.update(Task(summary=u'task', calendar=u'cal1'))
+            task.write()
+            # unchanged task in a batch
+            batch = model.WriteBatch()
+            task.write(batch=batch)
+            assert batch.commit() == []
+
+            assert not task.update(Task(summary=u'task', calendar=u'cal2'))
+            task.write(batch=batch)
+            assert batch.commit() == []
+            counters = model.stats.report()['counters']
+        finally:
+            model.stats.disable()
+
+        assert counters == {'writes_skipped': 2, 'files_renamed': 1}
+        assert not tmpdir.join('cal1').listdir()
+        moved = tmpdir.join('cal2', task.filename)
+        assert moved.read_binary() == raw
+        assert moved.stat().ino == st.st_ino
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+'''
+    watdo.tests.test_query
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright: (c) 2014 Markus Unterwaditzer
+    :license: MIT, see LICENSE for more details.
+'''
+
+import datetime
+import os
+
+import pytest
+
+from watdo.cache import TaskIndex
+from watdo.exceptions import CliError
+from watdo.query import FieldIndex, Query
+import watdo.model as model
+Task = model.Task
+
+
+def _fields(**kwargs):
+    rv = {'summary': u'', 'description': u''}
+    rv.update(kwargs)
+    return rv
+
+
+TASKS = {
+    'a.ics': _fields(summary=u'Pay invoice', due=u'20141030'),
+    'b.ics': _fields(summary=u'Write report', description=u'invoice too',
+                     due=u'20141101T120000', status=u'IN-PROCESS'),
+    'c.ics': _fields(summary=u'Old invoice', due=u'20141001',
+                     status=u'COMPLETED', completed=u'20141002T100000Z'),
+    'd.ics': _fields(summary=u'Someday'),
+}
+
+
+@pytest.mark.parametrize('text,pending,expected', [
+    (u'', False, 'abcd'),
+    (u'', True, 'abd'),
+    (u'invoice', True, 'ab'),
+    (u'text:INVOICE text:pay', False, 'a'),
+    (u'status:x', True, 'c'),
+    (u'status:IN-PROCESS status:completed', False, 'bc'),
+    (u'due<2014-11-01', False, 'ac'),
+    (u'due<=2014-11-01', False, 'abc'),
+    (u'due>2014-10-30', False, 'b'),
+    (u'due>=2014-10-30 due<2014-11-01/12:00', False, 'a'),
+    (u'due:2014-11-01', False, 'b'),
+    (u'due:2014-11-01/12:00 invoice', False, 'b'),
+    (u'due<2014-11-01 nothing', False, ''),
+])
+def test_query(text, pending, expected):
+    q = Query(text, pending=pending)
+    index = FieldIndex(dict((filename, [None, fields])
+                            for filename, fields in TASKS.items()))
+
+    matching = sorted(filename[0] for filename, fields in TASKS.items()
+                      if q(fields))
+    assert ''.join(matching) == expected
+
+    candidates = q.candidates(index)
+    if candidates is None:
+        candidates = TASKS
+    assert ''.join(sorted(x[0] for x in candidates)) == expected
+
+
+def test_query_calendars():
+    q = Query(u'@work invoice @home', calendars=['default'])
+    assert q.calendars == set(['work', 'home', 'default'])
+    assert q.words == set([u'invoice'])
+    assert Query(u'invoice').calendars is None
+
+
+@pytest.mark.parametrize('text', [u'status:unknown', u'due<soon'])
+def test_invalid_query(text):
+    with pytest.raises(CliError):
+        Query(text)
+
+
+def test_field_index_update():
+    old = {'a.ics': [1, TASKS['a.ics']], 'd.ics': [1, TASKS['d.ics']]}
+    new = {'a.ics': [2, TASKS['b.ics']], 'c.ics': [1, TASKS['c.ics']],
+           'd.ics': [1, TASKS['d.ics']]}
+    index = FieldIndex(old)
+    index.update(old, new)
+
+    expected = FieldIndex(new)
+    assert index.filenames == expected.filenames
+    assert index.statuses == expected.statuses
+    assert index.words == expected.words
+    assert index.due_between(None, None, None) == set(['a.ics', 'c.ics'])
+
+
+def test_walk_with_query(tmpdir):
+    tmpdir.mkdir('cal')
+    for summary, due in ((u'soon', datetime.date(2014, 10, 1)),
+                         (u'later', datetime.date(2014, 12, 1)),
+                         (u'never', None)):
+        Task(summary=summary, due=due, calendar=u'cal',
+             basepath=str(tmpdir)).write(create=True)
+
+    index = TaskIndex()
+    q = Query(u'due<2014-11-01')
+    for _ in range(2):
+        tasks = list(model.walk_calendars(str(tmpdir), index=index,
+                                          predicate=q))
+        assert [t.summary for t in tasks] == [u'soon']
+
+    # changed files are checked against the query too
+    later, = [t for t in model.walk_calendars(str(tmpdir))
+              if t.summary == u'later']
+    later.due = datetime.date(2014, 10, 2)
+    later.write()
+    os.utime(later.filepath, (0, 0))
+    tasks = list(model.walk_calendars(str(tmpdir), index=index,
+                                      predicate=q))
+    assert sorted(t.summary for t in tasks) == [u'later', u'soon']
+    assert index.field_index(str(tmpdir.join('cal'))).due_between(
+        None, None, None) == set(os.path.basename(t.filepath) for t in tasks)
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+'''
+    watdo.tests.test_search
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright: (c) 2014 Markus Unterwaditzer
+    :license: MIT, see LICENSE for more details.
+'''
+
+import os
+
+from watdo.cache import TaskIndex
+from watdo.search import SearchIndex, term_weights
+import watdo.model as model
+Task = model.Task
+
+
+def test_term_weights():
+    assert term_weights({'summary': u'Pay the invoice',
+                         'description': u'The invoice, really.'}) == {
+        u'pay': 3, u'the': 4, u'invoice': 4, u'really': 1
+    }
+
+
+def test_search(tmpdir):
+    tasks_dir = tmpdir.mkdir('tasks')
+    tasks_dir.mkdir('cal')
+    for summary, description in ((u'Pay invoice', u''),
+                                 (u'Write report', u'mention the invoice'),
+                                 (u'Call mom', u'')):
+        Task(summary=summary, description=description, calendar=u'cal',
+             basepath=str(tasks_dir)).write(create=True)
+
+    index = TaskIndex()
+    list(model.walk_calendars(str(tasks_dir), index=index))
+    search_path = str(tmpdir.join('search.json'))
+    search_index = SearchIndex.load(search_path)
+    search_index.update(index)
+    search_index.save()
+
+    def summaries(hits):
+        return [Task(filepath=filepath,
+                     vcal=open(filepath, 'rb').read()).summary
+                for score, filepath in hits]
+
+    search_index = SearchIndex.load(search_path)
+    assert summaries(search_index.search(u'invoice')) == \
+        [u'Pay invoice', u'Write report']
+    assert summaries(search_index.search(u'INVOICE report')) == \
+        [u'Write report']
+    assert search_index.search(u'invoice nothing') == []
+    assert search_index.search(u'') == []
+
+    # only changed tasks are tokenized again
+    search_index.update(index)
+    assert not search_index.changed
+
+    report, = [t for t in model.walk_calendars(str(tasks_dir))
+               if t.summary == u'Write report']
+    report.description = u''
+    report.write()
+    os.utime(report.filepath, (0, 0))
+    os.remove(search_index.search(u'mom')[0][1])
+    list(model.walk_calendars(str(tasks_dir), index=index))
+    search_index.update(index)
+    assert search_index.changed
+    assert summaries(search_index.search(u'invoice')) == [u'Pay invoice']
+    assert search_index.search(u'mom') == []
+    assert len(search_index.documents) == 2
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+'''
+    watdo.tests.test_storage
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright: (c) 2014 Markus Unterwaditzer
+    :license: MIT, see LICENSE for more details.
+'''
+
+import datetime
+
+import pytest
+
+from watdo.query import Query
+from watdo.storage import SQLiteStorage, VdirStorage
+import watdo.model as model
+Task = model.Task
+
+
+@pytest.fixture
+def db(tmpdir):
+    tasks_dir = tmpdir.mkdir('tasks')
+    rv = SQLiteStorage(str(tmpdir.join('tasks.sqlite3')), str(tasks_dir))
+    batch = rv.batch()
+    for summary, due, status in (
+            (u'soon', datetime.date(2014, 10, 1), u''),
+            (u'later', datetime.datetime(2014, 12, 1, 12, 0), u''),
+            (u'at noon', datetime.time(12, 0), u'IN-PROCESS'),
+            (u'done', None, u'COMPLETED')):
+        Task(summary=summary, due=due, status=status, calendar=u'cal',
+             basepath=str(tasks_dir)).write(create=True, batch=batch)
+    assert batch.commit() == []
+    return rv
+
+
+@pytest.mark.parametrize('text,pending,expected', [
+    (u'', False, [u'at noon', u'done', u'later', u'soon']),
+    (u'', True, [u'at noon', u'later', u'soon']),
+    (u'status:x', True, [u'done']),
+    (u'due<2014-11-01', False, [u'soon']),
+    (u'due<2015-01-01', False, [u'later', u'soon']),
+    (u'due>=2014-12-01/12:00', False, [u'at noon', u'later']),
+    (u'later', False, [u'later']),
+    (u'@other', False, []),
+])
+def test_walk(db, text, pending, expected):
+    q = Query(text, pending=pending)
+    tasks = db.walk(calendars=q.calendars, predicate=q)
+    assert sorted(t.summary for t in tasks) == expected
+
+
+def test_edit(db):
+    tasks = dict((t.summary, model.TaskRecord.from_task(t))
+                 for t in db.walk())
+    batch = db.batch()
+
+    task = batch.load(tasks[u'soon'])
+    task.summary = u'sooner'
+    task.write(batch=batch)
+    batch.check(tasks[u'done'])
+    batch.remove(tasks[u'done'].filepath)
+    assert batch.commit() == []
+    assert sorted(t.summary for t in db.walk()) == \
+        [u'at noon', u'later', u'sooner']
+
+    # the records are outdated now
+    with pytest.raises(model.ConflictError):
+        batch.load(tasks[u'soon'])
+    with pytest.raises(model.ConflictError):
+        batch.check(tasks[u'done'])
+
+
+def test_move(db):
+    task, = [t for t in db.walk() if t.summary == u'soon']
+    raw = db.load(task.filepath)[0]
+    task = db.batch().load(model.TaskRecord.from_task(task))
+    task.filepath = task.filepath.replace(u'/cal/', u'/other/')
+    batch = db.batch()
+    task.write(batch=batch)
+    assert batch.commit() == []
+
+    moved, = db.walk(calendars=[u'other'])
+    assert moved.summary == u'soon'
+    assert db.load(moved.filepath)[0] == raw
+    assert len(list(db.walk())) == 4
+
+
+def test_vdir_roundtrip(db, tmpdir):
+    tasks_dir = tmpdir.join('tasks')
+    tasks_dir.mkdir('cal')
+    assert db.export_vdir(str(tasks_dir)) == []
+    vdir = VdirStorage(str(tasks_dir))
+    assert sorted(t.summary for t in vdir.walk()) == \
+        sorted(t.summary for t in db.walk())
+
+    # nothing changed, nothing is written
+    assert db.export_vdir(str(tasks_dir)) == []
+    assert db.import_vdir(str(tasks_dir)) == []
+    assert [t.etag for t in db.walk()] == [[1]] * 4
+
+    # changes in the vdir are picked up
+    done, = [t for t in vdir.walk() if t.summary == u'done']
+    tasks_dir.join('cal', done.filename).remove()
+    task, = [t for t in vdir.walk() if t.summary == u'soon']
+    task.summary = u'changed'
+    task.write()
+    assert db.import_vdir(str(tasks_dir), delete=True) == []
+    assert sorted(t.summary for t in db.walk()) == \
+        [u'at noon', u'changed', u'later']
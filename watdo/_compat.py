@@ -7,8 +7,14 @@
     :license: MIT, see LICENSE for more details.
 '''
 
+import datetime
 import sys
 
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir  # noqa
+
 PY2 = sys.version_info < (3,)
 DEFAULT_ENCODING = 'utf-8'
 
@@ -25,10 +31,27 @@ def to_bytes(x, encoding=DEFAULT_ENCODING):
     return x
 
 if PY2:
+    from itertools import imap
     text_type = unicode  # flake8: noqa
     to_native = to_bytes
 else:
+    imap = map
     text_type = str
     to_native = to_unicode
 
 string_types = (bytes, text_type)
+
+try:
+    utc = datetime.timezone.utc
+except AttributeError:
+    class _UTC(datetime.tzinfo):
+        def utcoffset(self, dt):
+            return datetime.timedelta(0)
+
+        def dst(self, dt):
+            return datetime.timedelta(0)
+
+        def tzname(self, dt):
+            return 'UTC'
+
+    utc = _UTC()
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+'''
+    watdo.archive
+    ~~~~~~~~~~~~~
+
+    This module moves completed tasks out of the vdir into an archive, so
+    they don't have to be listed on every run. The archive is only read
+    when all tasks are requested.
+
+    :copyright: (c) 2014 Markus Unterwaditzer
+    :license: MIT, see LICENSE for more details.
+'''
+
+import base64
+import datetime
+import json
+import os
+
+from . import model, stats
+from ._compat import to_bytes, to_unicode
+from .cli_utils import check_directory
+from .query import _done_statuses, _status
+
+
+def is_archivable(fields, before=None):
+    '''Whether a task with the scanned ``fields`` is done, and was done
+    before the datetime ``before``. If ``before`` is given, tasks without a
+    valid done date are kept.'''
+    if fields is None or _status(fields) not in _done_statuses:
+        return False
+    if before is None:
+        return True
+    try:
+        done_date = model._decode_date(fields.get('completed'))
+    except model.ParsingError:
+        return False
+    if isinstance(done_date, datetime.datetime):
+        return done_date < before
+    elif isinstance(done_date, datetime.date):
+        return datetime.datetime.combine(done_date, datetime.time()) < before
+    return False
+
+
+class Archive(object):
+    '''The archived tasks of each calendar are stored as JSON Lines in a
+    file named after the calendar inside ``path``::
+
+        {"filename": ..., "fields": {...}, "data": "BEGIN:VCALENDAR..."}
+
+    ``fields`` are the scanned fields of the task, ``data`` the original
+    content of its file, base64-encoded. A task that is archived again after
+    its file reappeared with different content gets another record.
+
+    :param path: the archive directory.
+    :param basepath: the vdir the tasks were archived from.
+    '''
+
+    def __init__(self, path, basepath):
+        self.path = path
+        self.basepath = basepath
+
+    def _filepath(self, calendar):
+        return os.path.join(self.path, calendar + u'.jsonl')
+
+    def calendars(self):
+        '''Return a sorted list of the calendars with archived tasks.'''
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            return []
+        return sorted(name[:-len(u'.jsonl')] for name in names
+                      if name.endswith(u'.jsonl') and
+                      not name.startswith(u'.'))
+
+    def _read(self, calendar):
+        try:
+            f = open(self._filepath(calendar), 'rb')
+        except (IOError, OSError):
+            return
+        with f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line.decode('utf-8'))
+
+    def walk(self, calendars=None, predicate=None):
+        '''Yield the archived tasks of ``calendars``, or of all calendars.
+        Like with :py:func:`watdo.model.walk_calendars`, ``predicate`` is
+        called with the scanned fields of each task.
+
+        The tasks are read-only, their files don't exist anymore.'''
+        if calendars is None:
+            calendars = self.calendars()
+        for calendar in sorted(calendars):
+            with stats.timer('read_archive'):
+                records = list(self._read(calendar))
+            for record in records:
+                fields = record['fields']
+                if predicate is not None and not predicate(fields):
+                    continue
+                stats.incr('archived_tasks_read')
+                yield model.Task(
+                    filepath=os.path.join(self.basepath, calendar,
+                                          record['filename']),
+                    _fields=fields, archived=True)
+
+    def compact(self, index, before=None):
+        '''Move the done tasks known to the
+        :py:class:`watdo.cache.TaskIndex` ``index`` into the archive, see
+        :py:func:`is_archivable`. Returns the number of archived tasks and a
+        list of ``(filepath, error)`` for the files that couldn't be
+        removed.'''
+        n = 0
+        batch = model.WriteBatch()
+        for dirpath in sorted(index.calendars):
+            entries = index.get_calendar(dirpath)
+            filenames = sorted(filename for filename, (key, fields)
+                               in entries.items()
+                               if is_archivable(fields, before))
+            if filenames:
+                n += self._append(dirpath, filenames, entries, batch)
+        errors = batch.commit()
+        stats.incr('tasks_archived', n - len(errors))
+        return n - len(errors), errors
+
+    def _append(self, dirpath, filenames, entries, batch):
+        calendar = os.path.basename(dirpath)
+        archived = {}
+        for record in self._read(calendar):
+            archived.setdefault(record['filename'], set()).add(record['data'])
+        lines = []
+        n = 0
+        for filename in filenames:
+            filepath = os.path.join(dirpath, filename)
+            try:
+                with open(filepath, 'rb') as f:
+                    # skip files that changed since they were indexed
+                    if list(model.file_etag(os.fstat(f.fileno()))) != \
+                       entries[filename][0]:
+                        continue
+                    data = to_unicode(base64.b64encode(f.read()))
+            except (IOError, OSError):
+                continue
+            if data not in archived.get(filename, ()):
+                lines.append(to_bytes(json.dumps({
+                    'filename': filename,
+                    'fields': entries[filename][1],
+                    'data': data
+                }, sort_keys=True)) + b'\n')
+            batch.remove(filepath)
+            n += 1
+
+        # the archive has to be on disk before the files are removed
+        check_directory(self.path)
+        with open(self._filepath(calendar), 'ab') as f:
+            f.write(b''.join(lines))
+            f.flush()
+            os.fsync(f.fileno())
+        return n
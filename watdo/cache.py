@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+'''
+    watdo.cache
+    ~~~~~~~~~~~
+
+    This module provides a persistent index of the VTODO fields inside each
+    task file, so unchanged files don't have to be parsed on every run.
+
+    :copyright: (c) 2014 Markus Unterwaditzer
+    :license: MIT, see LICENSE for more details.
+'''
+
+import json
+import os
+
+from ._compat import to_bytes
+from .cli_utils import check_directory
+from .model import file_etag
+from .query import FieldIndex
+
+
+class JSONIndex(object):
+    '''Base class for indexes that are stored as JSON inside of
+    ``cachepath``. Subclasses convert their data with :py:meth:`_load` and
+    :py:meth:`_dump` and set :py:attr:`changed` when it changes.'''
+
+    #: bumped whenever the format of the stored data changes
+    version = None
+
+    def __init__(self, filepath=None):
+        self.filepath = filepath
+        self.changed = False
+
+    @classmethod
+    def load(cls, filepath):
+        '''Load the index at ``filepath``. A missing, corrupt or outdated file
+        results in an empty index.'''
+        self = cls(filepath)
+        try:
+            with open(filepath, 'rb') as f:
+                data = json.loads(f.read().decode('utf-8'))
+        except (IOError, OSError, ValueError):
+            return self
+        if isinstance(data, dict) and data.get('version') == self.version:
+            self._load(data)
+        return self
+
+    def save(self):
+        if not self.changed or self.filepath is None:
+            return
+        from atomicwrites import atomic_write
+        check_directory(os.path.dirname(self.filepath))
+        data = self._dump()
+        data['version'] = self.version
+        with atomic_write(self.filepath, mode='wb', overwrite=True) as f:
+            f.write(to_bytes(json.dumps(data)))
+        self.changed = False
+
+    def _load(self, data):
+        raise NotImplementedError()
+
+    def _dump(self):
+        raise NotImplementedError()
+
+
+class TaskIndex(JSONIndex):
+    '''Maps calendar directories to the tasks inside them::
+
+        {dirpath: {filename: [key, fields]}}
+
+    ``key`` is derived from the file's stat data, ``fields`` is the return
+    value of :py:func:`watdo.model.scan_vtodo` or ``None`` if the file
+    doesn't contain a VTODO.
+
+    Files that couldn't be parsed are kept in :py:attr:`quarantine` instead,
+    so they are skipped until they change::
+
+        {dirpath: {filename: [key, error]}}
+    '''
+
+    version = 3
+
+    def __init__(self, filepath=None):
+        JSONIndex.__init__(self, filepath)
+        self.calendars = {}
+        self.quarantine = {}
+        self._field_indexes = {}
+
+    def _load(self, data):
+        self.calendars = data['calendars']
+        self.quarantine = data['quarantine']
+
+    def _dump(self):
+        return {'calendars': self.calendars, 'quarantine': self.quarantine}
+
+    @staticmethod
+    def key(st):
+        '''The part of ``os.stat_result`` that identifies a file version.'''
+        return list(file_etag(st))
+
+    def get_calendar(self, dirpath):
+        return self.calendars.get(dirpath, {})
+
+    def set_calendar(self, dirpath, entries):
+        old = self.calendars.get(dirpath)
+        if old != entries:
+            field_index = self._field_indexes.get(dirpath)
+            if field_index is not None:
+                field_index.update(old or {}, entries)
+            self.calendars[dirpath] = entries
+            self.changed = True
+
+    def get_quarantine(self, dirpath):
+        return self.quarantine.get(dirpath, {})
+
+    def set_quarantine(self, dirpath, entries):
+        if self.quarantine.get(dirpath, {}) != entries:
+            if entries:
+                self.quarantine[dirpath] = entries
+            else:
+                del self.quarantine[dirpath]
+            self.changed = True
+
+    def quarantined_files(self):
+        '''Yield ``(filepath, error)`` for all files in quarantine, sorted
+        by path.'''
+        for dirpath in sorted(self.quarantine):
+            entries = self.quarantine[dirpath]
+            for filename in sorted(entries):
+                yield os.path.join(dirpath, filename), entries[filename][1]
+
+    def retain_calendars(self, dirpaths):
+        '''Forget about all calendars not in ``dirpaths``.'''
+        for dirpath in set(self.calendars).difference(dirpaths):
+            del self.calendars[dirpath]
+            self._field_indexes.pop(dirpath, None)
+            self.changed = True
+        for dirpath in set(self.quarantine).difference(dirpaths):
+            del self.quarantine[dirpath]
+            self.changed = True
+
+    def field_index(self, dirpath):
+        '''Return the :py:class:`watdo.query.FieldIndex` of a calendar. It is
+        built on first use and kept up to date by :py:meth:`set_calendar`.'''
+        rv = self._field_indexes.get(dirpath)
+        if rv is None:
+            rv = self._field_indexes[dirpath] = \
+                FieldIndex(self.get_calendar(dirpath))
+        return rv
@@ -10,22 +10,28 @@
     :license: MIT, see LICENSE for more details.
 '''
 
+import contextlib
+import datetime
+import errno
 import functools
+import itertools
+import json
 import os
+import shutil
 import subprocess
 import sys
 import tempfile
 
 import click
 
-from . import editor, model
+from . import archive, cache, daemon, editor, importer, model, query, search, \
+    stats, storage
 from ._compat import to_unicode
 from .cli_utils import parse_config_value, path
 from .exceptions import CliError
-try:
-    from ConfigParser import SafeConfigParser
-except ImportError:
-    from configparser import SafeConfigParser
+
+#: number of changes ``watdo set`` writes at once
+SET_BATCH_SIZE = 1000
 
 
 def confirm_changes(changes):
@@ -48,65 +54,347 @@ def confirm_changes(changes):
     return changes
 
 
-def make_changes(changes, cfg):
+def make_changes(changes, cfg, batch=None):
     changes = list(changes)
     if not changes:
         print('Nothing to do.')
-    for description, func in changes:
-        print(description)
-        func(cfg)
-
-
-def launch_editor(cfg, all_tasks=False, calendar=None):
+    if batch is None:
+        batch = get_storage(cfg).batch()
+    conflicts = 0
+    with stats.timer('make_changes'):
+        for description, func in changes:
+            print(description)
+            try:
+                func(cfg, batch)
+            except model.ConflictError as e:
+                print(u'Conflict: {} The change was not applied.'.format(e))
+                stats.incr('conflicts')
+                conflicts += 1
+        errors = batch.commit()
+    stats.incr('changes_applied', len(changes) - conflicts - len(errors))
+    for filepath, e in errors:
+        print(u'Error while writing {}: {}'.format(filepath, e))
+
+
+def set_tasks(cfg, q, properties, uids=(), dry_run=False,
+              batch_size=SET_BATCH_SIZE):
+    '''Set ``properties`` (see :py:func:`watdo.editor.update_record`) on
+    all tasks matching the :py:class:`watdo.query.Query` ``q`` and, if
+    given, having one of ``uids``. Changes are written in batches of
+    ``batch_size`` while the tasks are read. Returns the numbers of changed,
+    unchanged, conflicting and failed tasks.'''
+    uids = set(uids)
+    changed = unchanged = conflicts = 0
+    errors = []
+    # tasks moved into calendars that weren't read yet are read again
+    moved = set()
+    client = daemon.connect(cfg)
+    batch = get_storage(cfg).batch() if client is None else client.batch()
+    with read_tasks(cfg, q, client) as tasks:
+        for task in tasks:
+            if task.filepath in moved or uids and task.uid not in uids:
+                continue
+            old_task = model.TaskRecord.from_task(task)
+            new_task = editor.update_record(old_task, **properties)
+            if new_task == old_task:
+                unchanged += 1
+                continue
+            if new_task.calendar != old_task.calendar:
+                dirpath, filename = os.path.split(old_task.filepath)
+                moved.add(os.path.join(os.path.dirname(dirpath),
+                                       new_task.calendar, filename))
+            description, func = editor.get_modify_change(old_task, new_task)
+            if dry_run:
+                print(description)
+                changed += 1
+                continue
+            try:
+                func(cfg, batch)
+            except model.ConflictError as e:
+                print(u'Conflict: {} The change was not applied.'.format(e))
+                stats.incr('conflicts')
+                conflicts += 1
+                continue
+            changed += 1
+            if len(batch) >= batch_size:
+                errors.extend(batch.commit())
+    errors.extend(batch.commit())
+    stats.incr('changes_applied', changed - len(errors))
+    for filepath, e in errors:
+        print(u'Error while writing {}: {}'.format(filepath, e))
+    return changed - len(errors), unchanged, conflicts, len(errors)
+
+
+@contextlib.contextmanager
+def read_tasks(cfg, q, client=None):
+    '''Yield an iterator over the tasks matching the
+    :py:class:`watdo.query.Query` ``q``. They are read from the daemon if a
+    :py:class:`watdo.daemon.Client` is given and answers in time, otherwise
+    from disk, in which case the index is saved afterwards.
+
+    Archived tasks are only read if ``q`` can match done tasks. Otherwise,
+    done tasks are archived afterwards if ``archive_after`` is set.'''
+    if client is not None:
+        try:
+            tasks = client.walk_calendars(calendars=q.calendars,
+                                          pending=q.pending, query=q.text)
+        except daemon.DaemonUnavailable as e:
+            print(u'{} Reading tasks from disk instead.'.format(e))
+        else:
+            yield with_archived(cfg, q, tasks)
+            return
+
+    index = None
+    if cfg.get('storage', 'vdir') == 'vdir':
+        index = cache.TaskIndex.load(
+            os.path.join(cfg['cachepath'], 'index.json'))
+    yield with_archived(cfg, q, get_storage(cfg, index).walk(
+        calendars=q.calendars, predicate=q))
+    if index is None:
+        return
+    if not q.includes_done and cfg.get('archive_after') is not None:
+        archive_tasks(cfg, index, cfg['archive_after'])
+    with stats.timer('save_index'):
+        index.save()
+
+
+def get_storage(cfg, index=None):
+    '''Return the storage selected with the ``storage`` option. See
+    :py:class:`watdo.storage.VdirStorage` for ``index``.'''
+    if cfg.get('storage', 'vdir') == 'sqlite':
+        return storage.SQLiteStorage(cfg['database'], cfg['path'])
+    return storage.VdirStorage(cfg['path'], index=index,
+                               jobs=cfg.get('jobs', 1))
+
+
+def check_vdir(cfg, command):
+    if cfg.get('storage', 'vdir') != 'vdir':
+        raise CliError('watdo {} only works with tasks stored in the vdir.'
+                       .format(command))
+
+
+def get_archive(cfg):
+    return archive.Archive(cfg['archivepath'], cfg['path'])
+
+
+def with_archived(cfg, q, tasks):
+    '''Append the archived tasks matching ``q`` to ``tasks`` if ``q`` can
+    match done tasks.'''
+    if not q.includes_done or not cfg.get('archivepath'):
+        return tasks
+    return itertools.chain(tasks, get_archive(cfg).walk(
+        calendars=q.calendars, predicate=q))
+
+
+def archive_tasks(cfg, index, days):
+    '''Archive the tasks in ``index`` that were done more than ``days``
+    days ago. Returns the number of archived tasks.'''
+    before = None
+    if days > 0:
+        before = datetime.datetime.now() - datetime.timedelta(days=days)
+    with stats.timer('archive'):
+        n, errors = get_archive(cfg).compact(index, before)
+    for filepath, e in errors:
+        print(u'Error while archiving {}: {}'.format(filepath, e))
+    return n
+
+
+def make_query(query_text=u'', calendar=None, all_tasks=False):
+    '''Combine ``--query``, ``--calendar`` and ``--all`` into a
+    :py:class:`watdo.query.Query`.'''
+    return query.Query(query_text,
+                       calendars=None if calendar is None else [calendar],
+                       pending=not all_tasks)
+
+
+def check_editor(cfg):
+    if not cfg.get('editor'):
+        raise CliError('No editor could be determined. Make sure you\'ve got '
+                       'either $WATDO_EDITOR or $EDITOR set.')
+
+
+@contextlib.contextmanager
+def open_tmpfile(cfg):
+    '''Yield a new tmpfile inside ``tmppath``, which is removed
+    afterwards.'''
     tmpfile = tempfile.NamedTemporaryFile(dir=cfg['tmppath'], delete=False)
-
     try:
-        with tmpfile as f:
-            tasks = model.walk_calendars(cfg['path'])
-
-            def task_filter():
-                for task in tasks:
-                    if calendar is not None and task.calendar != calendar:
-                        continue
-                    if not all_tasks and task.done:
-                        continue
-                    yield task
-
-            header = u'// Showing {status} tasks from {calendar}'.format(
-                status=(u'all' if all_tasks else u'pending'),
-                calendar=(u'all calendars' if calendar is None else u'@{}'
-                          .format(calendar))
-            )
-            old_ids = editor.generate_tmpfile(f, task_filter(), header)
+        yield tmpfile
+    finally:
+        tmpfile.close()
+        os.remove(tmpfile.name)
+
 
-        new_ids = None
-        while new_ids is None:
-            cmd = cfg['editor'] + ' ' + tmpfile.name
-            print('>>> {}'.format(cmd))
+def edit_tmpfile(cfg, filename, old_ids, client=None):
+    '''Open the editor until the tmpfile at ``filename`` can be parsed, and
+    apply the changes to the tasks in ``old_ids``.'''
+    new_ids = None
+    while new_ids is None:
+        cmd = cfg['editor'] + ' ' + filename
+        print('>>> {}'.format(cmd))
+        with stats.timer('editor'):
             subprocess.call(cmd, shell=True)
 
-            with open(tmpfile.name, 'rb') as f:
-                try:
+        with open(filename, 'rb') as f:
+            try:
+                with stats.timer('parse_tmpfile'):
                     new_ids = editor.parse_tmpfile(f)
 
-                    changes = editor.get_changes(old_ids, new_ids)
+                with stats.timer('load_records'):
+                    editor.load_records(old_ids, new_ids,
+                                        get_storage(cfg).read)
+
+                with stats.timer('get_changes'):
+                    changes = list(editor.get_changes(old_ids, new_ids))
+
+                if cfg['confirmation']:
+                    changes = confirm_changes(changes)
+                make_changes(changes, cfg, batch=(
+                    None if client is None else client.batch()))
+
+            except (ValueError, CliError) as e:
+                print(e)
+                click.confirm('Do you want to edit again? '
+                              'Otherwise changes will be discarded.',
+                              default=True, abort=True)
+            else:
+                break
+
+
+def launch_editor(cfg, all_tasks=False, calendar=None, limit=None, page=1,
+                  query_text=u''):
+    check_editor(cfg)
+    client = daemon.connect(cfg)
+    header = u'// Showing {status} tasks from {calendar}'.format(
+        status=(u'all' if all_tasks else u'pending'),
+        calendar=(u'all calendars' if calendar is None else u'@{}'
+                  .format(calendar))
+    )
+    if query_text:
+        header += u' matching "{}"'.format(query_text)
+    offset = 0
+    if limit is not None:
+        offset = (page - 1) * limit
+        header += u', page {} ({} tasks per page)'.format(page, limit)
+    q = make_query(query_text, calendar, all_tasks)
+
+    with open_tmpfile(cfg) as f:
+        with read_tasks(cfg, q, client) as tasks:
+            with stats.timer('generate_tmpfile'):
+                old_ids = editor.generate_tmpfile(
+                    f, tasks, header, limit=limit, offset=offset,
+                    locators=cfg.get('low_memory', False))
+        f.close()
+        edit_tmpfile(cfg, f.name, old_ids, client)
+
+
+def search_tasks(cfg, text, q):
+    '''Return the tasks matching the :py:class:`watdo.query.Query` ``q``
+    that contain all words of ``text``, best matches first.
+
+    Archived tasks aren't in the search index. They come after all other
+    tasks, ranked only by the weight of the words in them, without the
+    inverse document frequency used by
+    :py:meth:`watdo.search.SearchIndex.search`.'''
+    words = set(query.split_words(text))
+    if not words:
+        return []
+    index = cache.TaskIndex.load(os.path.join(cfg['cachepath'], 'index.json'))
+    for task in model.walk_calendars(cfg['path'], index=index,
+                                     jobs=cfg.get('jobs', 1),
+                                     calendars=q.calendars, predicate=q):
+        pass
+    with stats.timer('save_index'):
+        index.save()
+
+    search_index = search.SearchIndex.load(
+        os.path.join(cfg['cachepath'], 'search.json'))
+    with stats.timer('update_search_index'):
+        search_index.update(index)
+    with stats.timer('search'):
+        hits = search_index.search(text)
+    with stats.timer('save_search_index'):
+        search_index.save()
+
+    rv = []
+    for score, filepath in hits:
+        dirpath, filename = os.path.split(filepath)
+        if q.calendars is not None and \
+           os.path.basename(dirpath) not in q.calendars:
+            continue
+        key, fields = index.get_calendar(dirpath)[filename]
+        if q(fields):
+            rv.append(model.Task(filepath=filepath, etag=key,
+                                 _fields=fields))
+
+    # archived tasks are not indexed, they come last
+    archived = []
+    for task in with_archived(cfg, q, ()):
+        weights = search.term_weights(task._fields)
+        if words.issubset(weights):
+            archived.append((-sum(weights[word] for word in words), task))
+    archived.sort(key=lambda x: x[0])
+    rv.extend(task for score, task in archived)
+    return rv
+
+
+def parse_archive_after(x):
+    if x is None or x == '':
+        return None
+    try:
+        days = int(x)
+    except ValueError:
+        days = -1
+    if days < 0:
+        raise CliError('Invalid value for archive_after: {}'.format(x))
+    return days
+
+
+def parse_storage(x):
+    if x not in ('vdir', 'sqlite'):
+        raise CliError('Invalid value for storage: {}'.format(x))
+    return x
+
+
+def parse_jobs(x):
+    x = parse_config_value(x)
+    if x is True:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    elif x is False:
+        return 1
+    try:
+        return max(1, int(x))
+    except ValueError:
+        raise CliError('Invalid value for jobs: {}'.format(x))
 
-                    if cfg['confirmation']:
-                        changes = confirm_changes(changes)
-                    make_changes(changes, cfg)
 
-                except (ValueError, CliError) as e:
-                    print(e)
-                    click.confirm('Do you want to edit again? '
-                                  'Otherwise changes will be discarded.',
-                                  default=True, abort=True)
-                else:
-                    break
-    finally:
-        os.remove(tmpfile.name)
+def print_tasks(tasks, fmt='text'):
+    try:
+        for task in tasks:
+            if fmt == 'json':
+                click.echo(json.dumps(editor.task_to_dict(task),
+                                      sort_keys=True))
+                continue
+            line, description = editor.format_task(task)
+            click.echo(line)
+            for x in description:
+                click.echo(editor.DESCRIPTION_INDENT + x)
+    except IOError as e:
+        if e.errno != errno.EPIPE:
+            raise
+        # the reader went away, e.g. ``watdo list | head``
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+        sys.exit(1)
 
 
 def get_config_parser(env):
+    try:
+        from ConfigParser import SafeConfigParser
+    except ImportError:
+        from configparser import SafeConfigParser
+
     fname = env.get('WATDO_CONFIG', path('~/.watdo/config'))
     parser = SafeConfigParser()
     parser.add_section('watdo')
@@ -138,15 +426,30 @@ def _get_cli():
     @click.option('--all/--pending', '-a',
                   help='Show all tasks, not only unfinished ones.')
     @click.option('--calendar', '-c', help='The calendar to show')
+    @click.option('--query', '-q', 'query_text', metavar='EXPR',
+                  help=('Only show tasks matching EXPR, e.g. '
+                        '"due<2014-11-01 status:IN-PROCESS @work invoice".'))
+    @click.option('--limit', '-n', type=click.IntRange(1),
+                  help='Only show the N tasks that are due first.')
+    @click.option('--page', '-p', type=click.IntRange(1), default=1,
+                  help=('With --limit, show the K-th page of tasks by due '
+                        'date.'))
+    @click.option('--profile', metavar='FILE', envvar='WATDO_PROFILE',
+                  help=('Write timings and counters as JSON to FILE, "-" for '
+                        'stderr. Can be set with WATDO_PROFILE.'))
     @click.pass_context
     @catch_errors
-    def cli(ctx, confirm, all, calendar):
+    def cli(ctx, confirm, all, calendar, query_text, limit, page, profile):
         if ctx.obj is None:
             ctx.obj = {}
 
-        def bail_out(msg):
-            click.echo(msg)
-            ctx.abort()
+        if profile:
+            stats.enable()
+
+            @ctx.call_on_close
+            def dump_stats():
+                stats.dump(profile)
+                stats.disable()
 
         file_cfg = get_config_parser(os.environ)
 
@@ -158,12 +461,28 @@ def _get_cli():
                                   file_cfg.get('tmppath') or
                                   '~/.watdo/tmp/')
 
+        ctx.obj['cachepath'] = path(os.environ.get('WATDO_CACHEPATH') or
+                                    file_cfg.get('cachepath') or
+                                    os.path.join(ctx.obj['tmppath'], 'cache'))
+
+        ctx.obj['storage'] = parse_storage(os.environ.get('WATDO_STORAGE') or
+                                           file_cfg.get('storage') or 'vdir')
+
+        ctx.obj['database'] = path(os.environ.get('WATDO_DATABASE') or
+                                   file_cfg.get('database') or
+                                   '~/.watdo/tasks.sqlite3')
+
+        ctx.obj['archivepath'] = path(os.environ.get('WATDO_ARCHIVEPATH') or
+                                      file_cfg.get('archivepath') or
+                                      '~/.watdo/archive/')
+
+        ctx.obj['archive_after'] = parse_archive_after(
+            os.environ.get('WATDO_ARCHIVE_AFTER') or
+            file_cfg.get('archive_after'))
+
         ctx.obj['editor'] = (os.environ.get('WATDO_EDITOR') or
                              file_cfg.get('editor') or
-                             os.environ.get('EDITOR') or
-                             bail_out('No editor could be determined. Make '
-                                      'sure you\'ve got either $WATDO_EDITOR '
-                                      'or $EDITOR set.'))
+                             os.environ.get('EDITOR'))
 
         confirm_default = parse_config_value(
             file_cfg.get('confirmation', 'true'))
@@ -172,13 +491,25 @@ def _get_cli():
             confirm = confirm_default
 
         ctx.obj['confirmation'] = confirm
+        ctx.obj['low_memory'] = parse_config_value(
+            os.environ.get('WATDO_LOW_MEMORY') or
+            file_cfg.get('low_memory', 'false')) is True
+        ctx.obj['jobs'] = parse_jobs(os.environ.get('WATDO_JOBS') or
+                                     file_cfg.get('jobs') or '1')
         ctx.obj['show_all_tasks'] = all
+        ctx.obj['calendar'] = calendar or None
+        ctx.obj['query'] = to_unicode(query_text or '', 'utf-8')
+        ctx.obj['limit'] = limit
+        ctx.obj['page'] = page
 
         if not ctx.invoked_subcommand:
             launch_editor(
                 ctx.obj,
                 all_tasks=ctx.obj.get('show_all_tasks', False),
-                calendar=calendar or None
+                calendar=ctx.obj['calendar'],
+                limit=limit,
+                page=page,
+                query_text=ctx.obj['query']
             )
 
     @cli.command()
@@ -191,11 +522,284 @@ def _get_cli():
         lines of a task inside the editor.'''
         # Not sure what the appropriate encoding is, but it probably is utf-8
         # in most cases.
-        _, t = editor.parse_summary_header(to_unicode(summary, 'utf-8'))
-        t.description = description
+        _, record = editor.parse_summary_header(to_unicode(summary, 'utf-8'))
+        record.description = description
+        t = record.to_task()
         t.basepath = ctx.obj['path']
         print(u'Creating task: "{}" in {}'.format(t.summary, t.calendar))
-        t.write(create=True)
+        batch = get_storage(ctx.obj).batch()
+        t.write(create=True, batch=batch)
+        for filepath, e in batch.commit():
+            raise CliError(u'Error while writing {}: {}'.format(filepath, e))
+
+    @cli.command('list')
+    @click.option('--format', 'fmt', type=click.Choice(['text', 'json']),
+                  default='text',
+                  help=('Print tasks like in the editor or as JSON Lines.'))
+    @click.option('--sort/--no-sort', default=False,
+                  help=('Sort tasks by due date. This has to read all tasks '
+                        'before printing the first one. Implied by --limit.'))
+    @click.pass_context
+    @catch_errors
+    def list_(ctx, fmt, sort):
+        '''Print tasks without opening the editor. Tasks are printed as
+        soon as they are read, in no particular order.'''
+        cfg = ctx.obj
+        q = make_query(cfg['query'], cfg['calendar'], cfg['show_all_tasks'])
+        with read_tasks(cfg, q, daemon.connect(cfg)) as tasks:
+            limit = cfg['limit']
+            if sort or limit is not None:
+                offset = 0 if limit is None else (cfg['page'] - 1) * limit
+                tasks = editor.select_by_deadline(tasks, limit=limit,
+                                                  offset=offset)
+            print_tasks(tasks, fmt)
+
+    cli.add_command(list_, 'export')
+
+    @cli.command('set')
+    @click.option('--uid', 'uids', multiple=True, metavar='UID',
+                  help=('Only change the task with this UID. Can be given '
+                        'multiple times.'))
+    @click.option('--status', help='The new status, such as x or CANCELLED.')
+    @click.option('--due', metavar='DATE',
+                  help=('The new due date in the format of the editor, '
+                        '"none" to remove it.'))
+    @click.option('--move-to', metavar='CALENDAR',
+                  help='Move the tasks into another calendar.')
+    @click.option('--dry-run', is_flag=True,
+                  help='Only show which tasks would be changed.')
+    @click.option('--select-all', is_flag=True,
+                  help=('Change all tasks. Required if neither --calendar, '
+                        '--query nor --uid is given.'))
+    @click.option('--batch-size', default=SET_BATCH_SIZE,
+                  type=click.IntRange(1),
+                  help='Number of changes written at once.')
+    @click.pass_context
+    @catch_errors
+    def set_(ctx, uids, status, due, move_to, dry_run, select_all,
+             batch_size):
+        '''Change the status, due date or calendar of all tasks selected
+        with --calendar, --query and --all, without opening the editor.'''
+        cfg = ctx.obj
+        properties = {}
+        if status is not None:
+            status = to_unicode(status, 'utf-8')
+            parsed = editor.parse_status(status) or \
+                editor.parse_status(status.upper())
+            if not parsed:
+                raise CliError(u'Invalid status: {}'.format(status))
+            # tasks store NEEDS-ACTION as no status at all
+            properties['status'] = u'' if parsed == u'NEEDS-ACTION' \
+                else parsed
+        if due is not None:
+            due = to_unicode(due, 'utf-8')
+            try:
+                properties['due'] = None if due.lower() == u'none' \
+                    else editor.parse_date(due)
+            except ValueError:
+                raise CliError(u'Invalid date: {}'.format(due))
+        if move_to is not None:
+            move_to = to_unicode(move_to, 'utf-8')
+            dirpath = os.path.join(cfg['path'], move_to)
+            if cfg['storage'] == 'vdir' and not os.path.isdir(dirpath):
+                raise CliError('Calendars are not explicitly created. '
+                               'Please create the directory {} yourself.'
+                               .format(dirpath))
+            properties['calendar'] = move_to
+        if not properties:
+            raise CliError('Nothing to change, use --status, --due or '
+                           '--move-to.')
+        if not (cfg['calendar'] or cfg['query'] or uids or select_all):
+            raise CliError('No tasks selected, use --calendar, --query, '
+                           '--uid or --select-all.')
+
+        q = make_query(cfg['query'], cfg['calendar'], cfg['show_all_tasks'])
+        changed, unchanged, conflicts, errors = set_tasks(
+            cfg, q, properties, [to_unicode(x, 'utf-8') for x in uids],
+            dry_run=dry_run, batch_size=batch_size)
+        print(u'{} {} tasks, {} unchanged, {} conflicts, {} errors.'.format(
+            u'Would change' if dry_run else u'Changed', changed, unchanged,
+            conflicts, errors))
+
+    @cli.command('search')
+    @click.argument('words', nargs=-1, required=True)
+    @click.option('--sort', type=click.Choice(['relevance', 'due']),
+                  default='relevance', help='How to order the results.')
+    @click.option('--format', 'fmt', type=click.Choice(['text', 'json']),
+                  default='text',
+                  help=('Print tasks like in the editor or as JSON Lines.'))
+    @click.option('--edit', '-e', is_flag=True,
+                  help='Open the matching tasks in the editor.')
+    @click.pass_context
+    @catch_errors
+    def search_(ctx, words, sort, fmt, edit):
+        '''Search the summaries and descriptions of tasks. Only tasks
+        containing all WORDS are shown.'''
+        cfg = ctx.obj
+        check_vdir(cfg, 'search')
+        text = u' '.join(to_unicode(word, 'utf-8') for word in words)
+        if edit:
+            check_editor(cfg)
+        q = make_query(cfg['query'], cfg['calendar'], cfg['show_all_tasks'])
+        tasks = search_tasks(cfg, text, q)
+
+        limit = cfg['limit']
+        offset = 0 if limit is None else (cfg['page'] - 1) * limit
+        if sort == 'due':
+            tasks = editor.select_by_deadline(tasks, limit=limit,
+                                              offset=offset)
+        elif limit is not None:
+            tasks = tasks[offset:offset + limit]
+
+        if not edit:
+            print_tasks(tasks, fmt)
+            return
+        with open_tmpfile(cfg) as f:
+            old_ids = editor.generate_tmpfile(
+                f, tasks, u'// Showing tasks matching "{}"'.format(text))
+            f.close()
+            edit_tmpfile(cfg, f.name, old_ids, daemon.connect(cfg))
+
+    @cli.command('import')
+    @click.argument('source', type=click.File('rb'))
+    @click.option('--batch-size', default=importer.BATCH_SIZE,
+                  type=click.IntRange(1),
+                  help='Number of tasks written at once.')
+    @click.pass_context
+    @catch_errors
+    def import_(ctx, source, batch_size):
+        '''Create tasks from a todo.txt file or a file in the format of the
+        editor, "-" for stdin. Tasks without a calendar are put into the one
+        given with --calendar.
+
+        Tasks that were already imported are skipped, so an interrupted
+        import can just be started again.'''
+        cfg = ctx.obj
+        with read_tasks(cfg, query.Query()) as tasks:
+            uids = set(task.uid for task in tasks)
+
+        def progress(imp):
+            click.echo(u'\rImported {} tasks, skipped {}.'
+                       .format(imp.imported, imp.skipped), nl=False, err=True)
+
+        imp = importer.Importer(cfg['path'], uids, calendar=cfg['calendar'],
+                                batch_size=batch_size, progress=progress,
+                                batch=get_storage(cfg).batch())
+        try:
+            imp.feed(source)
+        except model.ParsingError as e:
+            raise CliError(str(e))
+        finally:
+            progress(imp)
+            click.echo(err=True)
+            for filepath, e in imp.errors:
+                print(u'Error while writing {}: {}'.format(filepath, e))
+
+    @cli.command('archive')
+    @click.option('--older-than', metavar='DAYS', type=click.IntRange(0),
+                  default=None,
+                  help=('Only archive tasks done more than DAYS days ago. '
+                        'Defaults to the archive_after option, or 0.'))
+    @click.pass_context
+    @catch_errors
+    def archive_(ctx, older_than):
+        '''Move completed and cancelled tasks into the archive. Archived
+        tasks are only shown with --all or a query for done tasks, and can't
+        be changed anymore.'''
+        cfg = ctx.obj
+        check_vdir(cfg, 'archive')
+        if older_than is None:
+            older_than = cfg['archive_after'] or 0
+        index = cache.TaskIndex.load(
+            os.path.join(cfg['cachepath'], 'index.json'))
+        for _ in model.walk_calendars(cfg['path'], index=index,
+                                      jobs=cfg.get('jobs', 1)):
+            pass
+        n = archive_tasks(cfg, index, older_than)
+        index.save()
+        print(u'Archived {} tasks.'.format(n))
+
+    @cli.command()
+    @click.option('--move-to', metavar='DIR',
+                  type=click.Path(file_okay=False),
+                  help='Move broken files into DIR.')
+    @click.pass_context
+    @catch_errors
+    def doctor(ctx, move_to):
+        '''List task files that can't be parsed. Such files are only
+        reported once, after that they are skipped until they change.
+
+        With --move-to, they are moved into a subdirectory of DIR named after
+        their calendar, so they can be fixed by hand. Note that a sync
+        program might delete them on the server too.'''
+        cfg = ctx.obj
+        check_vdir(cfg, 'doctor')
+        index = cache.TaskIndex.load(
+            os.path.join(cfg['cachepath'], 'index.json'))
+        for _ in model.walk_calendars(cfg['path'], index=index,
+                                      jobs=cfg.get('jobs', 1)):
+            pass
+        index.save()
+
+        broken = list(index.quarantined_files())
+        if not broken:
+            print(u'No broken files found.')
+            return
+
+        for filepath, error in broken:
+            print(u'{}: {}'.format(filepath, error))
+        if move_to is None:
+            return
+
+        for filepath, error in broken:
+            dirpath = os.path.join(
+                move_to, os.path.basename(os.path.dirname(filepath)))
+            dest = os.path.join(dirpath, os.path.basename(filepath))
+            if os.path.exists(dest):
+                raise CliError(u'{} already exists.'.format(dest))
+            if not os.path.isdir(dirpath):
+                os.makedirs(dirpath)
+            shutil.move(filepath, dest)
+        print(u'Moved {} files to {}.'.format(len(broken), move_to))
+
+    @cli.group()
+    def db():
+        '''Copy tasks between the vdir and the SQLite database used with
+        "storage = sqlite".'''
+
+    @db.command('import-vdir')
+    @click.option('--delete', is_flag=True,
+                  help='Remove tasks that are not in the vdir.')
+    @click.pass_context
+    @catch_errors
+    def import_vdir(ctx, delete):
+        '''Copy all tasks from the vdir into the database.'''
+        cfg = ctx.obj
+        store = storage.SQLiteStorage(cfg['database'], cfg['path'])
+        for filepath, e in store.import_vdir(cfg['path'], delete=delete):
+            print(u'Error while importing {}: {}'.format(filepath, e))
+
+    @db.command('export-vdir')
+    @click.option('--delete', is_flag=True,
+                  help='Remove task files that are not in the database.')
+    @click.pass_context
+    @catch_errors
+    def export_vdir(ctx, delete):
+        '''Write all tasks from the database into the vdir, for example
+        before syncing it.'''
+        cfg = ctx.obj
+        store = storage.SQLiteStorage(cfg['database'], cfg['path'])
+        for filepath, e in store.export_vdir(cfg['path'], delete=delete):
+            print(u'Error while exporting {}: {}'.format(filepath, e))
+
+    @cli.command('daemon')
+    @click.pass_context
+    @catch_errors
+    def daemon_(ctx):
+        '''Keep tasks in memory and serve them to other watdo processes.'''
+        check_vdir(ctx.obj, 'daemon')
+        print(u'Listening on {}'.format(daemon.socket_path(ctx.obj)))
+        daemon.serve(ctx.obj)
 
     return cli
 
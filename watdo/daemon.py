@@ -0,0 +1,446 @@
+# -*- coding: utf-8 -*-
+'''
+    watdo.daemon
+    ~~~~~~~~~~~~
+
+    This module provides an optional long-running process that keeps the
+    scanned tasks in memory and serves them over a Unix socket. On Linux,
+    calendars are only rescanned after inotify reported changes to them.
+
+    Requests and responses are single lines of JSON. The content of files is
+    sent base64-encoded.
+
+    :copyright: (c) 2014 Markus Unterwaditzer
+    :license: MIT, see LICENSE for more details.
+'''
+
+import base64
+import json
+import os
+import select
+import signal
+import socket
+import struct
+import sys
+
+from . import model, query
+from ._compat import scandir, to_bytes, to_unicode
+from .cache import TaskIndex
+from .cli_utils import check_directory
+from .exceptions import CliError
+
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+
+_ROOT_MASK = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+_CALENDAR_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+                  IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF |
+                  IN_MOVE_SELF)
+_event_header = struct.Struct('iIII')
+
+#: seconds the daemon waits for a client to send its request
+REQUEST_TIMEOUT = 5
+#: seconds a client waits for the daemon to answer
+CLIENT_TIMEOUT = 30
+#: seconds a client waits for the answer to a ping
+PING_TIMEOUT = 1
+
+
+class DaemonUnavailable(CliError):
+    '''The daemon couldn't be reached or didn't answer in time.'''
+
+
+def socket_path(cfg):
+    return os.path.join(cfg['cachepath'], 'daemon.sock')
+
+
+class Inotify(object):
+    '''A minimal ctypes wrapper around Linux' inotify API.'''
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+        self._ctypes = ctypes
+        libname = ctypes.util.find_library('c')
+        self._libc = ctypes.CDLL(libname, use_errno=True)
+        self.fd = self._libc.inotify_init()
+        if self.fd < 0:
+            self._raise()
+        #: maps watch descriptors to paths
+        self.watches = {}
+
+    @classmethod
+    def create(cls):
+        '''Return an instance or ``None`` if inotify is not available.'''
+        try:
+            return cls()
+        except (AttributeError, OSError, TypeError):
+            return None
+
+    def _raise(self):
+        e = self._ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path, mask):
+        wd = self._libc.inotify_add_watch(
+            self.fd, to_bytes(path, sys.getfilesystemencoding()), mask)
+        if wd < 0:
+            self._raise()
+        self.watches[wd] = path
+        return wd
+
+    def read(self):
+        '''Return a list of ``(path, mask, name)`` for all pending events.'''
+        data = os.read(self.fd, 65536)
+        rv = []
+        i = 0
+        while i + _event_header.size <= len(data):
+            wd, mask, cookie, length = _event_header.unpack_from(data, i)
+            i += _event_header.size
+            name = data[i:i + length].rstrip(b'\0')
+            i += length
+            if mask & IN_IGNORED:
+                # the watch was removed, e.g. because the directory is gone
+                rv.append((self.watches.pop(wd, None), mask, name))
+            else:
+                rv.append((self.watches.get(wd), mask, name))
+        return rv
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Daemon(object):
+    '''Keeps a :py:class:`watdo.cache.TaskIndex` of ``path`` up to date and
+    answers requests from :py:class:`Client`.'''
+
+    def __init__(self, path, sockpath, index=None):
+        self.path = path
+        self.sockpath = sockpath
+        self.index = index if index is not None else TaskIndex()
+        self.inotify = Inotify.create()
+        self.calendars = []
+        self.dirty = set()
+        self.root_dirty = True
+        self.running = False
+        self.sock = None
+
+    def _bind(self):
+        if os.path.exists(self.sockpath):
+            if Client(self.sockpath).ping():
+                raise CliError('Another daemon is already listening on {}.'
+                               .format(self.sockpath))
+            os.remove(self.sockpath)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # only the user may connect, from the moment the socket exists
+        umask = os.umask(0o177)
+        try:
+            self.sock.bind(self.sockpath)
+        finally:
+            os.umask(umask)
+        self.sock.listen(16)
+
+    def serve_forever(self, timeout=None):
+        '''Serve requests until :py:meth:`stop` is called.'''
+        self._bind()
+        if self.inotify is not None:
+            self.inotify.add_watch(self.path, _ROOT_MASK)
+        self.running = True
+        self.refresh()
+        try:
+            while self.running:
+                fds = [self.sock]
+                if self.inotify is not None:
+                    fds.append(self.inotify)
+                readable, _, _ = select.select(fds, [], [], timeout)
+                if self.inotify in readable:
+                    self._handle_events()
+                if self.sock in readable:
+                    self._handle_connection()
+        finally:
+            self.sock.close()
+            os.remove(self.sockpath)
+            if self.inotify is not None:
+                self.inotify.close()
+            self.index.save()
+
+    def stop(self):
+        self.running = False
+
+    def _handle_events(self):
+        for path, mask, name in self.inotify.read():
+            if mask & IN_Q_OVERFLOW or path is None:
+                self.root_dirty = True
+                self.dirty.update(self.calendars)
+            elif path == self.path:
+                if mask & IN_ISDIR:
+                    self.root_dirty = True
+            else:
+                self.dirty.add(path)
+
+    def _poll_events(self):
+        if self.inotify is None:
+            return
+        while select.select([self.inotify], [], [], 0)[0]:
+            self._handle_events()
+
+    def refresh(self, calendars=None):
+        '''Rescan changed calendars. Without inotify, all calendars are
+        validated against the index.'''
+        self._poll_events()
+        if self.root_dirty or self.inotify is None:
+            self._scan_root()
+
+        for dirpath in self.calendars:
+            if calendars is not None and \
+               os.path.basename(dirpath) not in calendars:
+                continue
+            if dirpath in self.dirty or self.inotify is None:
+                self.dirty.discard(dirpath)
+                for task in model.walk_calendar(dirpath, index=self.index):
+                    pass
+
+    def _scan_root(self):
+        self.root_dirty = False
+        calendars = sorted(dirent.path for dirent in scandir(self.path)
+                           if not model._is_hidden(dirent.name) and
+                           dirent.is_dir())
+        new = set(calendars).difference(self.calendars)
+        self.calendars = calendars
+        self.index.retain_calendars(calendars)
+        self.dirty.update(new)
+        if self.inotify is not None:
+            watched = set(self.inotify.watches.values())
+            for dirpath in new.difference(watched):
+                self.inotify.add_watch(dirpath, _CALENDAR_MASK)
+
+    def _handle_connection(self):
+        conn, _ = self.sock.accept()
+        try:
+            # a client that never finishes its request mustn't block others
+            conn.settimeout(REQUEST_TIMEOUT)
+            f = conn.makefile('rwb')
+            try:
+                try:
+                    request = json.loads(to_unicode(f.readline()))
+                    response = self.handle(request)
+                except Exception as e:
+                    response = {'error': str(e)}
+                f.write(to_bytes(json.dumps(response)) + b'\n')
+                f.flush()
+            finally:
+                f.close()
+        except socket.error:
+            pass
+        finally:
+            conn.close()
+
+    def handle(self, request):
+        cmd = request.get('cmd')
+        if cmd == 'ping':
+            return {'ok': True}
+        elif cmd == 'list':
+            return self._list(request)
+        elif cmd == 'apply':
+            return self._apply(request)
+        raise ValueError('Unknown command: {}'.format(cmd))
+
+    def _list(self, request):
+        q = query.Query(request.get('query') or u'',
+                        calendars=request.get('calendars'),
+                        pending=request.get('pending', False))
+        self.refresh(q.calendars)
+        tasks = []
+        for dirpath in self.calendars:
+            if q.calendars is not None and \
+               os.path.basename(dirpath) not in q.calendars:
+                continue
+            entries = self.index.get_calendar(dirpath)
+            candidates = q.candidates(self.index.field_index(dirpath))
+            if candidates is None:
+                candidates = entries
+            for filename in sorted(candidates):
+                key, fields = entries[filename]
+                if fields is None:
+                    continue
+                tasks.append({'filepath': os.path.join(dirpath, filename),
+                              'key': key, 'fields': fields})
+        return {'ok': True, 'tasks': tasks}
+
+    def _check_filepath(self, filepath):
+        '''Raise :py:exc:`ValueError` unless ``filepath`` is a task file
+        inside a calendar of the vdir, after resolving symlinks.'''
+        dirpath, filename = os.path.split(os.path.realpath(filepath))
+        if os.path.dirname(dirpath) != os.path.realpath(self.path) or \
+           model._is_hidden(os.path.basename(dirpath)) or \
+           not os.path.isdir(dirpath) or model._is_hidden(filename) or \
+           not filename.endswith(u'.ics'):
+            raise ValueError('Not a task file inside {}: {}'
+                             .format(self.path, filepath))
+
+    def _apply(self, request):
+        # nothing is written unless all paths are valid
+        for write in request.get('writes', ()):
+            for filepath in [write['filepath']] + list(write.get('remove',
+                                                                 ())):
+                self._check_filepath(filepath)
+        for filepath in request.get('removals', ()):
+            self._check_filepath(filepath)
+
+        batch = model.WriteBatch()
+        for write in request.get('writes', ()):
+            batch.write_raw(write['filepath'], base64.b64decode(write['data']),
+                            create=write.get('create', False),
+                            old_filepaths=write.get('remove', ()))
+        for filepath in request.get('removals', ()):
+            batch.remove(filepath)
+        errors = batch.commit()
+        return {'ok': True,
+                'errors': [[filepath, str(e)] for filepath, e in errors]}
+
+
+class Client(object):
+    '''Talks to a :py:class:`Daemon`.'''
+
+    def __init__(self, sockpath, timeout=CLIENT_TIMEOUT):
+        self.sockpath = sockpath
+        self.timeout = timeout
+
+    def request(self, timeout=None, **request):
+        '''Send ``request`` and return the response. Raises
+        :py:exc:`DaemonUnavailable` if the daemon can't be reached or takes
+        longer than ``timeout`` seconds to answer.'''
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout if timeout is None else timeout)
+        try:
+            sock.connect(self.sockpath)
+            f = sock.makefile('rwb')
+            try:
+                f.write(to_bytes(json.dumps(request)) + b'\n')
+                f.flush()
+                line = f.readline()
+            finally:
+                f.close()
+        except socket.error as e:
+            raise DaemonUnavailable('Can\'t reach the daemon: {}'.format(e))
+        finally:
+            sock.close()
+        if not line:
+            raise CliError('The daemon closed the connection.')
+        response = json.loads(to_unicode(line))
+        if 'error' in response:
+            raise CliError('Error from daemon: {}'
+                           .format(response['error']))
+        return response
+
+    def ping(self):
+        try:
+            return self.request(cmd='ping',
+                                timeout=PING_TIMEOUT).get('ok', False)
+        except (CliError, ValueError):
+            return False
+
+    def walk_calendars(self, calendars=None, pending=False, query=u''):
+        '''Like :py:func:`watdo.model.walk_calendars`, but served by the
+        daemon. ``query`` is the text of a :py:class:`watdo.query.Query`.
+        The request is sent right away, so :py:exc:`DaemonUnavailable` is
+        raised by this call, not while iterating.'''
+        response = self.request(cmd='list',
+                                calendars=(None if calendars is None
+                                           else sorted(calendars)),
+                                pending=pending, query=query)
+        return (model.Task(filepath=x['filepath'], etag=x['key'],
+                           _fields=x['fields'])
+                for x in response['tasks'])
+
+    def batch(self):
+        return RemoteBatch(self)
+
+
+class RemoteBatch(object):
+    '''A :py:class:`watdo.model.WriteBatch` that lets the daemon write the
+    files.'''
+
+    def __init__(self, client):
+        self.client = client
+        self.directories = set()
+        self._writes = []
+        self._removals = []
+
+    def write(self, task, create=False):
+        self._writes.append((task, create))
+
+    def remove(self, filepath):
+        self._removals.append(filepath)
+
+    def load(self, record):
+        return record.load()
+
+    def check(self, record):
+        record.check()
+
+    def __len__(self):
+        return len(self._writes) + len(self._removals)
+
+    def commit(self):
+        writes = []
+        for task, create in self._writes:
+            data, unchanged = task.serialize()
+            old_filepaths = sorted(x for x in task._old_filepaths or ()
+                                   if x != task.filepath)
+            if unchanged and not create and not old_filepaths:
+                continue
+            writes.append({'filepath': task.filepath,
+                           'data': to_unicode(base64.b64encode(data)),
+                           'create': create,
+                           'remove': old_filepaths})
+        response = self.client.request(cmd='apply', writes=writes,
+                                       removals=self._removals)
+        for task, create in self._writes:
+            task._old_filepaths = None
+        self._writes = []
+        self._removals = []
+        return [tuple(x) for x in response['errors']]
+
+
+def connect(cfg):
+    '''Return a :py:class:`Client` if a daemon is running, else ``None``.
+    The daemon only serves tasks stored in the vdir.'''
+    if cfg.get('storage', 'vdir') != 'vdir':
+        return None
+    sockpath = socket_path(cfg)
+    if not os.path.exists(sockpath):
+        return None
+    client = Client(sockpath)
+    if not client.ping():
+        return None
+    return client
+
+
+def _exit(signum, frame):
+    sys.exit(0)
+
+
+def serve(cfg):
+    '''Run a daemon for the configuration ``cfg`` until it is terminated.'''
+    check_directory(cfg['cachepath'])
+    index = TaskIndex.load(os.path.join(cfg['cachepath'], 'index.json'))
+    daemon = Daemon(cfg['path'], socket_path(cfg), index=index)
+    signal.signal(signal.SIGTERM, _exit)
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -11,10 +11,14 @@
 '''
 
 import datetime
+import hashlib
+import heapq
+import itertools
 import os
 
+from . import stats
 from ._compat import text_type, to_unicode
-from .model import ParsingError, Task
+from .model import ParsingError, TaskLocator, TaskRecord
 
 DESCRIPTION_INDENT = u'    '
 DATE_FORMAT = '%Y-%m-%d'
@@ -22,24 +26,51 @@ TIME_FORMAT = '%H:%M'
 DATETIME_FORMAT = DATE_FORMAT + '/' + TIME_FORMAT
 
 
-def _by_deadline(x):
-    x = x.due
-    now = datetime.datetime.now()
-    if isinstance(x, datetime.datetime):
-        return x
-    elif isinstance(x, datetime.date):
-        return datetime.datetime(x.year, x.month, x.day)
-    elif isinstance(x, datetime.time):
-        return datetime.datetime(now.year, now.month, now.day,
-                                 x.hour, x.minute, x.second)
-    else:
-        return datetime.datetime.max
+def deadline_key(now=None):
+    '''Return a sort key for tasks by due date. Tasks that are only due at
+    a time of the day are due today, tasks without a due date come last.'''
+    if now is None:
+        now = datetime.datetime.now()
+
+    def key(task):
+        x = task.due
+        if isinstance(x, datetime.datetime):
+            return x
+        elif isinstance(x, datetime.date):
+            return datetime.datetime(x.year, x.month, x.day)
+        elif isinstance(x, datetime.time):
+            return datetime.datetime(now.year, now.month, now.day,
+                                     x.hour, x.minute, x.second)
+        else:
+            return datetime.datetime.max
+    return key
+
+
+def select_by_deadline(tasks, limit=None, offset=0):
+    '''Return a list of the tasks ordered by due date. With ``limit``, only
+    that many tasks after skipping the first ``offset`` ones are returned,
+    and no more than ``offset + limit`` tasks are kept in memory.'''
+    key = deadline_key()
+    if limit is None:
+        return sorted(tasks, key=key)[offset:]
+    # nsmallest computes the key once per task and is stable
+    return heapq.nsmallest(offset + limit, tasks, key=key)[offset:]
 
 
 def generate_tmpfile(f, tasks, header=u'// watdo',
-                     description_indent=DESCRIPTION_INDENT):
-    '''Given a file-like object ``f`` and a path, write todo file to ``f``,
-    return a ``ids`` object'''
+                     description_indent=DESCRIPTION_INDENT, limit=None,
+                     offset=0, locators=False):
+    '''Given a file-like object ``f`` and an iterable of tasks, write todo
+    file to ``f``, return a ``ids`` object mapping ids to
+    :py:class:`watdo.model.TaskRecord` objects.
+
+    ``limit`` and ``offset`` select a window of the tasks ordered by due
+    date, see :py:func:`select_by_deadline`. Tasks outside of it are not part
+    of ``ids`` and therefore never considered deleted.
+
+    With ``locators``, ``ids`` maps to :py:class:`watdo.model.TaskLocator`
+    objects instead, which have to be replaced with :py:func:`load_records`
+    before calling :py:func:`get_changes`.'''
 
     ids = {}
 
@@ -50,79 +81,187 @@ def generate_tmpfile(f, tasks, header=u'// watdo',
     p(u'\n')
 
     # sort by deadline
-    for i, task in enumerate(sorted(tasks, key=_by_deadline), start=1):
-        ids[i] = task
+    tasks = select_by_deadline(tasks, limit=limit, offset=offset)
+    for i, task in enumerate(tasks, start=1):
+        record = TaskRecord.from_task(task)
+        line, description = format_task(record)
+        p(u'{} id:{}\n'.format(line, i))
+        for l in description:
+            p(description_indent + l)
+            p(u'\n')
 
-        # summary
-        if task.status:
-            p(u'{} '.format(_status_to_alias[text_type(task.status)]))
-        if task.done_date:
-            p(u'{} '.format(_strftime(task.done_date)))
-        p(task.summary)
+        record.fingerprint = _fingerprint(line, u'\n'.join(description))
+        if locators and not record.archived:
+            # archived tasks can't be read again, so they keep their record
+            ids[i] = TaskLocator(record.filepath, record.fingerprint,
+                                 record.etag)
+        else:
+            ids[i] = record
 
-        # due
-        if task.due is not None:
-            p(u' due:{}'.format(_strftime(task.due)))
+    stats.incr('tasks_emitted', len(ids))
+    return ids
 
-        # calendar
-        p(u' @{}'.format(task.calendar))
-        p(u' id:{}\n'.format(i))
 
-        # description
-        for l in task.description.rstrip().splitlines():
-            p(description_indent + l)
-            p(u'\n')
-    return ids
+def format_task(task):
+    '''Return the first line of ``task`` as shown in the editor, without an
+    id, and a list of its description lines.'''
+    line = []
+
+    # summary
+    if task.status:
+        line.append(_status_to_alias[text_type(task.status)])
+    if task.done_date:
+        line.append(_strftime(task.done_date))
+    line.append(task.summary)
+
+    # due
+    if task.due is not None:
+        line.append(u'due:{}'.format(_strftime(task.due)))
+
+    # calendar
+    line.append(u'@{}'.format(task.calendar))
+    return u' '.join(line), task.description.rstrip().splitlines()
 
 
-def parse_summary_header(task_summary):
+def task_to_dict(task):
+    '''Return the properties of ``task`` as a JSON-serializable dict.'''
+    def date(x):
+        return x.isoformat() if x is not None else None
+
+    return {
+        'summary': task.summary,
+        'description': task.description,
+        'status': task.status or u'NEEDS-ACTION',
+        'due': date(task.due),
+        'done_date': date(task.done_date),
+        'calendar': task.calendar,
+        'filepath': task.filepath
+    }
+
+
+def _fingerprint(summary_line, description):
+    '''Hash the text of a task inside the tmpfile, excluding its id.'''
+    x = u'{}\n{}'.format(summary_line, description)
+    return hashlib.sha1(x.encode('utf-8')).digest()
+
+
+def _strip_id(summary_line):
+    '''Remove the id at the end of ``summary_line``, as written by
+    :py:func:`generate_tmpfile`.'''
+    rv, sep, task_id = summary_line.rpartition(u' id:')
+    if sep and task_id.isdigit():
+        return rv
+    return summary_line
+
+
+def parse_summary_header(task_summary, calendar=None):
+    '''Parse the first line of a task into a task id and a
+    :py:class:`watdo.model.TaskRecord`. Every word is looked at once.
+
+    The line may start with a status (or its alias) and, for done tasks, the
+    date they were done. Of the remaining words, the first ones with a
+    prefix of ``due:``, ``@`` and ``id:`` are the due date, calendar and id.
+    Allowed values for the due date are::
+
+        due:YYYY-mm-dd
+        due:YYYY-mm-dd/HH:MM
+        due:HH:mm
+
+    Everything else is the summary. Tasks without a calendar are put into
+    ``calendar``.'''
     flags = task_summary.split()
-    task = Task()
-    task.status = _extract_status(flags)
-    if task.done:
-        task.done_date = _extract_done_date(flags)
-    task.due = _extract_due_date(flags)
-    task.calendar = _extract_calendar(flags)
+    task = TaskRecord()
+    task_id = None
+    summary = []
+    start = 0
+
+    if flags:
+        task.status = parse_status(flags[0])
+        if task.status:
+            start = 1
+    if task.done and start < len(flags):
+        try:
+            task.done_date = parse_date(flags[start])
+        except ValueError:
+            pass
+        else:
+            start += 1
+
+    for flag in itertools.islice(flags, start, None):
+        if task.due is None and flag.startswith(u'due:'):
+            try:
+                task.due = parse_date(flag[4:])
+                continue
+            except ValueError:
+                pass
+        elif task.calendar is None and flag.startswith(u'@'):
+            task.calendar = flag[1:]
+            continue
+        elif task_id is None and flag.startswith(u'id:') and \
+                flag[3:].isdigit():
+            task_id = int(flag[3:])
+            continue
+        summary.append(flag)
+
+    if task.calendar is None:
+        task.calendar = calendar
+    if task.calendar is None:
+        raise ParsingError('All tasks must have a calendar set.')
+    task.summary = u' '.join(summary)
     # ids don't need to be numeric, yay ducktyping!
-    task_id = _extract_id(flags) or task_summary
-    task.summary = u' '.join(flags)
-    return task_id, task
+    return task_id or task_summary, task
 
 
-def parse_tmpfile(lines, description_indent=DESCRIPTION_INDENT):
-    ids = {}
-    task_id = None
-    descriptions = {}
+def iter_tmpfile(lines, description_indent=DESCRIPTION_INDENT,
+                 calendar=None):
+    '''Parse ``lines`` in the format of the tmpfile one task at a time.
+    Yields tuples of the line number, the task's id and its
+    :py:class:`watdo.model.TaskRecord`. ``calendar`` is used for tasks
+    without one.'''
+    task_id = task = summary_line = task_lineno = None
+    description = []
+
+    def finish():
+        task.description = u'\n'.join(description).rstrip()
+        task.fingerprint = _fingerprint(summary_line, task.description)
+        return task_lineno, task_id, task
 
     for lineno, line in enumerate(lines, start=1):
         try:
-            line = to_unicode(line).rstrip(u'\n')
+            line = to_unicode(line).rstrip(u'\r\n')
             if line.startswith(u'//'):
                 pass
             elif line.startswith(description_indent) or not line:
-                if task_id:
+                if task is not None:
                     if line:
                         line = line[len(description_indent):]
-                    descriptions[task_id].append(line)
+                    description.append(line)
             else:
-                task_summary = line
-                task_id, task = parse_summary_header(task_summary)
-
-                if task_id in ids:
-                    raise ParsingError('This list index already has been '
-                                       'used for this calendar')
-                ids[task_id] = task
-                descriptions[task_id] = []
+                if task is not None:
+                    yield finish()
+                task_id, task = parse_summary_header(line, calendar=calendar)
+                task_lineno = lineno
+                summary_line = _strip_id(line)
+                description = []
         except ParsingError as e:
             raise ParsingError('Line {}: {}'.format(lineno, str(e)))
 
-    for task_id, description in descriptions.items():
-        ids[task_id].description = u'\n'.join(description).rstrip()
+    if task is not None:
+        yield finish()
+
 
+def parse_tmpfile(lines, description_indent=DESCRIPTION_INDENT):
+    ids = {}
+    for lineno, task_id, task in iter_tmpfile(lines, description_indent):
+        if task_id in ids:
+            raise ParsingError('Line {}: This list index already has been '
+                               'used for this calendar'.format(lineno))
+        ids[task_id] = task
     return ids
 
 
-def _extract_date(string):
+def parse_date(string):
+    '''Parse a date as written after ``due:``.'''
     now = datetime.datetime.now()
     if string == u'today':
         return now.date()
@@ -140,6 +279,11 @@ def _extract_date(string):
         raise ValueError()
 
 
+def parse_status(alias):
+    '''Return the status for ``alias``, an empty string if there is none.'''
+    return _alias_to_status.get(alias, u'')
+
+
 def _strftime(x):
     '''Format datetime object back to todo.txt. No shortcuts here because that
     would mess with todo.txt syntax highlighting too much.'''
@@ -153,34 +297,6 @@ def _strftime(x):
         raise TypeError()
 
 
-def _extract_due_date(flags):
-    '''Allowed values:
-        due:YYYY-mm-dd
-        due:YYYY-mm-dd/HH:MM
-        due:HH:mm
-    '''
-    for i, flag in enumerate(flags):
-        if flag.startswith('due:'):
-            flag = flag[4:]
-            try:
-                rv = _extract_date(flag)
-            except ValueError:
-                pass
-            else:
-                del flags[i]
-                return rv
-
-
-def _extract_done_date(flags):
-    try:
-        x = _extract_date(flags[0])
-    except ValueError:
-        return None
-    else:
-        del flags[0]
-        return x
-
-
 def _compile_status_table():
     statuses = [
         (u'COMPLETED', u'x'),
@@ -202,30 +318,9 @@ _status_to_alias, _alias_to_status = _compile_status_table()
 del _compile_status_table
 
 
-def _extract_status(flags):
-    x = _alias_to_status.get(flags[0], u'')
-    if x:
-        del flags[0]
-    return x
-
-
-def _extract_calendar(flags):
-    for i, flag in enumerate(flags):
-        if flag.startswith(u'@'):
-            del flags[i]
-            return flag[1:]
-    raise ParsingError('All tasks must have a calendar set.')
-
-
-def _extract_id(flags):
-    for i, flag in enumerate(flags):
-        if flag.startswith(u'id:'):
-            del flags[i]
-            return int(flag[3:])
-
-
 def diff_calendars(ids_a, ids_b):
-    '''Get difference between two ``ids`` objects'''
+    '''Get difference between two ``ids`` objects. Tasks whose text in the
+    tmpfile didn't change are not compared.'''
     task_ids = set(ids_a).union(ids_b)
     for task_id in task_ids:
         if task_id not in ids_a and task_id in ids_b:
@@ -236,24 +331,32 @@ def diff_calendars(ids_a, ids_b):
             ev_a = ids_a[task_id]
             ev_b = ids_b[task_id]
 
+            if ev_a.fingerprint is not None and \
+               ev_a.fingerprint == ev_b.fingerprint:
+                continue
             if ev_a != ev_b:
                 yield 'mod', task_id
 
 
+def load_records(old_ids, new_ids, read):
+    '''Replace the :py:class:`watdo.model.TaskLocator` objects in
+    ``old_ids`` with records, but only for the tasks that were changed or
+    removed in the editor. ``read`` returns the current content of a task's
+    file, see :py:meth:`watdo.storage.VdirStorage.read`.'''
+    for task_id, old_task in list(old_ids.items()):
+        if isinstance(old_task, TaskRecord):
+            continue
+        new_task = new_ids.get(task_id)
+        if new_task is not None and \
+           new_task.fingerprint == old_task.fingerprint:
+            continue
+        old_ids[task_id] = old_task.to_record(read(old_task.filepath))
+
+
 def get_changes(old_ids, new_ids):
     for method, task_id in diff_calendars(old_ids, new_ids):
         if method == 'mod':
-            old_task = old_ids[task_id]
-            new_task = new_ids[task_id]
-
-            description = u'Modify: '
-            if old_task.summary == new_task.summary:
-                description += new_task.summary
-            else:
-                description += u'{} => {}'.format(old_task.summary,
-                                                  new_task.summary)
-
-            yield description, _change_modify(old_task, new_task)
+            yield get_modify_change(old_ids[task_id], new_ids[task_id])
         elif method == 'add':
             new_task = new_ids[task_id]
             yield (u'Add: {}'.format(new_task.summary),
@@ -267,24 +370,62 @@ def get_changes(old_ids, new_ids):
             raise ParsingError('Unknown method: {}'.format(method))
 
 
+def update_record(record, **properties):
+    '''Return a copy of the :py:class:`watdo.model.TaskRecord` ``record``
+    with ``properties`` such as ``status``, ``due`` or ``calendar`` replaced.
+    Like in the editor, tasks that are no longer done lose their done
+    date.'''
+    rv = TaskRecord(summary=record.summary, due=record.due,
+                    status=record.status, done_date=record.done_date,
+                    description=record.description, calendar=record.calendar,
+                    filepath=record.filepath, etag=record.etag,
+                    archived=record.archived)
+    for name, value in properties.items():
+        setattr(rv, name, value)
+    if not rv.done:
+        rv.done_date = None
+    return rv
+
+
+def get_modify_change(old_task, new_task):
+    '''Return the description and function of the change that turns the
+    :py:class:`watdo.model.TaskRecord` ``old_task`` into ``new_task``, as
+    yielded by :py:func:`get_changes`.'''
+    description = u'Modify: '
+    if old_task.summary == new_task.summary:
+        description += new_task.summary
+    else:
+        description += u'{} => {}'.format(old_task.summary,
+                                          new_task.summary)
+    return description, _change_modify(old_task, new_task)
+
+
 def _change_modify(old_task, new_task):
-    def inner(cfg):
-        old_task.update(new_task)
-        old_task.bump()
-        old_task.write()
+    def inner(cfg, batch=None):
+        task = old_task.load() if batch is None else batch.load(old_task)
+        if task.update(new_task):
+            task.bump()
+        task.write(batch=batch)
     return inner
 
 
-def _change_add(task):
-    def inner(cfg):
+def _change_add(new_task):
+    def inner(cfg, batch=None):
+        task = new_task.to_task()
         task.basepath = cfg['path']
-        task.write(create=True)
+        task.write(create=True, batch=batch)
 
     return inner
 
 
 def _change_delete(task):
-    def inner(cfg):
-        if task.filepath is not None:
+    def inner(cfg, batch=None):
+        if task.filepath is None:
+            return
+        if batch is not None:
+            batch.check(task)
+            batch.remove(task.filepath)
+        else:
+            task.check()
             os.remove(task.filepath)
     return inner
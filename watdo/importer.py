@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+'''
+    watdo.importer
+    ~~~~~~~~~~~~~~
+
+    This module creates tasks in bulk from todo.txt files or files in the
+    format of the editor.
+
+    Each imported task gets a UID derived from its content, so tasks that
+    already exist in the vdir are skipped. This makes it safe to run an
+    interrupted import again.
+
+    :copyright: (c) 2014 Markus Unterwaditzer
+    :license: MIT, see LICENSE for more details.
+'''
+
+import hashlib
+import os
+
+from . import editor, model, stats
+from .exceptions import CliError
+
+#: number of tasks written at once
+BATCH_SIZE = 1000
+
+
+def import_uid(record, occurrence=0):
+    '''Return the UID of the task created for the
+    :py:class:`watdo.model.TaskRecord` ``record``, as yielded by
+    :py:func:`watdo.editor.iter_tmpfile`. ``occurrence`` counts the earlier
+    tasks with the same text in the same source.
+
+    The UID is derived from the text the task was read from, not the parsed
+    values, so dates like ``due:tomorrow`` give the same UID every day.'''
+    x = b'\n'.join((record.calendar.encode('utf-8'), record.fingerprint,
+                    str(occurrence).encode('ascii')))
+    return u'{}@watdo-import'.format(hashlib.sha1(x).hexdigest())
+
+
+class Importer(object):
+    '''Creates a task file for each task read by :py:meth:`feed`.
+
+    :param path: the vdir.
+    :param uids: the UIDs of all tasks inside ``path``.
+    :param calendar: the calendar for tasks without one.
+    :param progress: called with the importer after each batch.
+    :param batch: the batch to write tasks with, a
+        :py:class:`watdo.model.WriteBatch` by default.
+    '''
+
+    def __init__(self, path, uids=(), calendar=None, batch_size=BATCH_SIZE,
+                 progress=None, batch=None):
+        self.path = path
+        self.uids = set(uids)
+        self.calendar = calendar
+        self.batch_size = batch_size
+        self.progress = progress
+        self.batch = model.WriteBatch() if batch is None else batch
+        self.imported = 0
+        self.skipped = 0
+        #: how often each task text was seen, see :py:func:`import_uid`
+        self._seen = {}
+        #: list of ``(filepath, error)`` for failed writes
+        self.errors = []
+
+    def feed(self, lines):
+        '''Import all tasks in ``lines``. Raises
+        :py:exc:`watdo.model.ParsingError` at the first line that can't be
+        parsed, after committing the tasks before it.'''
+        try:
+            for lineno, task_id, record in editor.iter_tmpfile(
+                    lines, calendar=self.calendar):
+                self.add(record)
+        finally:
+            self.flush()
+
+    def add(self, record):
+        key = (record.calendar, record.fingerprint)
+        occurrence = self._seen.get(key, 0)
+        self._seen[key] = occurrence + 1
+        uid = import_uid(record, occurrence)
+        if uid in self.uids:
+            self.skipped += 1
+            return
+        self.uids.add(uid)
+
+        dirpath = os.path.join(self.path, record.calendar)
+        if dirpath not in self.batch.directories:
+            if not os.path.isdir(dirpath):
+                raise CliError('Calendars are not explicitly created. '
+                               'Please create the directory {} yourself.'
+                               .format(dirpath))
+            self.batch.directories.add(dirpath)
+
+        data = model.render_vtodo(uid, summary=record.summary,
+                                  description=record.description,
+                                  status=record.status, due=record.due,
+                                  done_date=record.done_date)
+        self.batch.write_raw(os.path.join(dirpath, uid + u'.ics'), data,
+                             create=True)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        '''Write all queued tasks.'''
+        if not len(self.batch):
+            return
+        n = len(self.batch)
+        errors = self.batch.commit()
+        self.errors.extend(errors)
+        self.imported += n - len(errors)
+        stats.incr('tasks_imported', n - len(errors))
+        if self.progress is not None:
+            self.progress(self)
@@ -6,18 +6,22 @@
     This module provides datastructures to represent and helper functions to
     access data on the filesystem.
 
+    icalendar and other heavy dependencies are imported where they are used,
+    since most runs never need them.
+
     :copyright: (c) 2013 Markus Unterwaditzer
     :license: MIT, see LICENSE for more details.
 '''
 import datetime
+import errno
 import os
+import re
+import tempfile
+import time
+from calendar import timegm
 
-from atomicwrites import atomic_write
-
-import icalendar
-import icalendar.tools
-
-from ._compat import string_types, to_unicode
+from . import stats
+from ._compat import imap, scandir, string_types, to_unicode, utc
 from .exceptions import CliError
 
 
@@ -40,6 +44,28 @@ class Task(object):
     #: the VTODO object inside self._vcal (exposed through self.main)
     _main = None
 
+    #: the VTODO properties extracted without parsing the file (see
+    #: :py:func:`scan_vtodo`). While set, the file is only parsed when the
+    #: task is modified.
+    _fields = None
+
+    #: the ``os.stat_result`` of the task's file, if it was read from disk
+    stat = None
+
+    #: the :py:func:`file_etag` of the task's file when it was read
+    etag = None
+
+    #: whether the task was read from the archive (see
+    #: :py:class:`watdo.archive.Archive`) and therefore can't be modified
+    archived = False
+
+    #: the content of the task's file as it was read. On write, only the
+    #: properties in ``_changed`` are replaced inside of it.
+    _raw = None
+
+    #: names of the properties that were set since the task was read
+    _changed = None
+
     def __init__(self, **kwargs):
         for k, v in kwargs.items():  # meh
             setattr(self, k, v)
@@ -62,14 +88,25 @@ class Task(object):
     def vcal(self):
         '''full file content, parsed (VCALENDAR)'''
         if self._vcal is None:
-            self._vcal = dummy_vcal()
+            if self._fields is not None and self.filepath is not None:
+                with open(self.filepath, 'rb') as f:
+                    self.vcal = f.read()
+            else:
+                self._vcal = dummy_vcal()
         return self._vcal
 
     @vcal.setter
     def vcal(self, val):
+        self._raw = None
         if isinstance(val, string_types):
+            import icalendar
+            if isinstance(val, bytes):
+                self._raw = val
             val = icalendar.Calendar.from_ical(val)
         self._vcal = val
+        self._main = None
+        self._fields = None
+        self._changed = set()
 
     @property
     def main(self):
@@ -85,7 +122,65 @@ class Task(object):
     def main(self, val):
         self._main = val
 
-    def write(self, create=False):
+    def write(self, create=False, batch=None):
+        '''Write the task to its file. If a :py:class:`WriteBatch` is given,
+        the write is only queued.
+
+        If the content of a task read from disk didn't change, the file is
+        only renamed if the task was moved, or not touched at all.'''
+        self._prepare_write(create, batch)
+        if batch is not None:
+            batch.write(self, create=create)
+            return
+        with stats.timer('Task.write'):
+            data, unchanged = self.serialize()
+            if unchanged and not create and \
+               _move_unchanged(self.filepath, self._old_filepaths) \
+               is not None:
+                self._old_filepaths = None
+                return
+            from atomicwrites import atomic_write
+            with atomic_write(self.filepath, mode='wb',
+                              overwrite=not create) as f:
+                f.write(data)
+            while self._old_filepaths:
+                os.remove(self._old_filepaths.pop())
+        stats.incr('files_written')
+
+    def serialize(self):
+        '''Return the content of the task's file, and whether it is the same
+        as when the task was read.
+
+        For tasks that were read from disk, only the changed properties are
+        replaced (see :py:func:`patch_vtodo`), everything else is kept byte
+        for byte.'''
+        vcal = self.vcal  # loads tasks that were only scanned
+        if self._raw is None:
+            return vcal.to_ical(), False
+        if not self._changed:
+            return self._raw, True
+        main = self.main
+        properties = {}
+        for name in self._changed:
+            name = name.upper()
+            values = main.get(name)
+            if values is None:
+                values = []
+            elif not isinstance(values, list):
+                values = [values]
+            properties[name.encode('ascii')] = [
+                main.content_line(name, value, sorted=True).to_ical()
+                for value in values
+            ]
+        data = patch_vtodo(self._raw, properties)
+        return data, data == self._raw
+
+    def _touch(self, name):
+        if self._changed is None:
+            self._changed = set()
+        self._changed.add(name)
+
+    def _prepare_write(self, create, batch=None):
         if self.filename is None:
             if not create:
                 raise ValueError('Create arg must be true '
@@ -94,35 +189,71 @@ class Task(object):
             if self.filepath is None:
                 raise ValueError('basepath and calendar must be set.')
         calendar_path = os.path.join(self.basepath, self.calendar)
+        if batch is not None and calendar_path in batch.directories:
+            return
         if not os.path.exists(calendar_path):
             raise CliError('Calendars are not explicitly created. '
                            'Please create the directory {} yourself.'
                            .format(calendar_path))
-        with atomic_write(self.filepath, mode='wb', overwrite=not create) as f:
-            f.write(self.vcal.to_ical())
-        while self._old_filepaths:
-            os.remove(self._old_filepaths.pop())
+        if batch is not None:
+            batch.directories.add(calendar_path)
 
     def random_filename(self):
         self.filename = self.main['uid'] + u'.ics'
 
     def update(self, other):
-        self.due = other.due
-        self.summary = other.summary
-        self.description = other.description
-        self.status = other.status
-        self.calendar = other.calendar
+        '''Copy the properties shown in the editor from ``other``. Only
+        properties that differ are set. If the calendar differs, the task is
+        moved. Tasks that become done without a done date are marked as done
+        now. Returns whether any property other than the calendar
+        changed.'''
+        changed = False
+        done_date = other.done_date
+        if other.done and not self.done and done_date is None:
+            done_date = datetime.datetime.now().replace(microsecond=0)
+        for name in ('summary', 'description'):
+            value = getattr(other, name)
+            if getattr(self, name).rstrip(u'\n') != value.rstrip(u'\n'):
+                setattr(self, name, value)
+                changed = True
+        if self.status != other.status:
+            self.status = other.status
+            changed = True
+        # the editor shows dates only to the minute, so seconds are kept
+        for name, value in (('due', other.due), ('done_date', done_date)):
+            if not _same_date(getattr(self, name), value):
+                setattr(self, name, value)
+                changed = True
+
+        if other.calendar != self.calendar:
+            if self.filepath is None:
+                self.calendar = other.calendar
+            else:
+                self.filepath = os.path.join(self.basepath, other.calendar,
+                                             self.filename)
+        return changed
 
     def bump(self):
         self.main.pop('last-modified', None)
         self.main.add('last-modified', datetime.datetime.now())
+        self._touch('last-modified')
 
-    @property
-    def due(self):
-        dt = self.main.get('due', None)
+    def _get(self, name, default=None):
+        if self._fields is not None:
+            return self._fields.get(name, default)
+        return self.main.get(name, default)
+
+    def _get_date(self, name):
+        if self._fields is not None:
+            return _decode_date(self._fields.get(name, None))
+        dt = self.main.get(name, None)
         if dt is None:
             return None
-        dt = dt.dt
+        return dt.dt
+
+    @property
+    def due(self):
+        dt = self._get_date('due')
         if isinstance(dt, datetime.datetime):
             dt = dt.replace(tzinfo=None)
         return dt
@@ -130,18 +261,24 @@ class Task(object):
     @due.setter
     def due(self, dt):
         self.main.pop('due', None)
+        self._touch('due')
         if dt is not None:
             if isinstance(dt, string_types):
                 dt = to_unicode(dt)
             self.main.add('due', dt)
 
+    @property
+    def uid(self):
+        return self._get('uid')
+
     @property
     def summary(self):
-        return self.main.get('summary', u'')
+        return self._get('summary', u'')
 
     @summary.setter
     def summary(self, val):
         self.main.pop('summary', None)
+        self._touch('summary')
         if val:
             self.main['summary'] = to_unicode(val)
 
@@ -151,37 +288,50 @@ class Task(object):
 
     @property
     def done_date(self):
-        dt = self.main.get('completed', None)
-        if dt is None:
-            return None
-        return dt.dt
+        # COMPLETED is stored in UTC, but shown in local time
+        dt = self._get_date('completed')
+        if not isinstance(dt, datetime.datetime):
+            return dt
+        if self._fields is not None:
+            if self._fields['completed'].endswith(u'Z'):
+                dt = _to_local(dt)
+        elif dt.tzinfo is not None:
+            dt = _to_local(dt)
+        return dt
 
     @done_date.setter
     def done_date(self, dt):
         self.main.pop('completed', None)
+        self._touch('completed')
         if dt is not None:
             if isinstance(dt, string_types):
                 dt = to_unicode(dt)
+            elif isinstance(dt, datetime.datetime):
+                dt = _to_utc(dt).replace(tzinfo=utc)
             self.main.add('completed', dt)
+            # UTC is written as ...Z, some icalendar versions add a TZID
+            self.main['completed'].params.pop('TZID', None)
 
     @property
     def description(self):
-        return self.main.get('description', u'')
+        return self._get('description', u'')
 
     @description.setter
     def description(self, val):
         self.main.pop('description', None)
+        self._touch('description')
         if val:
             self.main['description'] = to_unicode(val)
 
     @property
     def status(self):
-        x = self.main.get('status', u'NEEDS-ACTION')
+        x = self._get('status', u'NEEDS-ACTION')
         return x if x != u'NEEDS-ACTION' else u''
 
     @status.setter
     def status(self, val):
         self.main.pop('status', None)
+        self._touch('status')
         if val:
             self.main['status'] = to_unicode(val)
 
@@ -189,13 +339,7 @@ class Task(object):
         return 0 if self.__eq__(x) else -1
 
     def __eq__(self, other):
-        return all((
-            isinstance(other, type(self)),
-            self.summary.rstrip(u'\n') == other.summary.rstrip(u'\n'),
-            self.description.rstrip(u'\n') == other.description.rstrip(u'\n'),
-            self.due == other.due,
-            self.status == other.status
-        ))
+        return isinstance(other, type(self)) and _same_content(self, other)
 
     def __repr__(self):
         return 'watdo.model.Task({})'.format({
@@ -206,7 +350,155 @@ class Task(object):
         })
 
 
+class TaskLocator(object):
+    '''Where to find a task shown in the editor, and the fingerprint of how
+    it was shown (see :py:func:`watdo.editor.generate_tmpfile`).
+
+    Low-memory editor sessions keep only locators, which are turned into
+    :py:class:`TaskRecord` objects with :py:meth:`to_record` if the task was
+    changed in the editor.'''
+
+    __slots__ = ('filepath', 'fingerprint', 'etag', 'archived')
+
+    def __init__(self, filepath=None, fingerprint=None, etag=None,
+                 archived=False):
+        self.filepath = filepath
+        self.fingerprint = fingerprint
+        self.etag = etag
+        self.archived = archived
+
+    def load(self):
+        '''Read the task. Raises :py:exc:`ConflictError` if its file was
+        changed or removed since it was shown.'''
+        self._check_archived()
+        try:
+            f = open(self.filepath, 'rb')
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            raise ConflictError(u'{} was removed.'.format(self.filepath))
+        with f:
+            self._check_etag(os.fstat(f.fileno()))
+            return Task(filepath=self.filepath, vcal=f.read(),
+                        etag=self.etag)
+
+    def check(self):
+        '''Raise :py:exc:`ConflictError` if the task's file was changed or
+        removed since it was shown.'''
+        self._check_archived()
+        if self.etag is None:
+            return
+        try:
+            st = os.stat(self.filepath)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            raise ConflictError(u'{} was removed.'.format(self.filepath))
+        self._check_etag(st)
+
+    def _check_archived(self):
+        if self.archived:
+            raise ConflictError(u'{} is archived and can\'t be changed.'
+                                .format(self.filepath))
+
+    def _check_etag(self, st):
+        if self.etag is not None and file_etag(st) != tuple(self.etag):
+            raise ConflictError(u'{} was changed by another program.'
+                                .format(self.filepath))
+
+    def to_record(self, data):
+        '''Return a :py:class:`TaskRecord` with the properties found in the
+        current content ``data`` of the task's file, ``None`` if it is gone.
+        The record keeps the etag of this locator, so changes to the file are
+        still detected as conflicts.'''
+        fields = None
+        if data is not None:
+            try:
+                fields = scan_vtodo(data)
+            except ValueError:
+                pass
+        stats.incr('records_loaded')
+        rv = TaskRecord.from_task(Task(filepath=self.filepath,
+                                       _fields=fields or {}))
+        rv.fingerprint = self.fingerprint
+        rv.etag = self.etag
+        return rv
+
+
+class TaskRecord(TaskLocator):
+    '''A compact, plain copy of the task properties shown in the editor.
+
+    Records are what the editor works with. Full :py:class:`Task` objects are
+    only created for records that are actually added or modified.'''
+
+    __slots__ = ('summary', 'due', 'status', 'done_date', 'description',
+                 'calendar')
+
+    def __init__(self, summary=u'', due=None, status=u'', done_date=None,
+                 description=u'', calendar=None, filepath=None,
+                 fingerprint=None, etag=None, archived=False):
+        TaskLocator.__init__(self, filepath=filepath, fingerprint=fingerprint,
+                             etag=etag, archived=archived)
+        self.summary = summary
+        self.due = due
+        self.status = status
+        self.done_date = done_date
+        self.description = description
+        self.calendar = calendar
+
+    @classmethod
+    def from_task(cls, task):
+        return cls(summary=task.summary, due=task.due, status=task.status,
+                   done_date=task.done_date, description=task.description,
+                   calendar=task.calendar, filepath=task.filepath,
+                   etag=task.etag, archived=task.archived)
+
+    @property
+    def done(self):
+        return self.status in (u'COMPLETED', u'CANCELLED')
+
+    def to_task(self):
+        '''Create a new task with the properties of this record.'''
+        task = Task(calendar=self.calendar)
+        task.summary = self.summary
+        task.description = self.description
+        task.status = self.status
+        task.done_date = self.done_date
+        task.due = self.due
+        return task
+
+    def __eq__(self, other):
+        return isinstance(other, TaskRecord) and \
+            _same_content(self, other) and \
+            self.calendar == other.calendar and \
+            _same_date(self.done_date, other.done_date)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return 'watdo.model.TaskRecord({})'.format({
+            'description': self.description,
+            'summary': self.summary,
+            'due': self.due,
+            'status': self.status,
+            'calendar': self.calendar
+        })
+
+
+def _same_content(a, b):
+    return all((
+        a.summary.rstrip(u'\n') == b.summary.rstrip(u'\n'),
+        a.description.rstrip(u'\n') == b.description.rstrip(u'\n'),
+        _same_date(a.due, b.due),
+        a.status == b.status
+    ))
+
+
 def dummy_vcal():
+    import icalendar
+    import icalendar.tools
+
     cal = icalendar.Calendar()
     cal.add('prodid', '-//watdo//mimedir.icalendar//EN')
     cal.add('version', '2.0')
@@ -222,29 +514,616 @@ class ParsingError(ValueError):
     pass
 
 
-def walk_calendar(dirpath):
-    for filename in os.listdir(dirpath):
-        filepath = os.path.join(dirpath, filename)
-        if not os.path.isfile(filepath) or not filepath.endswith('.ics'):
-            continue
+class ConflictError(Exception):
+    '''A task can't be changed, because its file was changed by another
+    program or the task is archived.'''
+
+
+def _escape_text(value):
+    return (value.replace(u'\\', u'\\\\').replace(u';', u'\\;')
+            .replace(u',', u'\\,').replace(u'\r\n', u'\\n')
+            .replace(u'\n', u'\\n'))
+
+
+def _fold_line(line):
+    '''Fold the bytestring ``line`` like icalendar does, to 74 octets plus
+    the leading space per line, without splitting UTF-8 sequences.'''
+    rv = []
+    while len(line) > 74:
+        i = 74
+        while (ord(line[i:i + 1]) & 0xC0) == 0x80:
+            i -= 1
+        rv.append(line[:i])
+        line = line[i:]
+    rv.append(line)
+    return b'\r\n '.join(rv) + b'\r\n'
+
+
+def _encode_date(name, value):
+    if isinstance(value, datetime.datetime):
+        return u'{};VALUE=DATE-TIME:{}'.format(
+            name, value.strftime('%Y%m%dT%H%M%S'))
+    elif isinstance(value, datetime.date):
+        return u'{};VALUE=DATE:{}'.format(name, value.strftime('%Y%m%d'))
+    return u'{};VALUE=TIME:{}'.format(name, value.strftime('%H%M%S'))
+
+
+def render_vtodo(uid, summary=u'', description=u'', status=u'', due=None,
+                 done_date=None):
+    '''Return the content of a new task file without building icalendar
+    objects. The result is the same as the one of :py:meth:`Task.write`.'''
+    properties = [u'UID:' + _escape_text(uid)]
+    if summary:
+        properties.append(u'SUMMARY:' + _escape_text(summary))
+    if description:
+        properties.append(u'DESCRIPTION:' + _escape_text(description))
+    if status:
+        properties.append(u'STATUS:' + _escape_text(status))
+    if due is not None:
+        properties.append(_encode_date(u'DUE', due))
+    if isinstance(done_date, datetime.datetime):
+        properties.append(u'COMPLETED;VALUE=DATE-TIME:' +
+                          _to_utc(done_date).strftime('%Y%m%dT%H%M%SZ'))
+    elif done_date is not None:
+        properties.append(_encode_date(u'COMPLETED', done_date))
+    properties.sort(key=lambda x: x.split(u':', 1)[0].split(u';', 1)[0])
+
+    return b''.join(_fold_line(line.encode('utf-8')) for line in [
+        u'BEGIN:VCALENDAR', u'VERSION:2.0',
+        u'PRODID:-//watdo//mimedir.icalendar//EN', u'BEGIN:VTODO'
+    ] + properties + [u'END:VTODO', u'END:VCALENDAR'])
+
+
+class WriteBatch(object):
+    '''Collects writes and removals of task files to commit them at once.
+
+    On commit, tasks are serialized and written by a pool of threads. Every
+    file is still replaced atomically, but each affected directory is only
+    fsynced once.'''
+
+    def __init__(self, threads=4):
+        self.threads = threads
+        #: calendar directories known to exist
+        self.directories = set()
+        self._writes = []
+        self._removals = []
+
+    def write(self, task, create=False):
+        if task._old_filepaths is None:
+            task._old_filepaths = set()
+        self._writes.append((task.filepath, task, create,
+                             task._old_filepaths))
+
+    def write_raw(self, filepath, data, create=False, old_filepaths=()):
+        '''Queue writing the bytestring ``data`` to ``filepath``, and removing
+        ``old_filepaths`` afterwards.'''
+        self._writes.append((filepath, data, create, list(old_filepaths)))
+
+    def remove(self, filepath):
+        self._removals.append(filepath)
+
+    def load(self, record):
+        '''Read the task ``record`` was created from, see
+        :py:meth:`TaskRecord.load`.'''
+        return record.load()
+
+    def check(self, record):
+        '''See :py:meth:`TaskRecord.check`.'''
+        record.check()
+
+    def __len__(self):
+        return len(self._writes) + len(self._removals)
 
-        with open(filepath, 'rb') as f:
-            vcal = f.read()
+    def commit(self):
+        '''Apply all queued changes. Returns a list of ``(filepath, error)``
+        for the changes that failed.'''
+        writes = sorted(self._writes, key=lambda x: x[0])
+        removals = self._removals
+        self._writes = []
+        self._removals = []
 
+        with stats.timer('WriteBatch.commit'):
+            return self._commit(writes, removals)
+
+    def _commit(self, writes, removals):
+        results = []
+        if writes:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(min(self.threads, len(writes)))
+            try:
+                results = pool.map(_write_task, writes)
+            finally:
+                pool.close()
+                pool.join()
+
+        errors = []
+        synced = set()
+        for (filepath, _, _, old_filepaths), (moved, error) in \
+                zip(writes, results):
+            if error is not None:
+                errors.append((filepath, error))
+                continue
+            if moved is not None:
+                synced.update(os.path.dirname(x) for x in moved)
+                while old_filepaths:
+                    old_filepaths.pop()
+                continue
+            stats.incr('files_written')
+            synced.add(os.path.dirname(filepath))
+            while old_filepaths:
+                removals.append(old_filepaths.pop())
+
+        for filepath in removals:
+            try:
+                os.remove(filepath)
+            except OSError as e:
+                errors.append((filepath, e))
+            else:
+                stats.incr('files_removed')
+                synced.add(os.path.dirname(filepath))
+
+        for dirpath in sorted(synced):
+            _sync_directory(dirpath)
+        return errors
+
+
+def _write_task(job):
+    '''Returns the paths that were renamed instead of writing the file, if
+    any, and the error that occured.'''
+    filepath, data, create, old_filepaths = job
+    try:
+        if isinstance(data, Task):
+            data, unchanged = data.serialize()
+            if unchanged and not create:
+                moved = _move_unchanged(filepath, old_filepaths)
+                if moved is not None:
+                    return moved, None
+        _write_file(filepath, data, overwrite=not create)
+    except (IOError, OSError, ValueError) as e:
+        return None, e
+    return None, None
+
+
+def _move_unchanged(filepath, old_filepaths):
+    '''Handle the write of a task whose content didn't change. If it was
+    moved from exactly one other path, the file is renamed, otherwise nothing
+    needs to be done. Returns the renamed paths, or ``None`` if the file has
+    to be written after all.'''
+    old_filepaths = [x for x in old_filepaths or () if x != filepath]
+    if not old_filepaths:
+        stats.incr('writes_skipped')
+        return ()
+    if len(old_filepaths) > 1:
+        return None
+    old_filepath, = old_filepaths
+    if os.path.exists(filepath):
+        raise OSError(errno.EEXIST, os.strerror(errno.EEXIST), filepath)
+    os.rename(old_filepath, filepath)
+    stats.incr('files_renamed')
+    return (old_filepath, filepath)
+
+
+def _write_file(filepath, data, overwrite=False):
+    '''Atomically write ``data`` to ``filepath``, without syncing the
+    directory.'''
+    dirpath, filename = os.path.split(filepath)
+    fd, tmp = tempfile.mkstemp(prefix='.' + filename, suffix='.tmp',
+                               dir=dirpath)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        if overwrite:
+            os.rename(tmp, filepath)
+        else:
+            # fails if filepath exists
+            os.link(tmp, filepath)
+    finally:
         try:
-            task = Task(vcal=vcal, filepath=filepath)
-        except Exception as e:
-            print('Error happened during parsing {}: {}'
-                  .format(filepath, str(e)))
+            os.remove(tmp)
+        except OSError:
+            pass
+
+
+def _sync_directory(dirpath):
+    if os.name != 'posix':
+        return
+    fd = os.open(dirpath, 0)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+#: The VTODO properties kept by :py:func:`scan_vtodo`.
+FIELDS = ('uid', 'summary', 'description', 'status', 'due', 'completed')
+_DATE_FIELDS = ('due', 'completed')
+_SCANNED_PROPERTIES = dict((name.upper().encode('ascii'), name)
+                           for name in FIELDS)
+
+_TEXT_ESCAPES = {u'n': u'\n', u'N': u'\n', u',': u',', u';': u';',
+                 u'\\': u'\\'}
+_text_escape_re = re.compile(r'\\(.)')
+
+
+def unfold_lines(lines):
+    '''Join folded content lines (RFC 5545, section 3.1). ``lines`` is an
+    iterable of bytestrings.'''
+    buf = None
+    for line in lines:
+        line = line.rstrip(b'\r\n')
+        if buf is not None and line[:1] in (b' ', b'\t'):
+            buf.append(line[1:])
+            continue
+        if buf is not None:
+            yield b''.join(buf)
+        buf = [line]
+    if buf is not None:
+        yield b''.join(buf)
+
+
+def _split_contentline(line):
+    '''Return name and value of a content line, ignoring parameters.'''
+    colon = line.find(b':')
+    if colon < 0:
+        raise ParsingError('Invalid content line: {!r}'.format(line))
+    semicolon = line.find(b';', 0, colon)
+    if semicolon < 0:
+        return line[:colon], line[colon + 1:]
+
+    if line.find(b'"', semicolon, colon) >= 0:
+        # parameter values may contain colons if quoted
+        in_quotes = False
+        for i in range(semicolon, len(line)):
+            c = line[i:i + 1]
+            if c == b'"':
+                in_quotes = not in_quotes
+            elif c == b':' and not in_quotes:
+                colon = i
+                break
         else:
-            if task.main is not None:
-                yield task
+            raise ParsingError('Invalid content line: {!r}'.format(line))
+    return line[:semicolon], line[colon + 1:]
+
+
+def _unescape_text(value):
+    if u'\\' not in value:
+        return value
+    return _text_escape_re.sub(
+        lambda m: _TEXT_ESCAPES.get(m.group(1), m.group(0)), value)
+
+
+def scan_vtodo(raw):
+    '''Extract the properties watdo displays from the first VTODO inside the
+    raw file content ``raw``, without building any icalendar objects.
+
+    Returns a dict mapping the names in :py:data:`FIELDS` to strings, or
+    ``None`` if there is no VTODO. Dates are kept in their iCalendar
+    representation, see :py:func:`_decode_date`. Raises
+    :py:exc:`ParsingError` for files that are structurally broken.'''
+    stack = []
+    fields = None
+    depth = None
+
+    for line in unfold_lines(raw.split(b'\n')):
+        if not line:
+            continue
+        name, value = _split_contentline(line)
+        name = name.upper()
+
+        if name == b'BEGIN':
+            stack.append(value.upper())
+            if fields is None and stack[-1] == b'VTODO':
+                fields = {}
+                depth = len(stack)
+        elif name == b'END':
+            if not stack or stack.pop() != value.upper():
+                raise ParsingError('Unexpected END:{}'
+                                   .format(to_unicode(value)))
+            if depth is not None and len(stack) < depth:
+                depth = None
+        elif depth == len(stack):
+            key = _SCANNED_PROPERTIES.get(name)
+            if key is None or key in fields:
+                continue
+            value = to_unicode(value)
+            if key in _DATE_FIELDS:
+                _decode_date(value)
+            else:
+                value = _unescape_text(value)
+            fields[key] = value
+
+    if stack:
+        raise ParsingError('Unexpected end of file inside {}'
+                           .format(to_unicode(stack[-1])))
+    return fields
+
+
+def _group_folded_lines(raw):
+    '''Yield each unfolded content line of ``raw`` together with the exact
+    bytes it was made of.'''
+    chunk = []
+    for line in raw.splitlines(True):
+        if chunk and line[:1] not in (b' ', b'\t'):
+            yield b''.join(unfold_lines(chunk)), b''.join(chunk)
+            chunk = []
+        chunk.append(line)
+    if chunk:
+        yield b''.join(unfold_lines(chunk)), b''.join(chunk)
+
+
+def patch_vtodo(raw, properties):
+    '''Replace properties of the first VTODO inside the raw file content
+    ``raw`` and keep everything else byte for byte.
+
+    ``properties`` maps uppercase property names to lists of serialized
+    content lines. The first occurrence of each property is replaced by
+    them, other occurrences are removed, and missing properties are added
+    after the other properties of the VTODO, before nested components such
+    as VALARMs. An empty list removes the property.'''
+    newline = b'\r\n' if b'\r\n' in raw else b'\n'
+    pending = dict(properties)
+    stack = []
+    depth = None
+    done = False
+    rv = []
+
+    def serialize(lines):
+        return b''.join(line.replace(b'\r\n', newline) + newline
+                        for line in lines)
+
+    def add_missing():
+        for key in sorted(pending):
+            rv.append(serialize(pending.pop(key)))
+
+    for line, chunk in _group_folded_lines(raw):
+        if done or not line:
+            rv.append(chunk)
+            continue
+        name, value = _split_contentline(line)
+        name = name.upper()
+
+        if name == b'BEGIN':
+            if depth == len(stack):
+                add_missing()
+            stack.append(value.upper())
+            if stack[-1] == b'VTODO' and depth is None:
+                depth = len(stack)
+        elif name == b'END':
+            if depth == len(stack):
+                add_missing()
+                done = True
+            if stack:
+                stack.pop()
+        elif depth == len(stack) and name in properties:
+            if name in pending:
+                rv.append(serialize(pending.pop(name)))
+            continue
+        rv.append(chunk)
+
+    if not done:
+        raise ParsingError('No VTODO found.')
+    return b''.join(rv)
+
+
+def _same_date(a, b):
+    '''Whether the dates ``a`` and ``b`` look the same in the editor, which
+    shows times only to the minute.'''
+    if isinstance(a, (datetime.datetime, datetime.time)) and \
+       type(a) is type(b):
+        return a.replace(second=0, microsecond=0) == \
+            b.replace(second=0, microsecond=0)
+    return a == b
+
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def _to_utc(dt):
+    '''Convert a datetime to a naive one in UTC. Naive datetimes are in
+    local time.'''
+    if dt.tzinfo is not None:
+        seconds = timegm(dt.utctimetuple())
+    else:
+        seconds = time.mktime(dt.timetuple())
+    return _EPOCH + datetime.timedelta(seconds=seconds,
+                                       microseconds=dt.microsecond)
+
+
+def _to_local(dt):
+    '''Convert a datetime to a naive one in local time. Naive datetimes are
+    in UTC.'''
+    return datetime.datetime.fromtimestamp(timegm(dt.utctimetuple())) \
+        .replace(microsecond=dt.microsecond)
+
+
+def _decode_date(value):
+    '''Parse a DATE, DATE-TIME or TIME value as found in iCalendar files.
+    Timezone information is dropped.'''
+    if not value:
+        return None
+    value = value.rstrip(u'Z')
+    try:
+        if u'T' in value:
+            return datetime.datetime.strptime(value, '%Y%m%dT%H%M%S')
+        elif len(value) == 8:
+            return datetime.datetime.strptime(value, '%Y%m%d').date()
+        elif len(value) == 6:
+            return datetime.datetime.strptime(value, '%H%M%S').time()
+    except ValueError:
+        pass
+    raise ParsingError('Invalid date: {}'.format(value))
+
+
+#: how many files are sent to a worker process at once
+_SCAN_CHUNKSIZE = 64
+
+
+def _scan_file(filepath):
+    '''Read and scan a single task file. Returns a tuple of the scanned fields
+    and an error message. Also used inside worker processes.'''
+    with open(filepath, 'rb') as f:
+        raw = f.read()
+    try:
+        return scan_vtodo(raw), None
+    except ValueError as e:
+        return None, str(e)
+
+
+def file_etag(st):
+    '''Return a tuple identifying the version of a file from its
+    ``os.stat_result``.'''
+    mtime = getattr(st, 'st_mtime_ns', None) or st.st_mtime
+    return (mtime, st.st_size, st.st_ino)
+
+
+def _is_hidden(name):
+    '''Hidden files are temporary files of vdirsyncer and watdo itself.'''
+    return name.startswith('.')
+
+
+def _list_calendar(dirpath, index=None):
+    '''Return a sorted list of ``(filename, stat, entry)`` for each task file
+    in ``dirpath``, where ``entry`` is the up-to-date index entry if there is
+    one.'''
+    cached = index.get_calendar(dirpath) if index is not None else {}
+    rv = []
+    for dirent in scandir(dirpath):
+        filename = dirent.name
+        if not filename.endswith('.ics') or _is_hidden(filename) or \
+           not dirent.is_file():
+            continue
+        st = dirent.stat()
+
+        entry = cached.get(filename)
+        if entry is not None and entry[0] != index.key(st):
+            entry = None
+        rv.append((filename, st, entry))
+    rv.sort(key=lambda x: x[0])
+    return rv
+
+
+def is_pending(fields):
+    '''Predicate for :py:func:`walk_calendars` that rejects completed and
+    cancelled tasks.'''
+    return fields.get('status') not in (u'COMPLETED', u'CANCELLED')
+
+
+def walk_calendar(dirpath, index=None, pool=None, predicate=None):
+    '''Yield all tasks inside the calendar at ``dirpath``, ordered by
+    filename.
+
+    If a :py:class:`watdo.cache.TaskIndex` is given, files whose stat data
+    didn't change since the last run are not read at all. That includes
+    files that couldn't be parsed, which are only reported once. If a
+    ``multiprocessing.Pool`` is given, the remaining files are scanned by its
+    workers. ``predicate`` is called with the scanned fields of each task
+    (see :py:func:`scan_vtodo`), tasks for which it returns false are
+    skipped.'''
+    with stats.timer('list_files'):
+        files = _list_calendar(dirpath, index)
+
+    # files that couldn't be parsed last time are skipped until they change
+    quarantine = {}
+    if index is not None:
+        known_bad = index.get_quarantine(dirpath)
+        if known_bad:
+            rv = []
+            for filename, st, entry in files:
+                bad = known_bad.get(filename)
+                if bad is not None and bad[0] == index.key(st):
+                    quarantine[filename] = bad
+                else:
+                    rv.append((filename, st, entry))
+            stats.incr('files_quarantined', len(files) - len(rv))
+            files = rv
+
+    misses = [os.path.join(dirpath, filename)
+              for filename, st, entry in files if entry is None]
+    stats.incr('files_scanned', len(files))
+    stats.incr('cache_hits', len(files) - len(misses))
+    if pool is not None and misses:
+        results = pool.imap(_scan_file, misses, _SCAN_CHUNKSIZE)
+    else:
+        results = imap(_scan_file, misses)
+
+    seen = {}
+    for filename, st, entry in files:
+        filepath = os.path.join(dirpath, filename)
+        if entry is None:
+            with stats.timer('scan_files'):
+                fields, error = next(results)
+            stats.incr('bytes_read', st.st_size)
+            if error is not None:
+                stats.incr('parse_failures')
+                print('Error happened during parsing {}: {}'
+                      .format(filepath, error))
+                if index is not None:
+                    quarantine[filename] = [index.key(st), error]
+                continue
+            entry = [None if index is None else index.key(st), fields]
+
+        seen[filename] = entry
+        fields = entry[1]
+        if fields is not None and (predicate is None or predicate(fields)):
+            yield Task(filepath=filepath, stat=st, etag=file_etag(st),
+                       _fields=fields)
+
+    if index is not None:
+        index.set_calendar(dirpath, seen)
+        index.set_quarantine(dirpath, quarantine)
+
+
+class _LazyPool(object):
+    '''A ``multiprocessing.Pool`` of ``jobs`` processes that is only
+    started when :py:func:`walk_calendar` has files to scan. When all files
+    are cached, no processes are spawned at all.'''
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self._pool = None
+
+    def imap(self, *args):
+        if self._pool is None:
+            import multiprocessing
+            self._pool = multiprocessing.Pool(self.jobs)
+        return self._pool.imap(*args)
+
+    def terminate(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+
+
+def walk_calendars(path, index=None, jobs=1, calendars=None,
+                   predicate=None):
+    '''Yield all tasks of all calendars inside ``path``. With ``jobs`` greater
+    than one, files are scanned by a pool of that many processes. The order
+    of tasks is the same either way.
 
+    If ``calendars`` is given, only the calendars with those names are read.
+    See :py:func:`walk_calendar` for ``predicate``.'''
+    dirpaths = []
+    if calendars is None:
+        for dirent in scandir(path):
+            if not _is_hidden(dirent.name) and dirent.is_dir():
+                dirpaths.append(dirent.path)
+        dirpaths.sort()
+        if index is not None:
+            index.retain_calendars(dirpaths)
+    else:
+        for dirname in sorted(set(calendars)):
+            dirpath = os.path.join(path, dirname)
+            if os.path.isdir(dirpath):
+                dirpaths.append(dirpath)
 
-def walk_calendars(path):
-    '''Yield name of and absolute path to each available calendar.'''
-    for dirname in os.listdir(path):
-        dirpath = os.path.join(path, dirname)
-        if not os.path.isfile(dirpath):
-            for task in walk_calendar(dirpath):
+    pool = _LazyPool(jobs) if jobs > 1 else None
+    try:
+        for dirpath in dirpaths:
+            for task in walk_calendar(dirpath, index=index, pool=pool,
+                                      predicate=predicate):
                 yield task
+    finally:
+        if pool is not None:
+            pool.terminate()
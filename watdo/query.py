@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+'''
+    watdo.query
+    ~~~~~~~~~~~
+
+    This module provides filter expressions for tasks, such as::
+
+        due<2014-11-01 status:IN-PROCESS @work invoice
+
+    and secondary indexes over the fields of a calendar, which are used to
+    select the matching tasks without looking at each of them.
+
+    :copyright: (c) 2014 Markus Unterwaditzer
+    :license: MIT, see LICENSE for more details.
+'''
+
+import bisect
+import datetime
+import re
+
+from . import editor
+from .exceptions import CliError
+from .model import _decode_date
+
+_word_re = re.compile(r'\w+', re.UNICODE)
+_due_re = re.compile(r'^due(<=|>=|<|>|:)(.+)$')
+_done_statuses = (u'COMPLETED', u'CANCELLED')
+
+
+def split_words(text):
+    '''Return a list of the lowercase words in ``text``.'''
+    return _word_re.findall(text.lower())
+
+
+def tokenize(text):
+    '''Return the set of lowercase words in ``text``.'''
+    return set(split_words(text))
+
+
+def _field_words(fields):
+    return tokenize(u'{}\n{}'.format(fields.get('summary', u''),
+                                     fields.get('description', u'')))
+
+
+def _status(fields):
+    return (fields.get('status') or u'NEEDS-ACTION').upper()
+
+
+def _as_datetime(x, today):
+    '''Tasks that are due at a time without a date are due ``today``.'''
+    if isinstance(x, datetime.datetime):
+        return x
+    elif isinstance(x, datetime.date):
+        return datetime.datetime(x.year, x.month, x.day)
+    return datetime.datetime.combine(today, x)
+
+
+def _in_range(value, lower, upper):
+    if lower is not None:
+        bound, inclusive = lower
+        if value < bound or (value == bound and not inclusive):
+            return False
+    if upper is not None:
+        bound, inclusive = upper
+        if value > bound or (value == bound and not inclusive):
+            return False
+    return True
+
+
+def _discard(mapping, key, filename):
+    filenames = mapping.get(key)
+    if filenames is not None:
+        filenames.discard(filename)
+        if not filenames:
+            del mapping[key]
+
+
+class FieldIndex(object):
+    '''Secondary indexes over the scanned fields of the tasks in one
+    calendar. ``entries`` has the format used by
+    :py:class:`watdo.cache.TaskIndex`.'''
+
+    def __init__(self, entries=None):
+        self.filenames = set()
+        #: maps statuses to sets of filenames
+        self.statuses = {}
+        #: maps words of the summary and description to sets of filenames
+        self.words = {}
+        #: sorted due dates, and the filenames at the same positions
+        self._due = []
+        self._due_filenames = []
+        #: maps filenames to due times of tasks without a due date
+        self._due_times = {}
+        for filename, (key, fields) in (entries or {}).items():
+            self.add(filename, fields)
+
+    def add(self, filename, fields):
+        if fields is None:
+            return
+        self.filenames.add(filename)
+        self.statuses.setdefault(_status(fields), set()).add(filename)
+        for word in _field_words(fields):
+            self.words.setdefault(word, set()).add(filename)
+
+        due = _decode_date(fields.get('due'))
+        if isinstance(due, datetime.time):
+            self._due_times[filename] = due
+        elif due is not None:
+            due = _as_datetime(due, None)
+            i = bisect.bisect_right(self._due, due)
+            self._due.insert(i, due)
+            self._due_filenames.insert(i, filename)
+
+    def remove(self, filename, fields):
+        if fields is None:
+            return
+        self.filenames.discard(filename)
+        _discard(self.statuses, _status(fields), filename)
+        for word in _field_words(fields):
+            _discard(self.words, word, filename)
+
+        due = _decode_date(fields.get('due'))
+        if isinstance(due, datetime.time):
+            self._due_times.pop(filename, None)
+        elif due is not None:
+            due = _as_datetime(due, None)
+            lo = bisect.bisect_left(self._due, due)
+            hi = bisect.bisect_right(self._due, due)
+            i = self._due_filenames.index(filename, lo, hi)
+            del self._due[i]
+            del self._due_filenames[i]
+
+    def update(self, old, new):
+        '''Apply the difference between the entries ``old`` and ``new``.'''
+        for filename, entry in old.items():
+            if new.get(filename) != entry:
+                self.remove(filename, entry[1])
+        for filename, entry in new.items():
+            if old.get(filename) != entry:
+                self.add(filename, entry[1])
+
+    def due_between(self, lower, upper, today):
+        '''Return the filenames of tasks due within the bounds. Each bound is
+        either ``None`` or a tuple of a datetime and whether it is
+        inclusive.'''
+        lo = 0
+        hi = len(self._due)
+        if lower is not None:
+            bound, inclusive = lower
+            if inclusive:
+                lo = bisect.bisect_left(self._due, bound)
+            else:
+                lo = bisect.bisect_right(self._due, bound)
+        if upper is not None:
+            bound, inclusive = upper
+            if inclusive:
+                hi = bisect.bisect_right(self._due, bound)
+            else:
+                hi = bisect.bisect_left(self._due, bound)
+        rv = set(self._due_filenames[lo:hi])
+        for filename, time in self._due_times.items():
+            if _in_range(_as_datetime(time, today), lower, upper):
+                rv.add(filename)
+        return rv
+
+
+class Query(object):
+    '''A parsed filter expression. Terms are separated by whitespace and all
+    of them have to match:
+
+    ``@calendar``
+        Tasks in that calendar. If given multiple times, tasks in any of
+        them.
+    ``status:STATUS``
+        Tasks with that status, aliases such as ``x`` work too. If given
+        multiple times, tasks with any of them.
+    ``due<DATE``, ``due<=DATE``, ``due>DATE``, ``due>=DATE``, ``due:DATE``
+        Tasks due before, after or at ``DATE``, which has the same format as
+        in the editor.
+    ``text:WORD`` or just ``WORD``
+        Tasks with that word in their summary or description.
+
+    Without a ``status:`` term, ``pending`` excludes completed and cancelled
+    tasks. Queries are predicates for :py:func:`watdo.model.walk_calendars`.
+    The daemon, which keeps its indexes in memory, uses :py:meth:`candidates`
+    instead.'''
+
+    def __init__(self, text=u'', calendars=None, pending=False):
+        self.text = text
+        self.calendars = set(calendars or ())
+        self.statuses = set()
+        self.pending = pending
+        self.lower = None
+        self.upper = None
+        self.words = set()
+        self.today = datetime.date.today()
+
+        for term in text.split():
+            self._parse_term(term)
+        if not self.calendars:
+            self.calendars = None
+
+    def _parse_term(self, term):
+        if term.startswith(u'@') and len(term) > 1:
+            self.calendars.add(term[1:])
+        elif term.startswith(u'status:'):
+            value = term[len(u'status:'):]
+            status = editor.parse_status(value) or \
+                editor.parse_status(value.upper())
+            if not status:
+                raise CliError(u'Invalid status in query: {}'.format(value))
+            self.statuses.add(status)
+        elif term.startswith(u'text:'):
+            self.words.update(tokenize(term[len(u'text:'):]))
+        elif _due_re.match(term):
+            op, value = _due_re.match(term).groups()
+            self._parse_due(op, value)
+        else:
+            self.words.update(tokenize(term))
+
+    def _parse_due(self, op, value):
+        try:
+            due = editor.parse_date(value)
+        except ValueError:
+            raise CliError(u'Invalid date in query: {}'.format(value))
+        if isinstance(due, datetime.datetime) or \
+           isinstance(due, datetime.time):
+            start = end = _as_datetime(due, self.today)
+            end_inclusive = True
+        else:
+            start = _as_datetime(due, self.today)
+            end = start + datetime.timedelta(days=1)
+            end_inclusive = False
+
+        if op in (u'>=', u':'):
+            self._set_lower(start, True)
+        if op in (u'<=', u':'):
+            self._set_upper(end, end_inclusive)
+        if op == u'<':
+            self._set_upper(start, False)
+        elif op == u'>':
+            self._set_lower(end, not end_inclusive)
+
+    def _set_lower(self, bound, inclusive):
+        if self.lower is None or bound > self.lower[0] or \
+           (bound == self.lower[0] and not inclusive):
+            self.lower = (bound, inclusive)
+
+    def _set_upper(self, bound, inclusive):
+        if self.upper is None or bound < self.upper[0] or \
+           (bound == self.upper[0] and not inclusive):
+            self.upper = (bound, inclusive)
+
+    @property
+    def includes_done(self):
+        '''Whether completed or cancelled tasks can match.'''
+        if self.statuses:
+            return bool(self.statuses.intersection(_done_statuses))
+        return not self.pending
+
+    @property
+    def has_due(self):
+        return self.lower is not None or self.upper is not None
+
+    def __call__(self, fields):
+        status = _status(fields)
+        if self.statuses:
+            if status not in self.statuses:
+                return False
+        elif self.pending and status in _done_statuses:
+            return False
+
+        if self.has_due:
+            due = _decode_date(fields.get('due'))
+            if due is None or not _in_range(_as_datetime(due, self.today),
+                                            self.lower, self.upper):
+                return False
+
+        if self.words and not self.words.issubset(_field_words(fields)):
+            return False
+        return True
+
+    def candidates(self, index):
+        '''Return the filenames of matching tasks inside the
+        :py:class:`FieldIndex` ``index``, or ``None`` if all tasks match.'''
+        sets = []
+        if self.statuses:
+            sets.append(set().union(*(index.statuses.get(status, ())
+                                      for status in self.statuses)))
+        elif self.pending:
+            sets.append(index.filenames.difference(
+                *(index.statuses.get(status, ())
+                  for status in _done_statuses)))
+
+        if self.has_due:
+            sets.append(index.due_between(self.lower, self.upper,
+                                          self.today))
+
+        for word in self.words:
+            sets.append(index.words.get(word, set()))
+
+        if not sets:
+            return None
+        sets.sort(key=len)
+        return set(sets[0]).intersection(*sets[1:])
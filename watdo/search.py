@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+'''
+    watdo.search
+    ~~~~~~~~~~~~
+
+    This module provides a persistent full-text index over the summaries and
+    descriptions of all tasks. It is updated from a
+    :py:class:`watdo.cache.TaskIndex`, so only tasks whose files changed are
+    tokenized again.
+
+    :copyright: (c) 2014 Markus Unterwaditzer
+    :license: MIT, see LICENSE for more details.
+'''
+
+import math
+import os
+
+from .cache import JSONIndex
+from .query import split_words
+
+#: how much more a word in the summary counts than one in the description
+SUMMARY_WEIGHT = 3
+
+
+def term_weights(fields):
+    '''Return a dict mapping each word of a task to its weight.'''
+    rv = {}
+    for word in split_words(fields.get('summary', u'')):
+        rv[word] = rv.get(word, 0) + SUMMARY_WEIGHT
+    for word in split_words(fields.get('description', u'')):
+        rv[word] = rv.get(word, 0) + 1
+    return rv
+
+
+class SearchIndex(JSONIndex):
+    '''Maps the path of each task file to its words::
+
+        {filepath: [key, {word: weight}]}
+
+    ``key`` is the one of the file in the :py:class:`watdo.cache.TaskIndex`
+    the words were taken from. The inverted index is built from this when
+    it's first needed.'''
+
+    version = 1
+
+    def __init__(self, filepath=None):
+        JSONIndex.__init__(self, filepath)
+        self.documents = {}
+        self._postings = None
+
+    def _load(self, data):
+        self.documents = data['documents']
+
+    def _dump(self):
+        return {'documents': self.documents}
+
+    def postings(self):
+        '''Return a dict mapping words to dicts of filepaths and weights.'''
+        if self._postings is None:
+            self._postings = {}
+            for filepath, (key, weights) in self.documents.items():
+                self._add_postings(filepath, weights)
+        return self._postings
+
+    def _add_postings(self, filepath, weights):
+        for word, weight in weights.items():
+            self._postings.setdefault(word, {})[filepath] = weight
+
+    def _remove(self, filepath):
+        key, weights = self.documents.pop(filepath)
+        if self._postings is not None:
+            for word in weights:
+                docs = self._postings[word]
+                del docs[filepath]
+                if not docs:
+                    del self._postings[word]
+        self.changed = True
+
+    def update(self, task_index):
+        '''Update the words of all tasks whose key in ``task_index``
+        changed, and forget about tasks that are gone.'''
+        seen = set()
+        for dirpath, entries in task_index.calendars.items():
+            for filename, (key, fields) in entries.items():
+                if fields is None:
+                    continue
+                filepath = os.path.join(dirpath, filename)
+                seen.add(filepath)
+                doc = self.documents.get(filepath)
+                if doc is not None and doc[0] == key:
+                    continue
+                if doc is not None:
+                    self._remove(filepath)
+                weights = term_weights(fields)
+                self.documents[filepath] = [key, weights]
+                if self._postings is not None:
+                    self._add_postings(filepath, weights)
+                self.changed = True
+
+        for filepath in set(self.documents).difference(seen):
+            self._remove(filepath)
+
+    def search(self, text):
+        '''Return a list of ``(score, filepath)`` of tasks containing all
+        words of ``text``, best matches first. Scores are the sum of each
+        word's weight in the task times its inverse document frequency.'''
+        postings = self.postings()
+        words = set(split_words(text))
+        if not words:
+            return []
+
+        matches = None
+        for word in words:
+            docs = postings.get(word)
+            if not docs:
+                return []
+            if matches is None:
+                matches = set(docs)
+            else:
+                matches.intersection_update(docs)
+
+        n = float(len(self.documents))
+        idf = dict((word, math.log(1 + n / len(postings[word])))
+                   for word in words)
+        rv = [(sum(postings[word][filepath] * idf[word] for word in words),
+               filepath) for filepath in matches]
+        rv.sort(key=lambda x: (-x[0], x[1]))
+        return rv
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+'''
+    watdo.stats
+    ~~~~~~~~~~~
+
+    This module collects wall time per phase and counters for ``--profile``.
+    Everything is a no-op unless :py:func:`enable` was called.
+
+    :copyright: (c) 2014 Markus Unterwaditzer
+    :license: MIT, see LICENSE for more details.
+'''
+
+import json
+import sys
+import timeit
+
+_enabled = False
+_timings = {}
+_counters = {}
+
+
+def enable():
+    '''Start collecting, discarding all previous data.'''
+    global _enabled
+    _enabled = True
+    _timings.clear()
+    _counters.clear()
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def incr(name, n=1):
+    '''Increase the counter ``name`` by ``n``.'''
+    if _enabled:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+class _Timer(object):
+    __slots__ = ('phase', 'start')
+
+    def __init__(self, phase):
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = timeit.default_timer()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        seconds = timeit.default_timer() - self.start
+        calls, total = _timings.get(self.phase, (0, 0.0))
+        _timings[self.phase] = (calls + 1, total + seconds)
+
+
+class _NullTimer(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, tb):
+        pass
+
+
+_null_timer = _NullTimer()
+
+
+def timer(phase):
+    '''Return a context manager that adds the time spent inside of it to
+    ``phase``.'''
+    if _enabled:
+        return _Timer(phase)
+    return _null_timer
+
+
+def report():
+    return {
+        'timings': dict((phase, {'calls': calls, 'seconds': seconds})
+                        for phase, (calls, seconds) in _timings.items()),
+        'counters': dict(_counters)
+    }
+
+
+def dump(filename):
+    '''Write the report as JSON to ``filename``, ``-`` for stderr.'''
+    data = json.dumps(report(), indent=2, sort_keys=True) + '\n'
+    if filename == '-':
+        sys.stderr.write(data)
+    else:
+        with open(filename, 'w') as f:
+            f.write(data)
@@ -0,0 +1,388 @@
+# -*- coding: utf-8 -*-
+'''
+    watdo.storage
+    ~~~~~~~~~~~~~
+
+    This module provides the places tasks can be stored in. The default is a
+    vdir, a directory of calendars with one file per task, as written by
+    vdirsyncer. Alternatively, tasks can be kept in a single SQLite database,
+    which avoids opening and syncing a file for every task.
+
+    Both hand out tasks whose paths look like the ones inside the vdir, so
+    the database can be exported to the vdir and imported from it again.
+
+    :copyright: (c) 2014 Markus Unterwaditzer
+    :license: MIT, see LICENSE for more details.
+'''
+
+import datetime
+import errno
+import json
+import os
+
+from . import model, stats
+from .cli_utils import check_directory
+from .query import Query, _done_statuses, _status
+
+
+class VdirStorage(object):
+    '''Tasks stored as files inside the vdir at ``path``. See
+    :py:func:`watdo.model.walk_calendars` for ``index`` and ``jobs``.'''
+
+    def __init__(self, path, index=None, jobs=1):
+        self.path = path
+        self.index = index
+        self.jobs = jobs
+
+    def walk(self, calendars=None, predicate=None):
+        '''Yield the tasks of ``calendars``, or of all calendars, for whose
+        scanned fields ``predicate`` returns true.'''
+        return model.walk_calendars(self.path, index=self.index,
+                                    jobs=self.jobs, calendars=calendars,
+                                    predicate=predicate)
+
+    def batch(self):
+        '''Return a new batch of writes and removals, see
+        :py:class:`watdo.model.WriteBatch`.'''
+        return model.WriteBatch()
+
+    def read(self, filepath):
+        '''Return the current content of the task at ``filepath``, or
+        ``None`` if there is none.'''
+        try:
+            with open(filepath, 'rb') as f:
+                return f.read()
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS tasks (
+    calendar TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    fields TEXT NOT NULL,
+    data BLOB NOT NULL,
+    version INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    due TEXT,
+    due_time INTEGER NOT NULL,
+    completed TEXT,
+    PRIMARY KEY (calendar, filename)
+);
+CREATE INDEX IF NOT EXISTS tasks_status ON tasks (calendar, status);
+CREATE INDEX IF NOT EXISTS tasks_due ON tasks (due);
+CREATE INDEX IF NOT EXISTS tasks_completed ON tasks (completed);
+'''
+
+
+def _isoformat(value):
+    '''Return dates and datetimes as sortable strings, ``None`` for
+    anything else.'''
+    if isinstance(value, datetime.datetime):
+        return value.strftime('%Y-%m-%dT%H:%M:%S')
+    elif isinstance(value, datetime.date):
+        return value.strftime('%Y-%m-%dT00:00:00')
+    return None
+
+
+def _columns(fields):
+    '''Return the indexed columns for the scanned ``fields`` of a task.'''
+    due = model._decode_date(fields.get('due'))
+    return {
+        'fields': json.dumps(fields, sort_keys=True),
+        'status': _status(fields),
+        'due': _isoformat(due),
+        'due_time': int(isinstance(due, datetime.time)),
+        'completed': _isoformat(model._decode_date(fields.get('completed')))
+    }
+
+
+def _in(column, values):
+    return '{} IN ({})'.format(column, ', '.join('?' for x in values))
+
+
+def _query_sql(q):
+    '''Translate the :py:class:`watdo.query.Query` ``q`` into a WHERE clause
+    and its parameters. The clause may match more tasks than ``q``, such as
+    ones containing the wrong words.'''
+    terms = []
+    params = []
+    if q.calendars is not None:
+        calendars = sorted(q.calendars)
+        terms.append(_in('calendar', calendars))
+        params.extend(calendars)
+    if q.statuses:
+        statuses = sorted(q.statuses)
+        terms.append(_in('status', statuses))
+        params.extend(statuses)
+    elif q.pending:
+        terms.append('status NOT IN (?, ?)')
+        params.extend(_done_statuses)
+    if q.has_due:
+        bounds = []
+        for bound, op in ((q.lower, '>'), (q.upper, '<')):
+            if bound is not None:
+                value, inclusive = bound
+                if inclusive:
+                    op += '='
+                bounds.append('due {} ?'.format(op))
+                params.append(_isoformat(value))
+        # tasks due at a time are due today, which the query checks itself
+        terms.append('(due IS NOT NULL AND {} OR due_time)'
+                     .format(' AND '.join(bounds)))
+    return ' AND '.join(terms) or '1', params
+
+
+class SQLiteStorage(object):
+    '''Tasks stored in the SQLite database at ``filepath``. Each row keeps
+    the original iCalendar data of a task and indexed columns for filtering.
+
+    Tasks get paths inside ``basepath`` as if they were stored in the vdir
+    there, which is what :py:meth:`export_vdir` writes them to.'''
+
+    def __init__(self, filepath, basepath):
+        self.filepath = filepath
+        self.basepath = basepath
+        self._conn = None
+
+    def connect(self):
+        if self._conn is None:
+            import sqlite3
+            check_directory(os.path.dirname(self.filepath))
+            self._conn = sqlite3.connect(self.filepath)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.executescript(_SCHEMA)
+        return self._conn
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def split_path(self, filepath):
+        '''Return the calendar and filename of the task at ``filepath``.'''
+        dirpath, filename = os.path.split(filepath)
+        return os.path.basename(dirpath), filename
+
+    def walk(self, calendars=None, predicate=None):
+        '''Like :py:meth:`VdirStorage.walk`. Queries are applied to the
+        indexed columns first.'''
+        terms = []
+        params = []
+        if calendars is not None:
+            calendars = sorted(calendars)
+            terms.append(_in('calendar', calendars))
+            params.extend(calendars)
+        if isinstance(predicate, Query):
+            where, query_params = _query_sql(predicate)
+            terms.append(where)
+            params.extend(query_params)
+
+        with stats.timer('sqlite_query'):
+            rows = self.connect().execute(
+                'SELECT calendar, filename, fields, version FROM tasks '
+                'WHERE {} ORDER BY calendar, filename'
+                .format(' AND '.join(terms) or '1'), params).fetchall()
+        stats.incr('rows_read', len(rows))
+        for calendar, filename, fields, version in rows:
+            fields = json.loads(fields)
+            if predicate is not None and not predicate(fields):
+                continue
+            yield model.Task(
+                filepath=os.path.join(self.basepath, calendar, filename),
+                etag=[version], _fields=fields)
+
+    def batch(self):
+        return SQLiteBatch(self)
+
+    def load(self, filepath):
+        '''Return the data and etag of the task at ``filepath``, or ``None``
+        if there is none.'''
+        row = self.connect().execute(
+            'SELECT data, version FROM tasks WHERE calendar = ? AND '
+            'filename = ?', self.split_path(filepath)).fetchone()
+        if row is None:
+            return None
+        data, version = row
+        return bytes(data), [version]
+
+    def read(self, filepath):
+        '''See :py:meth:`VdirStorage.read`.'''
+        rv = self.load(filepath)
+        return None if rv is None else rv[0]
+
+    def import_vdir(self, path, delete=False):
+        '''Copy all tasks from the vdir at ``path`` into the database. With
+        ``delete``, tasks that aren't in the vdir are removed. Returns a
+        list of ``(filepath, error)`` for the tasks that failed.'''
+        batch = self.batch()
+        seen = set()
+        for task in model.walk_calendars(path):
+            seen.add((task.calendar, task.filename))
+            filepath = os.path.join(self.basepath, task.calendar,
+                                    task.filename)
+            with open(task.filepath, 'rb') as f:
+                data = f.read()
+            old = self.load(filepath)
+            if old is None or old[0] != data:
+                batch.write_raw(filepath, data)
+        if delete:
+            for calendar, filename in self.connect().execute(
+                    'SELECT calendar, filename FROM tasks').fetchall():
+                if (calendar, filename) not in seen:
+                    batch.remove(os.path.join(self.basepath, calendar,
+                                              filename))
+        return batch.commit()
+
+    def export_vdir(self, path, delete=False):
+        '''Write all tasks into the vdir at ``path``. Only files whose
+        content differs are written. With ``delete``, files of tasks that
+        aren't in the database are removed. Returns a list of
+        ``(filepath, error)`` for the files that failed.'''
+        existing = dict(((task.calendar, task.filename), task.filepath)
+                        for task in model.walk_calendars(path))
+        batch = model.WriteBatch()
+        for calendar, filename, data in self.connect().execute(
+                'SELECT calendar, filename, data FROM tasks '
+                'ORDER BY calendar, filename'):
+            data = bytes(data)
+            filepath = existing.pop((calendar, filename), None)
+            if filepath is not None:
+                with open(filepath, 'rb') as f:
+                    if f.read() == data:
+                        continue
+            dirpath = os.path.join(path, calendar)
+            if dirpath not in batch.directories:
+                check_directory(dirpath)
+                batch.directories.add(dirpath)
+            batch.write_raw(os.path.join(dirpath, filename), data)
+        if delete:
+            for filepath in sorted(existing.values()):
+                batch.remove(filepath)
+        return batch.commit()
+
+
+class _AnyCalendar(object):
+    '''Calendars don't have to be created in the database.'''
+
+    def __contains__(self, dirpath):
+        return True
+
+    def add(self, dirpath):
+        pass
+
+
+class SQLiteBatch(object):
+    '''Like :py:class:`watdo.model.WriteBatch`, but all changes are applied
+    in a single transaction of a :py:class:`SQLiteStorage`.'''
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.directories = _AnyCalendar()
+        self._writes = []
+        self._removals = []
+
+    def write(self, task, create=False):
+        self._writes.append((task.filepath, task, create,
+                             task._old_filepaths))
+
+    def write_raw(self, filepath, data, create=False, old_filepaths=()):
+        self._writes.append((filepath, data, create, list(old_filepaths)))
+
+    def remove(self, filepath):
+        self._removals.append(filepath)
+
+    def __len__(self):
+        return len(self._writes) + len(self._removals)
+
+    def load(self, record):
+        '''Read the task the :py:class:`watdo.model.TaskRecord` ``record``
+        was created from, see :py:meth:`watdo.model.TaskRecord.load`.'''
+        self.check(record)
+        data, etag = self.storage.load(record.filepath)
+        return model.Task(filepath=record.filepath, vcal=data, etag=etag)
+
+    def check(self, record):
+        '''See :py:meth:`watdo.model.TaskRecord.check`.'''
+        record._check_archived()
+        rv = self.storage.load(record.filepath)
+        if rv is None:
+            raise model.ConflictError(u'{} was removed.'
+                                      .format(record.filepath))
+        if record.etag is not None and rv[1] != list(record.etag):
+            raise model.ConflictError(u'{} was changed by another program.'
+                                      .format(record.filepath))
+
+    def commit(self):
+        writes = self._writes
+        removals = self._removals
+        self._writes = []
+        self._removals = []
+        conn = self.storage.connect()
+        errors = []
+        with stats.timer('SQLiteBatch.commit'):
+            with conn:
+                for job in writes:
+                    error = self._write(conn, job)
+                    if error is not None:
+                        errors.append((job[0], error))
+                for filepath in removals:
+                    if not self._delete(conn, filepath):
+                        errors.append((filepath, OSError(
+                            errno.ENOENT, os.strerror(errno.ENOENT),
+                            filepath)))
+                    else:
+                        stats.incr('rows_removed')
+        return errors
+
+    def _delete(self, conn, filepath):
+        return conn.execute(
+            'DELETE FROM tasks WHERE calendar = ? AND filename = ?',
+            self.storage.split_path(filepath)).rowcount > 0
+
+    def _write(self, conn, job):
+        filepath, data, create, moved_from = job
+        old_filepaths = [x for x in moved_from or () if x != filepath]
+        try:
+            if isinstance(data, model.Task):
+                data, unchanged = data.serialize()
+                if unchanged and not create and not old_filepaths:
+                    stats.incr('writes_skipped')
+                    return None
+            fields = model.scan_vtodo(data)
+        except ValueError as e:
+            return e
+        if fields is None:
+            return model.ParsingError('No VTODO found.')
+
+        calendar, filename = self.storage.split_path(filepath)
+        columns = _columns(fields)
+        names = sorted(columns)
+        values = [columns[name] for name in names]
+        import sqlite3
+        updated = 0
+        if not create:
+            updated = conn.execute(
+                'UPDATE tasks SET data = ?, version = version + 1, {} '
+                'WHERE calendar = ? AND filename = ?'
+                .format(', '.join('{} = ?'.format(name) for name in names)),
+                [sqlite3.Binary(data)] + values + [calendar, filename]
+            ).rowcount
+        if not updated:
+            try:
+                conn.execute(
+                    'INSERT INTO tasks (calendar, filename, data, version, '
+                    '{}) VALUES (?, ?, ?, 1, {})'
+                    .format(', '.join(names), ', '.join('?' * len(names))),
+                    [calendar, filename, sqlite3.Binary(data)] + values)
+            except sqlite3.IntegrityError:
+                return OSError(errno.EEXIST, os.strerror(errno.EEXIST),
+                               filepath)
+        stats.incr('rows_written')
+        for old_filepath in old_filepaths:
+            self._delete(conn, old_filepath)
+        while moved_from:
+            moved_from.pop()
+        return None